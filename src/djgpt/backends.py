@@ -0,0 +1,128 @@
+"""DJ GPT CLI
+
+Module for the language model backends a prompt system can ask, hosted by OpenAI or run locally on the CPU
+"""
+
+import abc
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+import openai
+
+from djgpt.utils import check_cancelled, debug
+
+
+class Backend(abc.ABC):
+    """Something that can complete a chat, taking the arguments and answering in the shape of OpenAI's API."""
+
+    name = "backend"
+
+    @abc.abstractmethod
+    def create(
+        self, model: str, messages: List[Dict], max_tokens: int, temperature: float, **kwargs
+    ) -> Dict:
+        pass
+
+
+class OpenAIBackend(Backend):
+    """Models hosted by OpenAI, the default for every prompt system."""
+
+    name = "openai"
+
+    def create(
+        self, model: str, messages: List[Dict], max_tokens: int, temperature: float, **kwargs
+    ) -> Dict:
+        return openai.ChatCompletion.create(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, **kwargs
+        )
+
+
+OPENAI = OpenAIBackend()
+
+
+class LlamaCppBackend(Backend):
+    """A small quantized GGUF model run in-process on the CPU with llama-cpp-python.
+
+    There's no network round trip or per-token cost, so it suits cheap tasks like parsing a selection. The model is
+    loaded on first use and requests are serialised, as a llama.cpp context can only do one thing at a time. The model
+    name asked for is ignored, it's whichever model_path was loaded.
+
+    Function calling is done by constraining the output to the function's JSON schema, then answering as if the
+    model had called it.
+    """
+
+    name = "llama.cpp"
+
+    def __init__(
+        self,
+        model_path: Union[str, Path],
+        n_ctx: int = 4096,
+        n_threads: Optional[int] = None,
+        chat_format: Optional[str] = None,
+    ):
+        self.model_path = Path(model_path)
+        self.n_ctx = n_ctx
+        self.n_threads = n_threads
+        self.chat_format = chat_format
+        self.lock = threading.Lock()
+        self._llm: Any = None
+
+    def _load(self) -> Any:
+        if self._llm is None:
+            try:
+                from llama_cpp import Llama
+            except ImportError as e:
+                raise ImportError(
+                    "Running models locally needs llama-cpp-python: pip install llama-cpp-python"
+                ) from e
+            debug("Loading %s", self.model_path)
+            self._llm = Llama(
+                model_path=str(self.model_path),
+                n_ctx=self.n_ctx,
+                n_threads=self.n_threads,
+                n_gpu_layers=0,
+                chat_format=self.chat_format,
+                verbose=False,
+            )
+        return self._llm
+
+    def create(
+        self,
+        model: str,
+        messages: List[Dict],
+        max_tokens: int,
+        temperature: float,
+        functions: Optional[List[Dict]] = None,
+        function_call: Optional[Dict] = None,
+        **kwargs,
+    ) -> Dict:
+        # llama.cpp can't be interrupted part way, so this is the last chance to give up
+        check_cancelled()
+        function = None
+        options = {}
+        if functions:
+            wanted = (function_call or {}).get("name")
+            function = next((f for f in functions if f["name"] == wanted), functions[0])
+            messages = [
+                *messages,
+                {
+                    "role": "system",
+                    "content": f"Respond only with the JSON arguments for {function['name']}: "
+                    f"{function.get('description', '')}",
+                },
+            ]
+            options["response_format"] = {"type": "json_object", "schema": function["parameters"]}
+
+        with self.lock:
+            response = self._load().create_chat_completion(
+                messages=messages, max_tokens=max_tokens, temperature=temperature, **options
+            )
+
+        if function is not None:
+            message = response["choices"][0]["message"]
+            message["function_call"] = {
+                "name": function["name"],
+                "arguments": message.get("content") or "",
+            }
+        return response
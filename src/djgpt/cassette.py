@@ -0,0 +1,193 @@
+"""DJ GPT CLI
+
+Module to record every OpenAI and Spotify request/response of a real session to a cassette on disk, and replay them
+later with the original (or scaled) latencies, so runs and benchmarks can be reproduced offline
+"""
+
+import gzip
+import hashlib
+import json
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Union
+
+import openai
+from spotipy import SpotifyException
+
+from djgpt.backends import Backend
+from djgpt.catalog import Catalog, use_catalog
+from djgpt.history import History, use_history
+from djgpt.prompt import GPTPromptSystem
+from djgpt.spotify import _cli_spotify, set_spotify
+from djgpt.utils import debug
+
+RECORD = "record"
+REPLAY = "replay"
+
+
+class CassetteMiss(KeyError):
+    """Raised when replaying a request that was never recorded."""
+
+
+# Arguments that depend on how long we happen to have left rather than what is being asked
+TIMEOUT_ARGS = ("request_timeout", "timeout")
+
+
+def request_key(service: str, method: str, args: tuple, kwargs: Dict) -> str:
+    kwargs = {k: v for k, v in kwargs.items() if k not in TIMEOUT_ARGS}
+    request = json.dumps([service, method, args, kwargs], sort_keys=True, default=str)
+    return hashlib.sha1(request.encode()).hexdigest()
+
+
+class Cassette:
+    """Recorded responses keyed by a hash of the request.
+
+    The same request made several times gets its responses replayed in order, sticking on the last one.
+    """
+
+    def __init__(self, path: Union[str, Path], mode: str = RECORD, latency_scale: float = 1.0):
+        self.path = Path(path)
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.interactions: Dict[str, List[Dict]] = defaultdict(list)
+        self.cursors: Dict[str, int] = defaultdict(int)
+        self.lock = threading.Lock()
+        self.previous_spotify = None
+        self.catalog = use_catalog(Catalog())
+        self.history = use_history(History())
+        if mode == REPLAY:
+            with gzip.open(self.path, "rt") as f:
+                self.interactions.update(json.load(f))
+
+    def __len__(self) -> int:
+        return sum(len(responses) for responses in self.interactions.values())
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock, gzip.open(self.path, "wt") as f:
+            json.dump(self.interactions, f, separators=(",", ":"))
+        debug("Saved %d interactions to %s", len(self), self.path)
+
+    def call(self, service: str, method: str, func: Optional[Callable], *args, **kwargs) -> Any:
+        """Make a call through the cassette, recording or replaying it depending on the mode."""
+        key = request_key(service, method, args, kwargs)
+        if self.mode == REPLAY:
+            return self.replay(key, service, method)
+
+        start = time.perf_counter()
+        interaction: Dict[str, Any] = {}
+        try:
+            result = func(*args, **kwargs)
+            # Round trip through JSON so recording and replaying give back exactly the same shapes
+            interaction["response"] = json.loads(json.dumps(result, default=str))
+            return result
+        except SpotifyException as e:
+            interaction["error"] = {
+                "service": "spotify",
+                "status": e.http_status,
+                "code": e.code,
+                "msg": e.msg,
+            }
+            raise
+        except openai.OpenAIError as e:
+            interaction["error"] = {"service": "openai", "msg": str(e)}
+            raise
+        finally:
+            if interaction:
+                interaction["latency"] = time.perf_counter() - start
+                with self.lock:
+                    self.interactions[key].append(interaction)
+
+    def replay(self, key: str, service: str, method: str) -> Any:
+        with self.lock:
+            responses = self.interactions.get(key)
+            if not responses:
+                raise CassetteMiss(f"No recorded {service} {method} request matches")
+            interaction = responses[min(self.cursors[key], len(responses) - 1)]
+            self.cursors[key] += 1
+
+        if self.latency_scale:
+            time.sleep(interaction["latency"] * self.latency_scale)
+        error = interaction.get("error")
+        if error and error["service"] == "spotify":
+            raise SpotifyException(error["status"], error["code"], error["msg"])
+        if error:
+            raise openai.OpenAIError(error["msg"])
+        return interaction["response"]
+
+    def wrap_backend(self, backend: Backend) -> Backend:
+        return CassetteBackend(self, backend)
+
+    def install(self) -> "Cassette":
+        """Route every GPT and Spotify call through the cassette, whichever backend each prompt system asks.
+
+        The local catalog and listening history are swapped for empty ones so every search is recorded, or
+        replayed, regardless of what has been found or heard before.
+        """
+        GPTPromptSystem.wrap_backend = staticmethod(self.wrap_backend)
+        self.previous_spotify = set_spotify(CassetteSpotify(self))
+        self.catalog.__enter__()
+        self.history.__enter__()
+        return self
+
+    def uninstall(self):
+        GPTPromptSystem.wrap_backend = None
+        set_spotify(self.previous_spotify)
+        self.history.__exit__(None, None, None)
+        self.catalog.__exit__(None, None, None)
+        if self.mode == RECORD:
+            self.save()
+
+    def __enter__(self) -> "Cassette":
+        return self.install()
+
+    def __exit__(self, *exc):
+        self.uninstall()
+
+
+class CassetteBackend(Backend):
+    """Sends every chat completion for a backend through a cassette, so replaying never needs the backend itself."""
+
+    def __init__(self, cassette: Cassette, backend: Backend):
+        self.cassette = cassette
+        self.backend = backend
+        self.name = backend.name
+
+    def create(
+        self, model: str, messages: List[Dict], max_tokens: int, temperature: float, **kwargs
+    ) -> Dict:
+        # OpenAI keeps the name it was recorded under before there were other backends
+        service, method = (
+            ("openai", "ChatCompletion.create") if self.name == "openai" else (self.name, "create")
+        )
+        func = self.backend.create if self.cassette.mode == RECORD else None
+        return self.cassette.call(
+            service,
+            method,
+            func,
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            **kwargs,
+        )
+
+
+class CassetteSpotify:
+    """Stands in for a spotipy.Spotify client, sending every API method call through a cassette.
+
+    When recording the real client is only created on first use, so replaying never needs Spotify credentials.
+    """
+
+    def __init__(self, cassette: Cassette, client_factory: Callable = _cli_spotify):
+        self.cassette = cassette
+        self.client_factory = client_factory
+
+    def __getattr__(self, name: str) -> Callable:
+        def call(*args, **kwargs):
+            func = getattr(self.client_factory(), name) if self.cassette.mode == RECORD else None
+            return self.cassette.call("spotify", name, func, *args, **kwargs)
+
+        return call
@@ -0,0 +1,188 @@
+"""DJ GPT CLI
+
+Module for a local index of every track we've resolved in Spotify, so most searches never hit the network
+"""
+
+import json
+import re
+import sqlite3
+import threading
+import unicodedata
+from contextlib import contextmanager
+from functools import cache
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from djgpt.utils import cache_path, debug
+
+# Bits GPT and Spotify disagree on, e.g. "Song (feat. Someone)", "Song - 2011 Remaster", "Artist ft. Someone".
+# Not "(with ...)", which is as often part of the title, e.g. "Stay (With Me)"
+FEATURING = re.compile(
+    r"[\(\[]\s*(?:feat|ft|featuring)\b.*?[\)\]]|\s(?:feat|ft|featuring)\b.*$", re.IGNORECASE
+)
+VERSION = re.compile(
+    r"\s-\s.*\b(?:remaster(?:ed)?|version|edit|mix|live|mono|stereo)\b.*$"
+    r"|[\(\[][^\)\]]*\b(?:remaster(?:ed)?|version|edit|live|mono|stereo)\b[^\)\]]*[\)\]]",
+    re.IGNORECASE,
+)
+NON_WORD = re.compile(r"[^\w]+")
+NUMBER = re.compile(r"\d+")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    uri TEXT NOT NULL UNIQUE,
+    url TEXT NOT NULL,
+    item TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS names (
+    id INTEGER PRIMARY KEY,
+    artist TEXT NOT NULL,
+    trackname TEXT NOT NULL,
+    track_id INTEGER NOT NULL REFERENCES tracks(id),
+    UNIQUE (artist, trackname)
+);
+CREATE TABLE IF NOT EXISTS trigrams (
+    trigram TEXT NOT NULL,
+    name_id INTEGER NOT NULL REFERENCES names(id),
+    PRIMARY KEY (trigram, name_id)
+) WITHOUT ROWID;
+"""
+
+
+def normalize(name: str) -> str:
+    """Normalise an artist or track name so trivial differences in spelling don't matter."""
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join(c for c in name if not unicodedata.combining(c)).lower()
+    name = VERSION.sub("", FEATURING.sub("", name))
+    name = name.replace("&", " and ")
+    return " ".join(NON_WORD.sub(" ", name).split())
+
+
+def strip_extras(name: str) -> str:
+    """Drop any featured artists and remaster/version suffix from a name, keeping the rest as it was."""
+    return " ".join(VERSION.sub("", FEATURING.sub("", name)).split())
+
+
+def trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(a: str, b: str) -> float:
+    """Dice coefficient of the trigrams in two normalised strings."""
+    if a == b:
+        return 1.0
+    ta, tb = trigrams(a), trigrams(b)
+    return 2 * len(ta & tb) / (len(ta) + len(tb))
+
+
+class Catalog:
+    """A SQLite backed index of resolved tracks with fuzzy trigram lookup.
+
+    Every name a track has been known by (GPT's spelling and Spotify's own) maps to the same Spotify track.
+    """
+
+    def __init__(self, path: str = ":memory:", threshold: float = 0.75, candidates: int = 20):
+        self.threshold = threshold
+        self.candidates = candidates
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+    def add(self, artist: str, trackname: str, item: Dict):
+        """Index a Spotify track item under the name we searched for and the name Spotify knows it by."""
+        names = {(normalize(artist), normalize(trackname))}
+        if item.get("name") and item.get("artists"):
+            names.add((normalize(item["artists"][0]["name"]), normalize(item["name"])))
+
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO tracks (uri, url, item) VALUES (?, ?, ?) "
+                "ON CONFLICT (uri) DO UPDATE SET url = excluded.url, item = excluded.item",
+                (item["uri"], item["external_urls"]["spotify"], json.dumps(item)),
+            )
+            (track_id,) = self.db.execute(
+                "SELECT id FROM tracks WHERE uri = ?", (item["uri"],)
+            ).fetchone()
+            for norm_artist, norm_track in names:
+                cursor = self.db.execute(
+                    "INSERT OR IGNORE INTO names (artist, trackname, track_id) VALUES (?, ?, ?)",
+                    (norm_artist, norm_track, track_id),
+                )
+                if cursor.rowcount:
+                    self.db.executemany(
+                        "INSERT OR IGNORE INTO trigrams (trigram, name_id) VALUES (?, ?)",
+                        [(t, cursor.lastrowid) for t in trigrams(f"{norm_artist} {norm_track}")],
+                    )
+
+    def lookup(self, artist: str, trackname: str) -> Optional[Tuple[str, str, Dict]]:
+        """Find the closest indexed track, returning its url, uri and Spotify item."""
+        norm_artist, norm_track = normalize(artist), normalize(trackname)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT t.url, t.uri, t.item FROM names n JOIN tracks t ON t.id = n.track_id "
+                "WHERE n.artist = ? AND n.trackname = ?",
+                (norm_artist, norm_track),
+            ).fetchone()
+            if row is None:
+                row = self._fuzzy(norm_artist, norm_track)
+        if row is None:
+            return None
+        url, uri, item = row
+        return url, uri, json.loads(item)
+
+    def _fuzzy(self, norm_artist: str, norm_track: str) -> Optional[Tuple[str, str, str]]:
+        grams: List[str] = sorted(trigrams(f"{norm_artist} {norm_track}"))
+        candidates = self.db.execute(
+            f"SELECT n.artist, n.trackname, t.url, t.uri, t.item FROM ("
+            f"  SELECT name_id, COUNT(*) AS shared FROM trigrams"
+            f"  WHERE trigram IN ({','.join('?' * len(grams))})"
+            f"  GROUP BY name_id ORDER BY shared DESC LIMIT ?"
+            f") c JOIN names n ON n.id = c.name_id JOIN tracks t ON t.id = n.track_id",
+            (*grams, self.candidates),
+        ).fetchall()
+
+        numbers = NUMBER.findall(f"{norm_artist} {norm_track}")
+        best, best_score = None, self.threshold
+        for cand_artist, cand_track, url, uri, item in candidates:
+            # Symphony No. 5 is only a character away from No. 9, but is a different track altogether
+            if NUMBER.findall(f"{cand_artist} {cand_track}") != numbers:
+                continue
+            # Both the artist and the track have to be close, not just the overall string
+            score = min(similarity(norm_artist, cand_artist), similarity(norm_track, cand_track))
+            if score >= best_score:
+                best, best_score = (url, uri, item), score
+        if best:
+            debug(
+                "Catalog fuzzy match for %s - %s scored %.2f", norm_artist, norm_track, best_score
+            )
+        return best
+
+
+# Catalog to use instead of the persisted one, see use_catalog
+_CATALOG: Optional[Catalog] = None
+
+
+def get_catalog() -> Catalog:
+    """Get the local catalog, persisted in the DJGPT cache directory unless overridden with use_catalog."""
+    return _CATALOG if _CATALOG is not None else _persisted_catalog()
+
+
+@cache
+def _persisted_catalog() -> Catalog:
+    return Catalog(str(cache_path("catalog.sqlite")))
+
+
+@contextmanager
+def use_catalog(catalog: Catalog) -> Iterator[Catalog]:
+    """Use a different catalog within the block, e.g. an empty one for reproducible runs."""
+    global _CATALOG
+    previous, _CATALOG = _CATALOG, catalog
+    try:
+        yield catalog
+    finally:
+        _CATALOG = previous
@@ -4,10 +4,12 @@
 Handle setting up a CLI and running the interactive DJ session
 """
 
+import atexit
 import time
 from os import getenv
+from pathlib import Path
 from sys import exit
-from typing import List
+from typing import Dict, List, Optional
 
 import openai
 import typer
@@ -16,40 +18,185 @@ from typer import Option
 from typing_extensions import Annotated
 
 from djgpt import spotify
-from djgpt.prompt import IntGPTPromptSystem, SelfTestJSONGPTPromptSystem
+from djgpt.backends import LlamaCppBackend
+from djgpt.cassette import RECORD, REPLAY, Cassette
+from djgpt.catalog import normalize
+from djgpt.history import RECOMMENDED, SELECTED, History, get_history
+from djgpt.playqueue import PlayQueue
+from djgpt.prompt import (
+    GPTHallucinationError,
+    IntGPTPromptSystem,
+    SelfTestStructuredGPTPromptSystem,
+)
+from djgpt.semantic import SemanticCache
+from djgpt.session import Session
+from djgpt.snapshot import load_snapshot, save_snapshot
 
 # Use the cross-platform speech module that works on all operating systems
-from djgpt.speech import listen, say
-from djgpt.spotify import Track, play_on_spotify, wait_for_spotify
-from djgpt.utils import CONSOLE
+from djgpt.speech import TYPE_AHEAD, Interrupted, interruptible, listen, say, use_voice
+from djgpt.spotify import (
+    Track,
+    get_spotify,
+    play_on_spotify,
+    resolve_tracks,
+    wait_for_spotify,
+)
+from djgpt.utils import CONSOLE, DeadlineExceeded, deadline, dump_recent
 
 load_dotenv(find_dotenv(usecwd=True))
 
 app = typer.Typer()
 
 
-class DJGPTPromptSystem(SelfTestJSONGPTPromptSystem):
-    prompt_part = """You are DJGPT4 a master of music knowledge and recommendation engine, return all responses as an 
-    array of {num_tracks} music track recommendation objects with fields: 'artist', 'trackname', 'genre', 'reason' and 
-    'quality'. Where reason should be a concise reason why you think this track is relevant. Where quality is how well 
-    you think the track fits the user request ranging between 0 and 1 in increments of 0.1."""
+class DJGPTPromptSystem(SelfTestStructuredGPTPromptSystem):
+    fallback_model = "gpt-3.5-turbo"
 
-    def ask(self, user_prompt: str) -> List[Track]:
+    prompt_part = """You are DJGPT4 a master of music knowledge and recommendation engine, recommend {num_tracks} music 
+    tracks for every user request."""
+
+    function_name = "recommend_tracks"
+    function_description = "Recommend music tracks for the user request"
+    schema = {
+        "type": "object",
+        "properties": {
+            "tracks": {
+                "type": "array",
+                "minItems": 1,
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "artist": {"type": "string"},
+                        "trackname": {"type": "string"},
+                        "genre": {"type": "string"},
+                        "reason": {
+                            "type": "string",
+                            "description": "Concise reason why the track is relevant",
+                        },
+                        "quality": {
+                            "type": "number",
+                            "minimum": 0,
+                            "maximum": 1,
+                            "description": "How well the track fits the request, in increments of 0.1",
+                        },
+                    },
+                    "required": ["artist", "trackname"],
+                },
+            }
+        },
+        "required": ["tracks"],
+    }
+
+    # Drop tracks from the listening history before searching for them, optionally telling GPT about them too
+    history: Optional[History] = None
+    exclude_recent = 0
+    # Share a SemanticCache to reuse the tracks for requests worded differently but meaning the same thing
+    semantic_cache: Optional[SemanticCache] = None
+
+    def cached_tracks(self, user_prompt: str, context: Optional[str] = None) -> List[Dict]:
+        """The track objects from similar enough requests in the semantic cache.
+
+        Only requests asked without any context are cached, as a refinement like "something faster" means nothing
+        without the session it was asked in.
         """
-        We are getting JSON via SelfTestJSONGPTPromptSystem, but we really want Spotify Track objects.
+        if self.semantic_cache is None or context is not None:
+            return []
+        return (
+            self.semantic_cache.lookup(
+                user_prompt,
+                limit=self.num_tracks,
+                key=lambda t: (normalize(t["artist"]), normalize(t["trackname"])),
+            )
+            or []
+        )
+
+    def ask_tracks(self, user_prompt: str, context: Optional[str] = None) -> List[Dict]:
+        """The track objects GPT recommends."""
+        tracks = super().ask(user_prompt, context=context)["tracks"]
+        if self.semantic_cache is not None and context is None:
+            self.semantic_cache.put(user_prompt, tracks)
+        return tracks
+
+    def to_tracks(self, tracks: List[Dict]) -> List[Track]:
+        fields = self.schema["properties"]["tracks"]["items"]["properties"]
+        return [Track(**{k: v for k, v in track.items() if k in fields}) for track in tracks]
+
+    def ask_many(self, user_prompts: List[str]) -> List[List[Track]]:
+        """The tracks for each of several independent requests, packed into as few GPT calls as possible.
+
+        Meant for generating in bulk, so there's no session and nothing shown, a request that failed gets no tracks.
         """
-        djgpt_json = super().ask(user_prompt)
+        results = []
+        for response in self.ask_packed(user_prompts):
+            tracks = self.to_tracks(response["tracks"]) if response is not None else []
+            if self.history is not None:
+                tracks = self.history.filter(tracks)
+            results.append(tracks)
+        return results
 
-        try:
-            tracks = [Track(**track) for track in djgpt_json]
-        except Exception:
-            CONSOLE.log(
-                f"GPT failed to find any tracks, or we failed to understand GPT. {djgpt_json}"
-            )
-            tracks = []
+    def ask(self, user_prompt: str, session: Optional[Session] = None) -> List[Track]:
+        """
+        GPT fills in the track schema via function calling, which we turn straight into Spotify Track objects.
+
+        Given a session the request is asked in the context of what came before, and tracks we already found in
+        Spotify are reused rather than searched for again.
+        """
+        context = None
+        if session is not None:
+            user_prompt = session.expand(user_prompt)
+            context = session.context()
+        if self.history is not None and self.exclude_recent:
+            exclusions = self.history.exclusions(self.exclude_recent)
+            context = "\n".join(c for c in (context, exclusions) if c) or None
+
+        # Cached tracks are no good if we heard most of them already, so GPT is asked for more
+        tracks = self.fresh(self.to_tracks(self.cached_tracks(user_prompt, context)), session)
+        if len(tracks) < self.num_tracks:
+            try:
+                tracks = self.fresh(self.to_tracks(self.ask_tracks(user_prompt, context)), session)
+            except GPTHallucinationError as e:
+                CONSOLE.log(
+                    f"GPT failed to find any tracks, or we failed to understand GPT. {e.output}"
+                )
 
+        if session is not None:
+            session.reuse(tracks)
         return tracks
 
+    def fresh(self, tracks: List[Track], session: Optional[Session] = None) -> List[Track]:
+        """Drop tracks played recently, apart from any this session already found as they may well be asked for again."""
+        if self.history is None:
+            return tracks
+        return self.history.filter(
+            tracks, keep=session.has_resolved if session is not None else None
+        )
+
+
+def recommend(
+    djgpt: DJGPTPromptSystem, request: str, session: Session, num_tracks: int
+) -> List[Track]:
+    """Ask GPT for tracks, then present the best playable ones as soon as each is found in Spotify.
+
+    Raises Interrupted if the user asks for something else while GPT is thinking, or hits Ctrl-C at any point.
+    """
+    candidates = interruptible(djgpt.ask, request, session=session)
+    if len(candidates) == 0:
+        return []
+
+    say("GPT recommended the following tracks found in Spotify:")
+    # GPT's surplus is only searched for if needed
+    tracks = []
+    try:
+        for track in resolve_tracks(candidates, num_tracks):
+            tracks.append(track)
+            say(f"{len(tracks)}. {track.trackname} by {track.artist}")
+            CONSOLE.print(f"\t{track.genre}; {track.reason}")
+            CONSOLE.print(f"\t{track.spotify.url}")
+    except KeyboardInterrupt as e:
+        # Anything typed while tracks are listed is the answer to which to play, so only Ctrl-C stops here, which
+        # also cancels any searches still pending
+        raise Interrupted() from e
+    return tracks
+
 
 @app.command()
 def djgpt(
@@ -63,18 +210,119 @@ def djgpt(
         "OPENAI_API_KEY"
     ),
     num_tracks: int = 5,
+    surplus: Annotated[
+        int, Option(help="Extra tracks to ask GPT for, in case some can't be found in Spotify")
+    ] = 2,
+    hedge_after: Annotated[
+        Optional[float],
+        Option(help="Seconds to wait on GPT-4 before also asking the faster fallback model"),
+    ] = None,
+    exclude_recent: Annotated[
+        int, Option(help="Tell GPT about this many recently heard tracks to avoid repeats")
+    ] = 0,
+    turn_budget: Annotated[
+        float, Option(help="Seconds a request gets to find tracks, or to start playing them")
+    ] = 30.0,
+    semantic_cache: Annotated[
+        float,
+        Option(
+            help="Reuse tracks for requests at least this similar to an earlier one, 0 for never"
+        ),
+    ] = 0.75,
+    resume: Annotated[
+        bool, Option(help="Snapshot the session after every turn and pick it up again at startup")
+    ] = True,
+    device: Annotated[
+        Optional[str],
+        Option(help="Name or id of the Spotify device to play on, remembered for next time"),
+    ] = None,
+    local_model: Annotated[
+        Optional[Path],
+        Option(help="GGUF model file to understand which tracks to play with locally, on the CPU"),
+    ] = None,
+    local_recommend: Annotated[
+        bool, Option(help="Ask the --local-model for recommendations too, instead of GPT-4")
+    ] = False,
+    voice: Annotated[
+        bool,
+        Option(help="Listen on the microphone, with the best Whisper model this machine can run"),
+    ] = False,
+    stt_target_rtf: Annotated[
+        float,
+        Option(help="Seconds Whisper may take per second of speech, when picking the model"),
+    ] = 0.5,
+    stt_clip: Annotated[
+        Optional[Path],
+        Option(help="Audio clip to time the Whisper models on, instead of a made up one"),
+    ] = None,
+    recalibrate_stt: Annotated[
+        bool, Option(help="Time the Whisper models again rather than using the cached choice")
+    ] = False,
+    continuous: Annotated[
+        bool, Option(help="Queue selections up behind what's playing instead of replacing it")
+    ] = False,
+    record: Annotated[
+        Optional[Path], Option(help="Record all OpenAI and Spotify traffic to a cassette file")
+    ] = None,
+    replay: Annotated[
+        Optional[Path], Option(help="Replay OpenAI and Spotify traffic from a cassette file")
+    ] = None,
+    replay_latency_scale: Annotated[
+        float, Option(help="Scale the recorded latencies when replaying, 0 for none")
+    ] = 1.0,
 ):
     spotify.S_CLIENT_ID = spotify_client_id
     spotify.S_SECRET_ID = spotify_client_secret
     openai.api_key = openai_api_key
 
-    djgpt = DJGPTPromptSystem(num_tracks=num_tracks)
+    if record or replay:
+        cassette = Cassette(
+            record or replay, mode=RECORD if record else REPLAY, latency_scale=replay_latency_scale
+        ).install()
+        atexit.register(cassette.uninstall)
+
+    djgpt = DJGPTPromptSystem(num_tracks=num_tracks + surplus)
+    djgpt.hedge_after = hedge_after
+    djgpt.history = get_history()
+    djgpt.exclude_recent = exclude_recent
+    if semantic_cache:
+        djgpt.semantic_cache = SemanticCache(threshold=semantic_cache)
+    if voice:
+        use_voice(stt_target_rtf, clip=stt_clip, recalibrate=recalibrate_stt)
     intgpt = IntGPTPromptSystem()
+    if local_model is not None:
+        intgpt.backend = LlamaCppBackend(local_model)
+        if local_recommend:
+            djgpt.backend = intgpt.backend
+    session = Session()
+    # Replaying a cassette has to start from the same place as the recording
+    resume = resume and not (record or replay)
+    snapshot = load_snapshot() if resume else None
+    if snapshot is not None:
+        session = snapshot.restore()
+        CONSOLE.log(f"[bold green]Resumed session with {len(session.turns)} earlier requests")
+    if device is not None:
+        selected_device = spotify.select_device(device)
+        if selected_device is not None:
+            CONSOLE.log(f"[bold green]Playing on {selected_device['name']}")
+
+    # In continuous mode selections go on a play queue fed to Spotify in the background, so we never wait
+    play_queue = PlayQueue().start() if continuous else None
+    play = play_queue.extend if play_queue is not None else play_on_spotify
+
+    # Authorize with Spotify first, as a first ever run asks for the redirect URL on stdin, which the type ahead
+    # reader would otherwise swallow. Then type ahead so a new request, or Ctrl-C, can cut short waiting on the last one
+    get_spotify()
+    TYPE_AHEAD.start()
+    next_request = None
 
-    while wait_for_spotify():
+    while play_queue is not None or wait_for_spotify():
         try:
-            say("What kind of thing do you want to listen to?")
-            speech_text = listen()
+            if next_request is None:
+                say("What kind of thing do you want to listen to?")
+                speech_text = listen()
+            else:
+                speech_text, next_request = next_request, None
 
             # Check if speech_text is None (microphone/recognition failed)
             if speech_text is None:
@@ -85,24 +333,32 @@ def djgpt(
                 say("Goodbye!", wait=True)
                 exit()
             say("Asking DJ GPT about: " + speech_text)
+            request_id = djgpt.history.record_request(speech_text)
 
-            recommended_tracks = djgpt.ask(speech_text)
+            # Finding tracks gets a fixed budget, with whatever was found in time shown if we run out
+            try:
+                with deadline(turn_budget):
+                    recommended_tracks = recommend(djgpt, speech_text, session, num_tracks)
+            except Interrupted as e:
+                say("Never mind that then.")
+                next_request = e.request
+                continue
+            except DeadlineExceeded:
+                say("Sorry, GPT took too long. Please try again.")
+                continue
+            session.record(speech_text, recommended_tracks)
+            djgpt.history.record(RECOMMENDED, recommended_tracks, request_id)
+            if resume:
+                save_snapshot(session)
             if len(recommended_tracks) == 0:
                 continue
 
-            say("GPT recommended the following tracks found in Spotify:")
-            for idx, track in enumerate(recommended_tracks):
-                if track.spotify is None:
-                    # If we can't find something in Spotify it's probably GPT4 halucinating its tits off so just ignore
-                    continue
-                say(f"{idx + 1}. {track.trackname} by {track.artist}")
-                CONSOLE.print(f"\t{track.genre}; {track.reason}")
-                CONSOLE.print(f"\t{track.spotify.url}")
-
             say("Which would you like to play?")
             selected = listen()
+            if selected is None:
+                continue
             if "all" in selected.lower():
-                play_on_spotify([t for t in recommended_tracks if t.spotify])
+                chosen = recommended_tracks
             elif "none" in selected.lower():
                 continue
             else:
@@ -113,14 +369,25 @@ def djgpt(
                 selected_track = recommended_tracks[selected - 1]
                 say(f"{selected_track.trackname} was recommended because: {selected_track.reason}")
                 # Use this if the OAuth scope doesn't work webbrowser.open(selected_track["url"])
-                play_on_spotify([selected_track])
+                chosen = [selected_track]
 
-            time.sleep(2)
+            djgpt.history.record(SELECTED, chosen, request_id)
+            try:
+                with deadline(turn_budget):
+                    play(chosen)
+            except DeadlineExceeded:
+                say("Sorry, Spotify took too long to start playing.")
+
+            if play_queue is None:
+                time.sleep(2)
 
         except KeyboardInterrupt as e:
             CONSOLE.log("The Program is terminated manually!")
             # Might need some clean up here given all the crazed binaries we are using in the background
             raise SystemExit from e
+        except Exception:
+            dump_recent()
+            raise
 
 
 def main():
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""DJ GPT CLI
+
+Offline evaluation of prompt systems against their self generated test cases, so prompt changes can be judged on
+speed, yield and cost rather than gut feel
+"""
+
+import atexit
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from os import getenv
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import openai
+import typer
+from rich.table import Table
+from typer import Option
+from typing_extensions import Annotated
+
+from djgpt import spotify
+from djgpt.cassette import RECORD, REPLAY, Cassette
+from djgpt.cli import DJGPTPromptSystem
+from djgpt.prompt import (
+    TIER_WINS,
+    GPTHallucinationError,
+    PromptTestCase,
+    SelfTestStructuredGPTPromptSystem,
+    TestCaseType,
+    track_usage,
+)
+from djgpt.spotify import Spotify, Track, search_spotify
+from djgpt.standins import LocalSpotify
+from djgpt.utils import CONSOLE
+
+app = typer.Typer()
+
+Resolver = Callable[[str, str], Optional[Spotify]]
+
+
+@dataclass
+class CaseResult:
+    """Store how a prompt system got on with a single test case."""
+
+    case: PromptTestCase
+    tracks: List[Track] = field(default_factory=list)
+    resolved: int = 0
+    gpt_latency: float = 0.0
+    resolve_latency: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    error: Optional[str] = None
+
+    @property
+    def latency(self) -> float:
+        return self.gpt_latency + self.resolve_latency
+
+    @property
+    def hit_rate(self) -> float:
+        return self.resolved / len(self.tracks) if self.tracks else 0.0
+
+
+def load_test_cases(
+    path: Path, prompt_system: SelfTestStructuredGPTPromptSystem, regenerate: bool = False
+) -> List[PromptTestCase]:
+    """Load cached test cases, or get GPT to generate some and cache them for next time.
+
+    Nothing is cached if generation fails, so the next run tries again.
+    """
+    if path.exists() and not regenerate:
+        with path.open() as f:
+            return [
+                PromptTestCase(prompt=c["prompt"], output=c["output"], case=TestCaseType(c["case"]))
+                for c in json.load(f)
+            ]
+
+    try:
+        cases = prompt_system.test_cases()
+    except GPTHallucinationError as e:
+        CONSOLE.log(f"[bold red]No test cases generated, GPT's answer didn't make sense: {e}")
+        return []
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w") as f:
+        json.dump([c._asdict() for c in cases], f, indent=2)
+    return cases
+
+
+def run_case(
+    prompt_system: SelfTestStructuredGPTPromptSystem, resolver: Resolver, case: PromptTestCase
+) -> CaseResult:
+    """Ask the prompt system for a single test case and resolve whatever tracks come back."""
+    result = CaseResult(case=case)
+    with track_usage() as usage:
+        start = time.perf_counter()
+        try:
+            result.tracks = prompt_system.ask(case.prompt) or []
+        except Exception as e:
+            result.error = str(e)
+        result.gpt_latency = time.perf_counter() - start
+    result.prompt_tokens = usage["prompt_tokens"]
+    result.completion_tokens = usage["completion_tokens"]
+    return resolve_case(result, resolver)
+
+
+def run_pack(
+    prompt_system: SelfTestStructuredGPTPromptSystem,
+    resolver: Resolver,
+    cases: List[PromptTestCase],
+) -> List[CaseResult]:
+    """Ask the prompt system for several test cases in one packed request, sharing its latency and tokens out."""
+    results = [CaseResult(case=case) for case in cases]
+    with track_usage() as usage:
+        start = time.perf_counter()
+        try:
+            answers = prompt_system.ask_many([case.prompt for case in cases])
+        except Exception as e:
+            answers = [[] for _ in cases]
+            for result in results:
+                result.error = str(e)
+        gpt_latency = time.perf_counter() - start
+
+    for result, tracks in zip(results, answers, strict=True):
+        result.tracks = tracks
+        result.gpt_latency = gpt_latency
+        result.prompt_tokens = usage["prompt_tokens"] // len(cases)
+        result.completion_tokens = usage["completion_tokens"] // len(cases)
+        resolve_case(result, resolver)
+    return results
+
+
+def resolve_case(result: CaseResult, resolver: Resolver) -> CaseResult:
+    start = time.perf_counter()
+    result.resolved = sum(
+        1 for track in result.tracks if resolver(track.artist, track.trackname) is not None
+    )
+    result.resolve_latency = time.perf_counter() - start
+    return result
+
+
+def evaluate(
+    prompt_system: SelfTestStructuredGPTPromptSystem,
+    cases: List[PromptTestCase],
+    resolver: Resolver = search_spotify,
+    workers: int = 4,
+    pack: int = 1,
+) -> List[CaseResult]:
+    """Run all the test cases concurrently through the prompt system, pack at a time in each request."""
+    prompt_system.show_status = False
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        if pack <= 1:
+            return list(pool.map(partial(run_case, prompt_system, resolver), cases))
+        prompt_system.pack_size = pack
+        packs = [cases[n : n + pack] for n in range(0, len(cases), pack)]
+        return [
+            result
+            for results in pool.map(partial(run_pack, prompt_system, resolver), packs)
+            for result in results
+        ]
+
+
+def summarise(
+    results: List[CaseResult], prompt_price: float, completion_price: float
+) -> Dict[str, Dict[str, float]]:
+    """Aggregate results per TestCaseType (and overall), prices are per 1K tokens."""
+    groups = {
+        case_type.value: [r for r in results if r.case.case == case_type]
+        for case_type in TestCaseType
+    }
+    groups["all"] = results
+    summary = {}
+    for name, group in groups.items():
+        if not group:
+            continue
+        latencies = sorted(r.latency for r in group)
+        tracks = sum(len(r.tracks) for r in group)
+        prompt_tokens = sum(r.prompt_tokens for r in group)
+        completion_tokens = sum(r.completion_tokens for r in group)
+        summary[name] = {
+            "cases": len(group),
+            "errors": sum(1 for r in group if r.error),
+            "tracks": tracks,
+            "hit_rate": sum(r.resolved for r in group) / tracks if tracks else 0.0,
+            "latency_mean": statistics.fmean(latencies),
+            "latency_p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cost": (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000,
+        }
+    return summary
+
+
+def report(summary: Dict[str, Dict[str, float]]):
+    table = Table(title="DJGPT prompt evaluation")
+    for column in (
+        "Case",
+        "Cases",
+        "Errors",
+        "Tracks",
+        "Hit rate",
+        "Mean (s)",
+        "p95 (s)",
+        "Tokens",
+        "Cost ($)",
+    ):
+        table.add_column(column, justify="left" if column == "Case" else "right")
+    for name, row in summary.items():
+        table.add_row(
+            name,
+            str(row["cases"]),
+            str(row["errors"]),
+            str(row["tracks"]),
+            f"{row['hit_rate']:.0%}",
+            f"{row['latency_mean']:.2f}",
+            f"{row['latency_p95']:.2f}",
+            str(row["prompt_tokens"] + row["completion_tokens"]),
+            f"{row['cost']:.4f}",
+        )
+    CONSOLE.print(table)
+
+
+@app.command()
+def main(
+    openai_api_key: Annotated[str, Option(prompt=True, envvar="OPENAI_API_KEY")] = getenv(
+        "OPENAI_API_KEY"
+    ),
+    spotify_client_id: Annotated[Optional[str], Option(envvar="SPOTIPY_CLIENT_ID")] = None,
+    spotify_client_secret: Annotated[Optional[str], Option(envvar="SPOTIPY_CLIENT_SECRET")] = None,
+    cases_file: Path = Path("evaluation/test_cases.json"),
+    regenerate: bool = False,
+    offline: Annotated[
+        bool, Option(help="Resolve tracks against a local catalog built from the test cases")
+    ] = False,
+    num_tracks: int = 5,
+    workers: int = 4,
+    pack: Annotated[
+        int, Option(help="Test cases to pack into each GPT request, sharing the system prompt")
+    ] = 1,
+    hedge_after: Annotated[
+        Optional[float], Option(help="Seconds before hedging with the fallback model")
+    ] = None,
+    prompt_price: Annotated[float, Option(help="$ per 1K prompt tokens")] = 0.03,
+    completion_price: Annotated[float, Option(help="$ per 1K completion tokens")] = 0.06,
+    record: Annotated[Optional[Path], Option(help="Record all API traffic to a cassette")] = None,
+    replay: Annotated[Optional[Path], Option(help="Replay API traffic from a cassette")] = None,
+    replay_latency_scale: float = 1.0,
+    output: Annotated[
+        Optional[Path], Option(help="Write the summary as JSON for comparison")
+    ] = None,
+):
+    openai.api_key = openai_api_key
+    spotify.S_CLIENT_ID = spotify_client_id
+    spotify.S_SECRET_ID = spotify_client_secret
+
+    if record or replay:
+        cassette = Cassette(
+            record or replay, mode=RECORD if record else REPLAY, latency_scale=replay_latency_scale
+        ).install()
+        atexit.register(cassette.uninstall)
+
+    djgpt = DJGPTPromptSystem(num_tracks=num_tracks)
+    djgpt.hedge_after = hedge_after
+    cases = load_test_cases(cases_file, djgpt, regenerate=regenerate)
+    if not cases:
+        CONSOLE.log("[bold red]No test cases to evaluate.")
+        raise typer.Exit(1)
+
+    resolver = search_spotify
+    if offline:
+        resolver = partial(search_spotify, client=LocalSpotify.from_test_cases(cases))
+
+    start = time.perf_counter()
+    results = evaluate(djgpt, cases, resolver=resolver, workers=workers, pack=pack)
+    CONSOLE.log(f"Evaluated {len(results)} cases in {time.perf_counter() - start:.2f}s")
+
+    summary = summarise(results, prompt_price, completion_price)
+    report(summary)
+    if TIER_WINS:
+        CONSOLE.print(f"Hedged request wins by model: {dict(TIER_WINS)}")
+    if output:
+        output.write_text(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    app()
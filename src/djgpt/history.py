@@ -0,0 +1,167 @@
+"""DJ GPT CLI
+
+Module to keep a persistent listening history, so tracks played recently aren't offered again
+"""
+
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import cache
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, List, Optional, Sequence
+
+from djgpt.catalog import normalize
+from djgpt.utils import cache_path, debug
+
+if TYPE_CHECKING:
+    from djgpt.spotify import Track
+
+RECOMMENDED = "recommended"
+SELECTED = "selected"
+PLAYED = "played"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    id INTEGER PRIMARY KEY,
+    at REAL NOT NULL,
+    request TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    at REAL NOT NULL,
+    kind TEXT NOT NULL,
+    request_id INTEGER REFERENCES requests(id),
+    artist TEXT NOT NULL,
+    trackname TEXT NOT NULL,
+    uri TEXT
+);
+CREATE INDEX IF NOT EXISTS events_track ON events (artist, trackname, at);
+CREATE INDEX IF NOT EXISTS events_at ON events (at);
+"""
+
+
+class History:
+    """A SQLite backed log of requests and the tracks recommended, selected and played for them.
+
+    Tracks are stored under their normalised names, the same as the catalog, so GPT's spelling variations still count
+    as repeats.
+    """
+
+    def __init__(
+        self,
+        path: str = ":memory:",
+        window: float = 24 * 3600,
+        repeat_kinds: Sequence[str] = (PLAYED,),
+    ):
+        self.window = window
+        self.repeat_kinds = tuple(repeat_kinds)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    def record_request(self, request: str) -> int:
+        with self.lock, self.db:
+            return self.db.execute(
+                "INSERT INTO requests (at, request) VALUES (?, ?)", (time.time(), request)
+            ).lastrowid
+
+    def record(self, kind: str, tracks: Iterable["Track"], request_id: Optional[int] = None):
+        now = time.time()
+        rows = [
+            (
+                now,
+                kind,
+                request_id,
+                normalize(t.artist),
+                normalize(t.trackname),
+                t.spotify.uri if t.resolved and t.spotify else None,
+            )
+            for t in tracks
+        ]
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO events (at, kind, request_id, artist, trackname, uri) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def _kinds(self) -> str:
+        return ",".join("?" * len(self.repeat_kinds))
+
+    def is_repeat(self, track: "Track") -> bool:
+        """Whether a track was played, or whichever repeat_kinds, within the window."""
+        with self.lock:
+            return (
+                self.db.execute(
+                    f"SELECT 1 FROM events WHERE artist = ? AND trackname = ? AND at >= ? "
+                    f"AND kind IN ({self._kinds()}) LIMIT 1",
+                    (
+                        normalize(track.artist),
+                        normalize(track.trackname),
+                        time.time() - self.window,
+                        *self.repeat_kinds,
+                    ),
+                ).fetchone()
+                is not None
+            )
+
+    def filter(
+        self, tracks: List["Track"], keep: Optional[Callable[["Track"], bool]] = None
+    ) -> List["Track"]:
+        """Drop recent repeats, before we spend any Spotify searches on them, apart from any we're told to keep."""
+        fresh = [t for t in tracks if (keep is not None and keep(t)) or not self.is_repeat(t)]
+        if len(fresh) < len(tracks):
+            debug("Dropped %d recently heard tracks", len(tracks) - len(fresh))
+        return fresh
+
+    def exclusions(self, limit: int = 20) -> Optional[str]:
+        """A compact list of the most recent repeats, for asking GPT not to bother with them."""
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT artist, trackname FROM events WHERE at >= ? AND kind IN ({self._kinds()}) "
+                f"GROUP BY artist, trackname ORDER BY MAX(at) DESC LIMIT ?",
+                (time.time() - self.window, *self.repeat_kinds, limit),
+            ).fetchall()
+        if not rows:
+            return None
+        return "Don't recommend these, the user heard them recently: " + "; ".join(
+            f"{trackname} by {artist}" for artist, trackname in rows
+        )
+
+    def prune(self, keep: float = 90 * 24 * 3600):
+        """Forget anything older than keep seconds, so the history doesn't grow forever."""
+        cutoff = time.time() - keep
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM events WHERE at < ?", (cutoff,))
+            self.db.execute("DELETE FROM requests WHERE at < ?", (cutoff,))
+
+
+# History to use instead of the persisted one, see use_history
+_HISTORY: Optional[History] = None
+
+
+def get_history() -> History:
+    """Get the listening history, persisted in the DJGPT cache directory unless overridden with use_history."""
+    return _HISTORY if _HISTORY is not None else _persisted_history()
+
+
+@cache
+def _persisted_history() -> History:
+    history = History(str(cache_path("history.sqlite")))
+    history.prune()
+    return history
+
+
+@contextmanager
+def use_history(history: History) -> Iterator[History]:
+    """Use a different history within the block, e.g. an empty one for reproducible runs."""
+    global _HISTORY
+    previous, _HISTORY = _HISTORY, history
+    try:
+        yield history
+    finally:
+        _HISTORY = previous
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""DJ GPT CLI
+
+Load test the DJGPT server against local stand-ins for GPT and Spotify, to see how many sessions a core can handle
+"""
+
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from typing import Dict, List, Optional
+
+import typer
+from typer import Option
+from typing_extensions import Annotated
+
+from djgpt.cli import DJGPTPromptSystem
+from djgpt.prompt import GPTPromptSystem
+from djgpt.server import DJGPTServer, share_caches
+from djgpt.standins import LocalGPT, LocalSpotify, synthetic_tracks
+from djgpt.utils import CONSOLE
+
+app = typer.Typer()
+
+
+def call(conn: HTTPConnection, method: str, path: str, body: Optional[Dict] = None) -> Dict:
+    conn.request(
+        method, path, body=json.dumps(body or {}), headers={"Content-Type": "application/json"}
+    )
+    response = conn.getresponse()
+    payload = response.read()
+    if response.status >= 400:
+        raise RuntimeError(f"{method} {path} failed with {response.status}: {payload!r}")
+    return json.loads(payload) if payload else {}
+
+
+def request_for(n: int) -> str:
+    return f"music for situation {n}"
+
+
+def warm_up(port: int, requests: int):
+    """Ask the first few distinct requests as fresh sessions, as if earlier users had, so the shared caches have them.
+
+    The semantic cache only serves the first request of a session, so without this it hardly gets a look in when every
+    user starts at once.
+    """
+    conn = HTTPConnection("127.0.0.1", port)
+    for n in range(requests):
+        session_id = call(conn, "POST", "/sessions", {"access_token": "warm-up"})["session"]
+        call(conn, "POST", f"/sessions/{session_id}/ask", {"request": request_for(n)})
+        call(conn, "DELETE", f"/sessions/{session_id}")
+    conn.close()
+
+
+def run_user(port: int, user: int, turns: int, distinct_requests: int) -> List[float]:
+    """Simulate one user making requests and playing what comes back, returning each turn's latency."""
+    conn = HTTPConnection("127.0.0.1", port)
+    session_id = call(conn, "POST", "/sessions", {"access_token": f"user-{user}"})["session"]
+    latencies = []
+    for turn in range(turns):
+        start = time.perf_counter()
+        # Users ask for overlapping things, so shared caches get a chance to help
+        request = request_for((user * 7 + turn) % distinct_requests)
+        tracks = call(conn, "POST", f"/sessions/{session_id}/ask", {"request": request})["tracks"]
+        if tracks:
+            call(conn, "POST", f"/sessions/{session_id}/play", {"tracks": [1]})
+        latencies.append(time.perf_counter() - start)
+    call(conn, "DELETE", f"/sessions/{session_id}")
+    conn.close()
+    return latencies
+
+
+def load_test(
+    users: int = 50,
+    turns: int = 20,
+    catalog_size: int = 1000,
+    distinct_requests: int = 200,
+    gpt_latency: float = 0.0,
+    spotify_latency: float = 0.0,
+    warm: int = 0,
+) -> Dict[str, float]:
+    """Run the server in process against stand-ins and hammer it with concurrent users, after warming it up."""
+    tracks = synthetic_tracks(catalog_size)
+    gpt = LocalGPT(tracks, latency=gpt_latency)
+    share_caches()
+    server = DJGPTServer(
+        ("127.0.0.1", 0),
+        client_factory=lambda credentials: LocalSpotify(tracks, latency=spotify_latency),
+        chat_completion=gpt.create,
+        max_sessions=users,
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        warm_up(server.server_port, min(warm, distinct_requests))
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        with ThreadPoolExecutor(max_workers=users) as pool:
+            results = list(
+                pool.map(
+                    lambda user: run_user(server.server_port, user, turns, distinct_requests),
+                    range(users),
+                )
+            )
+    finally:
+        server.shutdown()
+        server.server_close()
+    wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+
+    latencies = sorted(latency for user in results for latency in user)
+    return {
+        "turns": len(latencies),
+        "wall_seconds": wall,
+        "cpu_seconds": cpu,
+        "turns_per_second": len(latencies) / wall,
+        "cpu_ms_per_turn": 1000 * cpu / len(latencies),
+        "latency_p50_ms": 1000 * statistics.median(latencies),
+        "latency_p95_ms": 1000 * latencies[int(len(latencies) * 0.95) - 1],
+        "response_cache_hit_rate": GPTPromptSystem.response_cache.hit_rate,
+        "semantic_cache_hit_rate": DJGPTPromptSystem.semantic_cache.hit_rate,
+    }
+
+
+@app.command()
+def main(
+    users: int = 50,
+    turns: int = 20,
+    catalog_size: int = 1000,
+    distinct_requests: int = 200,
+    gpt_latency: Annotated[float, Option(help="Seconds each stand-in GPT call takes")] = 0.0,
+    spotify_latency: Annotated[
+        float, Option(help="Seconds each stand-in Spotify call takes")
+    ] = 0.0,
+    think_time: Annotated[float, Option(help="Seconds a real user takes between turns")] = 30.0,
+    warm: Annotated[
+        int,
+        Option(help="Distinct requests to ask before the load starts, warming the shared caches"),
+    ] = 0,
+):
+    # Stand-in tracks must never end up in the real local catalog
+    os.environ["DJGPT_CACHE_DIR"] = tempfile.mkdtemp(prefix="djgpt-loadtest-")
+
+    stats = load_test(
+        users, turns, catalog_size, distinct_requests, gpt_latency, spotify_latency, warm
+    )
+    for name, value in stats.items():
+        CONSOLE.print(f"{name:>20}: {value:.2f}")
+    # A core is busy for cpu_ms_per_turn each time a user takes a turn every think_time seconds
+    CONSOLE.print(f"{'sessions_per_core':>20}: {think_time * 1000 / stats['cpu_ms_per_turn']:.0f}")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,189 @@
+"""DJ GPT CLI
+
+Module for continuous DJ mode, keeping Spotify's queue topped up from a local play queue in the background
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, List, NamedTuple, Optional, Set
+
+import requests
+import spotipy
+from spotipy import SpotifyException
+
+from djgpt.history import PLAYED, get_history
+from djgpt.spotify import Track, get_spotify, queue_on_spotify, start_on_spotify, use_spotify
+from djgpt.utils import CONSOLE, debug
+
+# How long to assume a track lasts when Spotify didn't tell us
+DEFAULT_DURATION = 240.0
+
+
+class Pushed(NamedTuple):
+    """A track we've given to Spotify, and when we expect it to have started playing by."""
+
+    uri: str
+    starts_by: float
+    duration: float
+    track: Track
+
+
+def duration(track: Track) -> float:
+    return (track.spotify.stash.get("duration_ms") or 0) / 1000 or DEFAULT_DURATION
+
+
+class PlayQueue:
+    """A local queue of tracks fed to Spotify a few at a time.
+
+    Rather than replacing whatever is playing, the next tracks are pushed onto Spotify's queue ahead of time so
+    there is no gap between batches. A background thread watches playback and tops the Spotify queue back up as it
+    drains, so nobody has to block waiting for the music to stop.
+
+    Pushed tracks we never see playing, because they were skipped, cleared from Spotify's queue or playback stopped,
+    are given up on stale_after seconds past when they should have started, so the queue can't stall waiting on them.
+    Only the tracks we do see playing go in the listening history as played.
+    """
+
+    def __init__(
+        self,
+        ahead: int = 2,
+        poll_interval: float = 15.0,
+        client: Optional[spotipy.Spotify] = None,
+        stale_after: float = 60.0,
+    ):
+        self.ahead = ahead
+        self.poll_interval = poll_interval
+        self.client = client
+        self.stale_after = stale_after
+        # Tracks waiting locally, and those we've pushed to Spotify that haven't started playing yet
+        self.pending: Deque[Track] = deque()
+        self.pushed: Deque[Pushed] = deque()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self.pending) + len(self.pushed)
+
+    def extend(self, tracks: List[Track]):
+        """Add tracks to the end of the queue, only those actually on Spotify."""
+        with self.lock:
+            self.pending.extend(t for t in tracks if t.spotify)
+        self.wake.set()
+
+    def clear(self):
+        """Forget anything not yet pushed to Spotify."""
+        with self.lock:
+            self.pending.clear()
+
+    def top_up(self) -> float:
+        """Sync with Spotify once, returning how long we can sleep before we next need to look.
+
+        Spotify is only ever called without holding the lock, so adding tracks never waits on the network.
+        """
+        playback = get_spotify().current_playback() or {}
+        now = time.monotonic()
+        item = playback.get("item") or {}
+        remaining = (item.get("duration_ms", 0) - (playback.get("progress_ms") or 0)) / 1000
+
+        start, queue, played = None, [], None
+        with self.lock:
+            if playback.get("is_playing"):
+                # Spotify may have relinked the track to another URI for the market
+                played = self.seen(
+                    {item.get("uri"), (item.get("linked_from") or {}).get("uri")}, now + remaining
+                )
+            self.expire(now)
+            if not playback.get("is_playing"):
+                if not self.pushed and self.pending:
+                    # Nothing is playing and nothing queued, so there's nothing to interrupt,
+                    # it counts as pushed until we see it playing, so we don't start it twice
+                    start = self.pending.popleft()
+                    self.push(start, now)
+            else:
+                while len(self.pushed) < self.ahead and self.pending:
+                    queue.append(self.pending.popleft())
+                    self.push(queue[-1], now + remaining)
+
+        if played is not None:
+            get_history().record(PLAYED, [played])
+        if start is not None:
+            self.send(start_on_spotify, [start])
+            debug("Started playing %s by %s", start.trackname, start.artist)
+            return 1.0
+        if not playback.get("is_playing"):
+            return self.poll_interval
+        for n, track in enumerate(queue):
+            self.send(queue_on_spotify, queue[n:])
+            debug("Queued %s by %s", track.trackname, track.artist)
+
+        # Look again shortly before the current track ends, as that is when the queue drains
+        return max(1.0, min(self.poll_interval, remaining - 2))
+
+    def push(self, track: Track, starts_by: float):
+        """Note a track as given to Spotify, to start after anything already pushed, call holding the lock."""
+        if self.pushed:
+            last = self.pushed[-1]
+            starts_by = max(starts_by, last.starts_by + last.duration)
+        self.pushed.append(Pushed(track.spotify.uri, starts_by, duration(track), track))
+
+    def seen(self, uris: Set[Optional[str]], ends_at: float) -> Optional[Track]:
+        """Move past everything up to the track now playing, returning it if it was ours, call holding the lock."""
+        if not any(p.uri in uris for p in self.pushed):
+            return None
+        playing = self.pushed.popleft()
+        while playing.uri not in uris:
+            playing = self.pushed.popleft()
+        # The rest are due one after the other once the current track ends
+        rest, self.pushed = self.pushed, deque()
+        for pushed in rest:
+            self.pushed.append(pushed._replace(starts_by=ends_at))
+            ends_at += pushed.duration
+        return playing.track
+
+    def expire(self, now: float):
+        """Give up on pushed tracks that should have started a while ago, call holding the lock."""
+        while self.pushed and now > self.pushed[0].starts_by + self.stale_after:
+            debug("Gave up waiting for %s to play", self.pushed.popleft().uri)
+
+    def send(self, call: Callable[[Track], None], tracks: List[Track]):
+        """Send the first of the tracks to Spotify, putting them all back to try again if it fails."""
+        try:
+            call(tracks[0])
+        except (SpotifyException, requests.RequestException):
+            uris = {t.spotify.uri for t in tracks}
+            with self.lock:
+                self.pushed = deque(p for p in self.pushed if p.uri not in uris)
+                self.pending.extendleft(reversed(tracks))
+            raise
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wake.clear()
+            try:
+                if self.client is not None:
+                    with use_spotify(self.client):
+                        wait = self.top_up()
+                else:
+                    wait = self.top_up()
+            except (SpotifyException, requests.RequestException) as e:
+                debug("Failed to top up the Spotify queue: %s", e)
+                wait = self.poll_interval
+            except Exception as e:
+                # Whatever went wrong, continuous playback stopping for good would be worse
+                CONSOLE.log(f"[bold red]Failed to top up the Spotify queue: {e!r}")
+                wait = self.poll_interval
+            self.wake.wait(wait)
+
+    def start(self) -> "PlayQueue":
+        self.thread = threading.Thread(target=self.run, name="djgpt-playqueue", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -5,14 +5,56 @@ Module to deal with prompt management and interacting with OpenAI's API
 
 import abc
 import json
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar, copy_context
 from enum import auto
 from string import Formatter
-from typing import Any, Dict, List, NamedTuple, Optional, Union
+from typing import Any, Callable, Dict, Hashable, Iterator, List, NamedTuple, Optional, Union
 
 import openai
 from strenum import LowercaseStrEnum
 
-from djgpt.utils import CONSOLE, debug, retry
+from djgpt.backends import OPENAI, Backend
+from djgpt.utils import (
+    CONSOLE,
+    DeadlineExceeded,
+    call_timeout,
+    check_cancelled,
+    debug,
+    remaining,
+    retry,
+    trace,
+)
+
+# Token usage counter for whoever is currently interested, see track_usage
+_USAGE: ContextVar[Optional[Counter]] = ContextVar("djgpt_usage", default=None)
+
+# Threads for racing hedged requests, and how often each model won the race
+_HEDGE_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="djgpt-hedge")
+_TIER_LOCK = threading.Lock()
+TIER_WINS: Counter = Counter()
+
+# Tokens each model takes, prompt and completion together, anything else is assumed to take as few as the smallest
+CONTEXT_WINDOWS = {
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+}
+
+
+def context_window(model: str) -> int:
+    return CONTEXT_WINDOWS.get(model, min(CONTEXT_WINDOWS.values()))
+
+
+def estimate_tokens(value: Any) -> int:
+    """A rough count of the tokens some text or JSON takes, erring high as JSON takes more than English."""
+    text = value if isinstance(value, str) else json.dumps(value)
+    return len(text) // 3 + 1
 
 
 class TestCaseType(LowercaseStrEnum):
@@ -22,9 +64,9 @@ class TestCaseType(LowercaseStrEnum):
 
 
 class PromptTestCase(NamedTuple):
-    """Store spotify API data.
+    """Store a generated test case for a prompt system.
 
-    Tuple of what we care about the URI/URLs and stash the rest just incase
+    The user prompt, the output GPT thinks should be produced and how hard the case is
     """
 
     prompt: str
@@ -32,6 +74,58 @@ class PromptTestCase(NamedTuple):
     case: TestCaseType
 
 
+@contextmanager
+def track_usage() -> Iterator[Counter]:
+    """Count the tokens used by every GPT call made within the block.
+
+    Usage is tracked per thread/context so concurrent callers each get their own counts.
+    """
+    counter = Counter()
+    token = _USAGE.set(counter)
+    try:
+        yield counter
+    finally:
+        _USAGE.reset(token)
+
+
+class ResponseCache:
+    """A thread safe LRU cache of GPT responses, shareable between prompt systems and users."""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.responses: "OrderedDict[Hashable, str]" = OrderedDict()
+        self.hits = self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.responses)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, key: Hashable) -> Optional[str]:
+        with self.lock:
+            if key in self.responses:
+                self.hits += 1
+                self.responses.move_to_end(key)
+                return self.responses[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, response: str):
+        with self.lock:
+            self.responses[key] = response
+            self.responses.move_to_end(key)
+            while len(self.responses) > self.maxsize:
+                self.responses.popitem(last=False)
+
+    def discard(self, key: Hashable):
+        with self.lock:
+            self.responses.pop(key, None)
+
+
 class PromptSystemMeta(abc.ABCMeta):
     """Metaclass for the PromptSystem.
     It handles the creation of new PromptSystem classes and ensures
@@ -105,42 +199,188 @@ class GPTHallucinationError(ValueError):
 class GPTPromptSystem(PromptSystem):
     """
     A prompt system that uses the GPT-4 model to generate responses.
+
+    Set a fallback_model and hedge_after to bound tail latency: if the main model hasn't given a valid answer within
+    hedge_after seconds the same request is also sent to the fallback, and whichever valid answer arrives first wins.
+
+    The models are hosted by OpenAI unless a different backend is set, e.g. a LlamaCppBackend to run cheap prompts
+    locally on the CPU.
     """
 
     model = "gpt-4"
+    fallback_model: Optional[str] = None
+    hedge_after: Optional[float] = None
     max_tokens = 1000
     temperature = 0.9
+    # Longest to wait on a single request, cut down further by any deadline
+    request_timeout = 60.0
+    # Rich can only show one status spinner at a time, turn off when asking from many threads
+    show_status = True
+    # Share a ResponseCache to skip asking GPT the exact same thing twice
+    response_cache: Optional[ResponseCache] = None
+    # Where the models run, per prompt system
+    backend: Backend = OPENAI
+    # Swap out the chat completion call whatever the backend, e.g. for a local stand-in
+    chat_completion: Optional[Callable[..., Dict]] = None
+    # Wrap whichever backend each prompt system asks, e.g. to record and replay its traffic with a cassette
+    wrap_backend: Optional[Callable[[Backend], Backend]] = None
+
+    def cache_key(self, user_prompt: str, context: Optional[str] = None) -> Hashable:
+        return (
+            self.backend.name,
+            self.model,
+            self.max_tokens,
+            self.temperature,
+            self.prompt,
+            context,
+            user_prompt,
+        )
+
+    def valid(self, gpt_text: str) -> bool:
+        """Whether a response is usable, so a hedged request knows if it can stop waiting."""
+        return bool(gpt_text)
+
+    def completion_options(self) -> Dict:
+        """Any extra arguments for the chat completion request."""
+        return {}
+
+    def message_text(self, message: Dict) -> str:
+        """Pull the text we care about out of the response message."""
+        return message["content"]
+
+    def complete(
+        self,
+        model: str,
+        messages: List[Dict],
+        max_tokens: Optional[int] = None,
+        options: Optional[Dict] = None,
+    ) -> str:
+        """Make a single chat completion request against a model.
+
+        The max_tokens and completion options of the prompt system are used unless given.
+        """
+        check_cancelled()
+        backend = self.backend if self.wrap_backend is None else self.wrap_backend(self.backend)
+        create = self.chat_completion or backend.create
+        response = create(
+            model=model,
+            max_tokens=max_tokens or self.max_tokens,
+            temperature=self.temperature,
+            messages=messages,
+            request_timeout=call_timeout(self.request_timeout),
+            **(self.completion_options() if options is None else options),
+        )
+        usage = _USAGE.get()
+        if usage is not None:
+            usage.update(response.get("usage") or {})
+        trace("Raw GPT Response: %s", response)
+        return self.message_text(response["choices"][0]["message"])
+
+    def hedged(self, messages: List[Dict]) -> str:
+        """Ask the main model, and after hedge_after seconds the fallback too, taking the first valid answer.
+
+        If the main model comes back sooner with an error or an invalid answer the fallback is asked straight away.
+        The losing request is cancelled if it hasn't started, otherwise its answer is just ignored as the OpenAI
+        client gives us no way to abort a request in flight.
+        """
+        start = time.perf_counter()
+        tiers: Dict[Future, str] = {
+            _HEDGE_POOL.submit(copy_context().run, self.complete, self.model, messages): self.model
+        }
+        pending = set(tiers)
+        hedging = False
+        gpt_text, error = None, None
+        while pending:
+            timeout = remaining()
+            if not hedging:
+                hedge_in = max(0.0, self.hedge_after - (time.perf_counter() - start))
+                timeout = hedge_in if timeout is None else min(timeout, hedge_in)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    gpt_text = future.result()
+                except openai.OpenAIError as e:
+                    error = e
+                    continue
+                if self.valid(gpt_text):
+                    for loser in pending:
+                        loser.cancel()
+                    with _TIER_LOCK:
+                        TIER_WINS[tiers[future]] += 1
+                    debug(
+                        "%s won the hedged request in %.2fs",
+                        tiers[future],
+                        time.perf_counter() - start,
+                        model=tiers[future],
+                    )
+                    return gpt_text
+
+            if not hedging and (not pending or time.perf_counter() - start >= self.hedge_after):
+                debug(
+                    "No valid answer from %s after %.1fs, hedging with %s",
+                    self.model,
+                    time.perf_counter() - start,
+                    self.fallback_model,
+                )
+                fallback = _HEDGE_POOL.submit(
+                    copy_context().run, self.complete, self.fallback_model, messages
+                )
+                tiers[fallback] = self.fallback_model
+                pending.add(fallback)
+                hedging = True
+            elif not done and remaining() == 0:
+                for loser in pending:
+                    loser.cancel()
+                raise DeadlineExceeded()
+
+        if gpt_text is None and error is not None:
+            raise error
+        return gpt_text
+
+    def forget(self, user_prompt: str, context: Optional[str] = None):
+        """Drop a cached response, e.g. because it turned out to be garbage."""
+        if self.response_cache is not None:
+            self.response_cache.discard(self.cache_key(user_prompt, context))
 
     @retry(exception_class=openai.OpenAIError)
-    def ask(self, user_prompt: str) -> str:
+    def ask(self, user_prompt: str, context: Optional[str] = None) -> str:
         """
         Asks a question to the GPT-4 model.
 
         Args:
             user_prompt (str): The user's question.
+            context (str, optional): Extra system context such as a summary of the session so far.
 
         Returns:
             str: The GPT-4 model's response message.
         """
-        with CONSOLE.status("[bold green]Waiting for GPT..."):
+        if self.response_cache is not None:
+            gpt_text = self.response_cache.get(self.cache_key(user_prompt, context))
+            if gpt_text is not None:
+                debug("Cached GPT Text: %s", gpt_text)
+                return gpt_text
+
+        messages = [{"role": "system", "content": self.prompt}]
+        if context:
+            messages.append({"role": "system", "content": context})
+        messages.append({"role": "user", "content": user_prompt})
+
+        status = (
+            CONSOLE.status("[bold green]Waiting for GPT...") if self.show_status else nullcontext()
+        )
+        with status:
             try:
-                messages = [
-                    {"role": "system", "content": self.prompt},
-                    {"role": "user", "content": user_prompt},
-                ]
-                response = openai.ChatCompletion.create(
-                    model=self.model,
-                    max_tokens=self.max_tokens,
-                    temperature=self.temperature,
-                    messages=messages,
-                )
-                gpt_text = response["choices"][0]["message"]["content"]
+                if self.fallback_model and self.hedge_after is not None:
+                    gpt_text = self.hedged(messages)
+                else:
+                    gpt_text = self.complete(self.model, messages)
                 CONSOLE.log("[bold red]GPT Done!")
             except openai.OpenAIError as e:
                 CONSOLE.log(f"[bold red]ERROR: {e}")
                 raise
-        debug(f"Raw GPT Response: {response}")
-        debug(f"Raw GPT Text: {gpt_text}")
+        debug("Raw GPT Text: %s", gpt_text)
+        if self.response_cache is not None:
+            self.response_cache.put(self.cache_key(user_prompt, context), gpt_text)
         return gpt_text
 
 
@@ -157,24 +397,286 @@ class JSONGPTPromptSystem(GPTPromptSystem):
     prompt_part = """Ensure all output produced is strict JSON format, do not add any other text outside of valid JSON.
     Check the output step by step for invalid JSON formatting and invalid characters, always use utf8 encoded characters.\n"""
 
+    def valid(self, gpt_text: str) -> bool:
+        try:
+            json.loads(gpt_text)
+        except (TypeError, ValueError):
+            return False
+        return True
+
     @retry(exception_class=GPTHallucinationError, cooloff=True)
-    def ask(self, user_prompt: str) -> str:
-        gpt_text = super().ask(user_prompt)
+    def ask(self, user_prompt: str, context: Optional[str] = None) -> str:
+        gpt_text = super().ask(user_prompt, context=context)
         gpt_json = None  # This will also trigger a retry
         try:
             gpt_json = json.loads(gpt_text)
-        except TypeError as e:
+        except (TypeError, ValueError) as e:
             CONSOLE.log(f"[bold red]ERROR: {e}")
+            self.forget(user_prompt, context)
             raise GPTHallucinationError(
                 "Invalid JSON hallucinated.",
                 prompt=self,
                 asked=user_prompt,
                 output=gpt_text,
             ) from e
-        debug(f"GPT JSON Response: {gpt_json}")
+        trace("GPT JSON Response: %s", gpt_json)
         return gpt_json
 
 
+# JSON schema types and the Python types that satisfy them
+SCHEMA_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "number": (int, float),
+    "integer": int,
+    "boolean": bool,
+    "null": type(None),
+}
+
+
+def schema_errors(value: Any, schema: Dict, path: str = "$") -> List[str]:
+    """Check a value against the subset of JSON schema we declare function parameters with.
+
+    Understands type, enum, properties, required, items, minItems, minimum and maximum. Returns a list of everything
+    that is wrong, so an empty list means the value is valid.
+    """
+    expected = schema.get("type")
+    if expected is not None:
+        python_type = SCHEMA_TYPES[expected]
+        if not isinstance(value, python_type) or (
+            isinstance(value, bool) and expected in ("number", "integer")
+        ):
+            return [f"{path} should be {expected}, got {type(value).__name__}"]
+    if "enum" in schema and value not in schema["enum"]:
+        return [f"{path} should be one of {schema['enum']}"]
+
+    errors = []
+    if isinstance(value, dict):
+        for name in schema.get("required", []):
+            if name not in value:
+                errors.append(f"{path}.{name} is missing")
+        for name, subschema in schema.get("properties", {}).items():
+            if value.get(name) is not None:
+                errors.extend(schema_errors(value[name], subschema, f"{path}.{name}"))
+    elif isinstance(value, list):
+        if len(value) < schema.get("minItems", 0):
+            errors.append(f"{path} should have at least {schema['minItems']} items")
+        if "items" in schema:
+            for n, item in enumerate(value):
+                errors.extend(schema_errors(item, schema["items"], f"{path}[{n}]"))
+    elif isinstance(value, (int, float)):
+        if "minimum" in schema and value < schema["minimum"]:
+            errors.append(f"{path} should be at least {schema['minimum']}")
+        if "maximum" in schema and value > schema["maximum"]:
+            errors.append(f"{path} should be at most {schema['maximum']}")
+    return errors
+
+
+def drop_invalid_items(value: Any, schema: Dict) -> List[str]:
+    """Drop the items of an object's arrays that don't fit their schema, in place, returning what was wrong with them.
+
+    One bad item, like a track with a quality of 1.1, shouldn't cost us all the good ones.
+    """
+    dropped: List[str] = []
+    if not isinstance(value, dict):
+        return dropped
+    for name, subschema in schema.get("properties", {}).items():
+        if not isinstance(value.get(name), list) or "items" not in subschema:
+            continue
+        kept = []
+        for n, item in enumerate(value[name]):
+            errors = schema_errors(item, subschema["items"], f"$.{name}[{n}]")
+            dropped.extend(errors)
+            if not errors:
+                kept.append(item)
+        value[name] = kept
+    return dropped
+
+
+class StructuredGPTPromptSystem(GPTPromptSystem):
+    """
+    A GPT prompt system that gets structured output by having the model call a function with the JSON schema of the
+    response as its parameters, rather than asking nicely for JSON in the prompt.
+
+    The schema is declared once on the class and the response is validated against it. Array items that don't match
+    are dropped, and a response that still doesn't match is asked for again, as GPT may well answer differently, up
+    to attempts times before it's a GPTHallucinationError.
+    """
+
+    function_name = "respond"
+    function_description = "Respond to the user"
+    # JSON schema of the function parameters, which is the response we get back
+    schema: Dict = {"type": "object", "properties": {}}
+    # Most requests to answer in a single completion, see ask_packed, fewer if they don't fit the model's context
+    pack_size = 4
+    # Times to ask before giving up on a response that doesn't fit the schema
+    attempts = 2
+
+    def function(self) -> Dict:
+        return {
+            "name": self.function_name,
+            "description": self.function_description,
+            "parameters": self.schema,
+        }
+
+    def completion_options(self) -> Dict:
+        return {"functions": [self.function()], "function_call": {"name": self.function_name}}
+
+    def message_text(self, message: Dict) -> str:
+        function_call = message.get("function_call") or {}
+        return function_call.get("arguments") or message.get("content")
+
+    def parse(self, gpt_text: str) -> Any:
+        """Parse and validate the function arguments, raising GPTHallucinationError if they don't fit the schema.
+
+        Array items that don't fit are dropped, so long as what is left still does.
+        """
+        try:
+            response = json.loads(gpt_text)
+        except (TypeError, ValueError) as e:
+            errors = [f"invalid JSON {e}"]
+        else:
+            dropped = drop_invalid_items(response, self.schema)
+            if dropped:
+                debug("Dropped items that didn't match the schema: %s", "; ".join(dropped))
+            errors = schema_errors(response, self.schema)
+            if errors:
+                errors = dropped + errors
+        if errors:
+            raise GPTHallucinationError(
+                f"Response didn't match the schema: {'; '.join(errors)}",
+                prompt=self,
+                output=gpt_text,
+            )
+        return response
+
+    def valid(self, gpt_text: str) -> bool:
+        try:
+            self.parse(gpt_text)
+        except GPTHallucinationError:
+            return False
+        return True
+
+    def ask(self, user_prompt: str, context: Optional[str] = None) -> Any:
+        for attempt in range(1, self.attempts + 1):
+            gpt_text = super().ask(user_prompt, context=context)
+            try:
+                response = self.parse(gpt_text)
+            except GPTHallucinationError as e:
+                CONSOLE.log(f"[bold red]ERROR: {e}")
+                self.forget(user_prompt, context)
+                e.asked = user_prompt
+                if attempt == self.attempts:
+                    raise
+                continue
+            trace("GPT Structured Response: %s", response)
+            return response
+
+    def packed_function(self, keys: List[str]) -> Dict:
+        """The function for answering several requests at once, one response per key."""
+        return {
+            "name": f"{self.function_name}_each",
+            "description": f"{self.function_description}, separately for each of the keyed requests",
+            "parameters": {
+                "type": "object",
+                "properties": {key: self.schema for key in keys},
+                "required": list(keys),
+            },
+        }
+
+    def ask_packed(self, user_prompts: List[str], context: Optional[str] = None) -> List[Any]:
+        """Answer several independent requests, pack_size at a time in a single completion each.
+
+        The system prompt and per request overhead are paid once per pack rather than once per request, which is what
+        matters when generating in bulk. Each request's response is keyed so it can be split back out and validated on
+        its own, and only those that didn't fit the schema are asked again, singly. Responses come back in the order of
+        the requests, None for any that failed even then.
+        """
+        responses: List[Any] = [None] * len(user_prompts)
+        failed = []
+        for start in range(0, len(user_prompts), self.pack_size):
+            pack = {}
+            for n in range(start, min(start + self.pack_size, len(user_prompts))):
+                responses[n] = self._cached(user_prompts[n], context)
+                if responses[n] is None:
+                    pack[f"r{n}"] = n
+            if not pack:
+                continue
+            answers = self._ask_pack({key: user_prompts[n] for key, n in pack.items()}, context)
+            for key, n in pack.items():
+                errors = ["missing"]
+                if key in answers:
+                    drop_invalid_items(answers[key], self.schema)
+                    errors = schema_errors(answers[key], self.schema)
+                if errors:
+                    debug("Packed response %s failed: %s", key, "; ".join(errors))
+                    failed.append(n)
+                    continue
+                responses[n] = answers[key]
+                if self.response_cache is not None:
+                    self.response_cache.put(
+                        self.cache_key(user_prompts[n], context), json.dumps(answers[key])
+                    )
+
+        for n in failed:
+            try:
+                # Subclasses wrap ask to return something else, we want the validated response
+                responses[n] = StructuredGPTPromptSystem.ask(self, user_prompts[n], context=context)
+            except GPTHallucinationError:
+                responses[n] = None
+        return responses
+
+    def _cached(self, user_prompt: str, context: Optional[str]) -> Optional[Any]:
+        if self.response_cache is None:
+            return None
+        gpt_text = self.response_cache.get(self.cache_key(user_prompt, context))
+        return self.parse(gpt_text) if gpt_text is not None and self.valid(gpt_text) else None
+
+    def _ask_pack(self, requests: Dict[str, str], context: Optional[str]) -> Dict[str, Any]:
+        """Ask for a pack of keyed requests, giving back whatever keyed responses could be parsed at all.
+
+        Each request gets max_tokens to answer in, and a pack too big for the model to do that is split in two.
+        """
+        function = self.packed_function(list(requests))
+        messages = [
+            {"role": "system", "content": self.prompt},
+            {
+                "role": "system",
+                "content": "There are several independent user requests keyed in a JSON object, respond to each "
+                "one on its own under the same key.",
+            },
+        ]
+        if context:
+            messages.append({"role": "system", "content": context})
+        messages.append({"role": "user", "content": json.dumps(requests)})
+
+        room = context_window(self.model) - estimate_tokens([messages, function])
+        if len(requests) > 1 and room < self.max_tokens * len(requests):
+            keys = list(requests)
+            half = len(keys) // 2
+            debug("Splitting a pack of %d requests that won't fit in %s", len(keys), self.model)
+            return {
+                **self._ask_pack({key: requests[key] for key in keys[:half]}, context),
+                **self._ask_pack({key: requests[key] for key in keys[half:]}, context),
+            }
+        if room <= 0:
+            return {}
+
+        try:
+            gpt_text = self.complete(
+                self.model,
+                messages,
+                max_tokens=min(self.max_tokens * len(requests), room),
+                options={"functions": [function], "function_call": {"name": function["name"]}},
+            )
+            answers = json.loads(gpt_text)
+        except (openai.OpenAIError, TypeError, ValueError) as e:
+            CONSOLE.log(f"[bold red]ERROR: packed request failed {e}")
+            return {}
+        return answers if isinstance(answers, dict) else {}
+
+
 class TestGPTPomptSystem(JSONGPTPromptSystem):
     """
     A fairly meta GPT prompt system for getting and using test cases for other GPT prompt systems
@@ -193,8 +695,8 @@ class TestGPTPomptSystem(JSONGPTPromptSystem):
     def ask(self, user_prompt: str) -> List[PromptTestCase]:
         gpt_json = super().ask(user_prompt)
         try:
-            [
-                PromptTestCase(prompt=c["prompt"], output=c["output"], case=c["case"])
+            return [
+                PromptTestCase(prompt=c["prompt"], output=c["output"], case=TestCaseType(c["case"]))
                 for c in gpt_json
             ]
         except ValueError as e:
@@ -205,6 +707,14 @@ class TestGPTPomptSystem(JSONGPTPromptSystem):
                     asked=user_prompt,
                     output=gpt_json,
                 ) from e
+            raise
+        except (KeyError, TypeError) as e:
+            raise GPTHallucinationError(
+                "Test cases were not an array of prompt/output/case objects.",
+                prompt=self,
+                asked=user_prompt,
+                output=gpt_json,
+            ) from e
 
 
 class SelfTestJSONGPTPromptSystem(JSONGPTPromptSystem):
@@ -213,16 +723,33 @@ class SelfTestJSONGPTPromptSystem(JSONGPTPromptSystem):
     performance given user data.
     """
 
-    def test_cases(self):
+    def test_cases(self) -> List[PromptTestCase]:
         return TestGPTPomptSystem(num_cases=12).ask(self.prompt)
 
 
+class SelfTestStructuredGPTPromptSystem(StructuredGPTPromptSystem):
+    """
+    A GPT structured output prompt system that can get GPT to produce test cases for itself, the outputs of which are
+    the function arguments.
+    """
+
+    def test_cases(self) -> List[PromptTestCase]:
+        return TestGPTPomptSystem(num_cases=12).ask(
+            f"{self.prompt}\nRespond only with arguments for this function: {json.dumps(self.function())}"
+        )
+
+
 class IntGPTPromptSystem(GPTPromptSystem):
     prompt_part = """"You are IntegerGPT4 a mathematician who's only job is to output the integer representation of the 
     input. Only include the digits 0 to 9 in your output string."""
 
+    # Parsing an integer doesn't need the big model
+    model = "gpt-3.5-turbo"
     max_tokens = 10
 
+    def valid(self, gpt_text: str) -> bool:
+        return gpt_text.strip().isdigit()
+
     def ask(self, user_prompt: str) -> int:
         if user_prompt.strip().isnumeric():
             try:
@@ -231,7 +758,7 @@ class IntGPTPromptSystem(GPTPromptSystem):
             except ValueError:
                 pass
         gpt_text = super().ask(user_prompt)
-        debug(f"GPT Integer Response: {gpt_text}")
+        debug("GPT Integer Response: %s", gpt_text)
         try:
             integer = int(gpt_text)
         except ValueError:
@@ -0,0 +1,152 @@
+"""DJ GPT CLI
+
+Module for a semantic cache, so requests that mean the same thing but are worded differently can skip asking GPT
+"""
+
+import itertools
+import json
+import threading
+import zlib
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from djgpt.catalog import NUMBER, normalize
+from djgpt.utils import debug
+
+
+def features(text: str, sizes: Tuple[int, ...] = (3, 4)) -> List[str]:
+    """Words and character n-grams of the normalised text, so word order and spelling slips matter less."""
+    text = normalize(text)
+    grams = [f"w:{word}" for word in text.split()]
+    padded = f" {text} "
+    for n in sizes:
+        grams.extend(padded[i : i + n] for i in range(len(padded) - n + 1))
+    return grams
+
+
+def hashed_counts(text: str, dim: int) -> np.ndarray:
+    """Term counts of the text's features hashed into a fixed number of buckets."""
+    counts = np.zeros(dim, dtype=np.float32)
+    for gram in features(text):
+        counts[zlib.crc32(gram.encode()) % dim] += 1
+    return counts
+
+
+def numbers_in(text: str) -> List[str]:
+    """The numbers in some text, in order of size as "top 10 of the 2000s" means the same as "2000s top 10"."""
+    return sorted(NUMBER.findall(normalize(text)), key=int)
+
+
+class SemanticCache:
+    """A thread safe LRU cache keyed by what a request means rather than its exact wording.
+
+    Requests are embedded locally as hashed n-gram TF-IDF vectors, stored as rows of a NumPy matrix, and looked up by
+    cosine similarity. Anything at least threshold similar is a hit, so long as it has the same numbers in it, as the
+    80s are only a character away from the 90s but another playlist altogether.
+    """
+
+    def __init__(self, maxsize: int = 1024, threshold: float = 0.75, dim: int = 2048):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.dim = dim
+        self.lock = threading.Lock()
+        # Raw term counts per slot, IDF weighting changes as requests come and go so is applied at lookup. The matrix
+        # grows as needed up to maxsize rows, rather than starting out at its biggest
+        self.counts = np.zeros((min(maxsize, 64), dim), dtype=np.float32)
+        self.doc_freq = np.zeros(dim, dtype=np.float32)
+        self.texts: List[str] = []
+        self.numbers: List[List[str]] = []
+        self.values: List[Any] = []
+        self.last_used = np.zeros(maxsize, dtype=np.int64)
+        self.tick = 0
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def _tfidf(self, counts: np.ndarray) -> np.ndarray:
+        idf = np.log((1 + self.size) / (1 + self.doc_freq)) + 1
+        weighted = counts * idf
+        norms = np.linalg.norm(weighted, axis=-1, keepdims=True)
+        return weighted / np.where(norms == 0, 1, norms)
+
+    def neighbours(self, text: str, k: int = 3) -> List[Tuple[float, Any]]:
+        """The k most similar cached values at or above the threshold, most similar first."""
+        query = hashed_counts(text, self.dim)
+        numbers = numbers_in(text)
+        with self.lock:
+            if self.size == 0:
+                self.misses += 1
+                return []
+            scores = self._tfidf(self.counts[: self.size]) @ self._tfidf(query)
+            best = [
+                int(i)
+                for i in np.argsort(-scores)
+                if scores[i] >= self.threshold and self.numbers[i] == numbers
+            ][:k]
+            if not best:
+                self.misses += 1
+                return []
+            self.hits += 1
+            self.tick += 1
+            self.last_used[best] = self.tick
+            debug(
+                "Semantic cache hit for %r, %r scored %.2f",
+                text,
+                self.texts[best[0]],
+                scores[best[0]],
+            )
+            return [(float(scores[i]), self.values[i]) for i in best]
+
+    def lookup(
+        self, text: str, limit: Optional[int] = None, key: Callable[[Any], Hashable] = None
+    ) -> Optional[List]:
+        """Serve a cached list for something similar enough, blending the lists of several close matches.
+
+        The lists are interleaved most similar first with duplicates (by key) dropped, up to limit items.
+        """
+        matches = self.neighbours(text)
+        if not matches:
+            return None
+        key = key or (lambda item: json.dumps(item, sort_keys=True, default=str))
+        blended, seen = [], set()
+        for item in itertools.chain.from_iterable(
+            itertools.zip_longest(*(value for _, value in matches))
+        ):
+            if item is None or key(item) in seen:
+                continue
+            seen.add(key(item))
+            blended.append(item)
+        return blended[:limit] if limit else blended
+
+    def put(self, text: str, value: Any):
+        counts = hashed_counts(text, self.dim)
+        with self.lock:
+            if self.size < self.maxsize:
+                slot = self.size
+                self.size += 1
+                self.texts.append(text)
+                self.numbers.append(numbers_in(text))
+                self.values.append(value)
+                if slot == len(self.counts):
+                    grown = np.zeros((min(2 * slot, self.maxsize), self.dim), dtype=np.float32)
+                    grown[:slot] = self.counts
+                    self.counts = grown
+            else:
+                slot = int(np.argmin(self.last_used))
+                self.doc_freq -= self.counts[slot] > 0
+                self.evictions += 1
+            self.counts[slot] = counts
+            self.doc_freq += counts > 0
+            self.texts[slot] = text
+            self.numbers[slot] = numbers_in(text)
+            self.values[slot] = value
+            self.tick += 1
+            self.last_used[slot] = self.tick
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""DJ GPT CLI
+
+Run DJGPT as a long running HTTP service for many users at once. Each user session gets its own Spotify credentials
+and session state, while the GPT response cache, the local track catalog and the pooled HTTP connections are shared.
+
+    POST   /sessions              {"access_token": ...}
+    POST   /sessions/<id>/ask     {"request": "something for a summer road trip"}
+    POST   /sessions/<id>/play    {"tracks": [1, 3]} or {"tracks": "all"}
+    DELETE /sessions/<id>
+"""
+
+import json
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import getenv
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import openai
+import spotipy
+import typer
+from typer import Option
+from typing_extensions import Annotated
+
+from djgpt.cli import DJGPTPromptSystem
+from djgpt.prompt import GPTPromptSystem, ResponseCache
+from djgpt.semantic import SemanticCache
+from djgpt.session import Session
+from djgpt.spotify import Track, ready_device, resolve_tracks, spotify_client, use_spotify
+from djgpt.utils import CONSOLE, DeadlineExceeded, deadline, debug, http_session
+
+app = typer.Typer()
+
+ClientFactory = Callable[[Dict], spotipy.Spotify]
+
+
+def default_client_factory(credentials: Dict) -> spotipy.Spotify:
+    """A Spotify API caller for the user's own access token.
+
+    Users authorize with Spotify themselves, the server never does the OAuth dance as that would cache one user's
+    token for everyone and prompt on the server's own terminal.
+    """
+    if not credentials.get("access_token"):
+        raise ValueError("Sessions need a Spotify access_token")
+    return spotify_client(access_token=credentials["access_token"])
+
+
+@dataclass
+class UserSession:
+    """Everything we keep for one user of the server."""
+
+    client: spotipy.Spotify
+    djgpt: DJGPTPromptSystem
+    session: Session = field(default_factory=Session)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class DJGPTServer(ThreadingHTTPServer):
+    """A threaded HTTP server holding all the user sessions."""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        num_tracks: int = 5,
+        surplus: int = 2,
+        client_factory: ClientFactory = default_client_factory,
+        chat_completion: Optional[Callable[..., Dict]] = None,
+        session_ttl: float = 3600,
+        max_sessions: int = 1000,
+        turn_budget: Optional[float] = 30.0,
+    ):
+        super().__init__(address, DJGPTRequestHandler)
+        self.num_tracks = num_tracks
+        self.surplus = surplus
+        self.client_factory = client_factory
+        self.chat_completion = chat_completion
+        self.session_ttl = session_ttl
+        self.max_sessions = max_sessions
+        self.turn_budget = turn_budget
+        self.sessions: Dict[str, UserSession] = {}
+        self.lock = threading.Lock()
+
+    def create_session(self, credentials: Dict) -> str:
+        djgpt = DJGPTPromptSystem(num_tracks=self.num_tracks + self.surplus)
+        djgpt.show_status = False
+        if self.chat_completion is not None:
+            djgpt.chat_completion = self.chat_completion
+        user = UserSession(client=self.client_factory(credentials), djgpt=djgpt)
+
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.expire_sessions()
+            if len(self.sessions) >= self.max_sessions:
+                raise OverflowError("Too many sessions")
+            self.sessions[session_id] = user
+        return session_id
+
+    def expire_sessions(self):
+        """Drop sessions nobody has used for a while, call holding the lock."""
+        cutoff = time.monotonic() - self.session_ttl
+        for session_id in [k for k, v in self.sessions.items() if v.last_used < cutoff]:
+            del self.sessions[session_id]
+
+    def get_session(self, session_id: str) -> Optional[UserSession]:
+        with self.lock:
+            user = self.sessions.get(session_id)
+        if user is not None:
+            user.last_used = time.monotonic()
+        return user
+
+    def delete_session(self, session_id: str) -> bool:
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+
+def track_json(number: int, track: Track) -> Dict:
+    return {
+        "number": number,
+        "artist": track.artist,
+        "trackname": track.trackname,
+        "genre": track.genre,
+        "reason": track.reason,
+        "quality": track.quality,
+        "url": track.spotify.url if track.spotify else None,
+        "uri": track.spotify.uri if track.spotify else None,
+    }
+
+
+class DJGPTRequestHandler(BaseHTTPRequestHandler):
+    server: DJGPTServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args):
+        debug("%s " + format, self.address_string(), *args)
+
+    def send_json(self, status: HTTPStatus, body: Optional[Dict] = None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_json(self) -> Dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def route(self) -> Tuple[Optional[UserSession], Optional[str], Optional[str]]:
+        """Split /sessions/<id>/<action> into the session, its id and the action."""
+        parts = self.path.strip("/").split("/")
+        if parts[0] != "sessions" or len(parts) > 3:
+            return None, None, None
+        session_id = parts[1] if len(parts) > 1 else None
+        action = parts[2] if len(parts) > 2 else None
+        user = self.server.get_session(session_id) if session_id else None
+        return user, session_id, action
+
+    def do_POST(self):
+        try:
+            body = self.read_json()
+        except ValueError:
+            return self.send_json(HTTPStatus.BAD_REQUEST, {"error": "Invalid JSON"})
+        if not isinstance(body, dict):
+            return self.send_json(HTTPStatus.BAD_REQUEST, {"error": "Expected a JSON object"})
+
+        user, session_id, action = self.route()
+        if session_id is None and self.path.strip("/") == "sessions":
+            try:
+                return self.send_json(
+                    HTTPStatus.CREATED, {"session": self.server.create_session(body)}
+                )
+            except OverflowError as e:
+                return self.send_json(HTTPStatus.SERVICE_UNAVAILABLE, {"error": str(e)})
+            except Exception as e:
+                return self.send_json(HTTPStatus.UNAUTHORIZED, {"error": str(e)})
+        if user is None:
+            return self.send_json(HTTPStatus.NOT_FOUND, {"error": "No such session"})
+
+        if action == "ask":
+            request = body.get("request")
+            if not isinstance(request, str) or not request.strip():
+                return self.send_json(
+                    HTTPStatus.BAD_REQUEST, {"error": "request should be what to listen to"}
+                )
+            try:
+                with deadline(self.server.turn_budget):
+                    tracks = self.ask(user, request)
+            except DeadlineExceeded:
+                return self.send_json(HTTPStatus.GATEWAY_TIMEOUT, {"error": "GPT took too long"})
+            return self.send_json(HTTPStatus.OK, {"tracks": tracks})
+        if action == "play":
+            selection = body.get("tracks")
+            if selection != "all" and not (
+                isinstance(selection, list) and all(type(n) is int for n in selection)
+            ):
+                return self.send_json(
+                    HTTPStatus.BAD_REQUEST,
+                    {"error": 'tracks should be "all" or a list of track numbers'},
+                )
+            return self.play(user, selection)
+        return self.send_json(HTTPStatus.BAD_REQUEST, {"error": "Unknown action"})
+
+    def do_DELETE(self):
+        # Drain any body so the connection can be kept alive
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        _, session_id, action = self.route()
+        if session_id is None or action is not None or not self.server.delete_session(session_id):
+            return self.send_json(HTTPStatus.NOT_FOUND, {"error": "No such session"})
+        return self.send_json(HTTPStatus.NO_CONTENT)
+
+    def ask(self, user: UserSession, request: str) -> List[Dict]:
+        with user.lock, use_spotify(user.client):
+            candidates = user.djgpt.ask(request, session=user.session)
+            # Resolve while we're using this user's client
+            tracks = list(resolve_tracks(candidates, self.server.num_tracks))
+            presented = [track_json(n, t) for n, t in enumerate(tracks, start=1)]
+            user.session.record(request, tracks)
+        return presented
+
+    def play(self, user: UserSession, selection: Union[str, List[int]]):
+        with user.lock:
+            tracks = user.session.last_tracks
+            if selection != "all":
+                missing = [n for n in selection if user.session.track(n) is None]
+                if missing:
+                    return self.send_json(
+                        HTTPStatus.BAD_REQUEST, {"error": f"No track numbered {missing[0]}"}
+                    )
+                tracks = [user.session.track(n) for n in selection]
+            uris = [t.spotify.uri for t in tracks if t.spotify]
+            if not uris:
+                return self.send_json(HTTPStatus.BAD_REQUEST, {"error": "Nothing to play"})
+            try:
+                with deadline(self.server.turn_budget):
+                    # The host's own preferred device is nothing to do with this user
+                    device_id = ready_device(user.client, preferred=None)
+                    user.client.start_playback(device_id=device_id, uris=uris)
+            except spotipy.SpotifyException as e:
+                return self.send_json(HTTPStatus.CONFLICT, {"error": str(e)})
+            except DeadlineExceeded:
+                return self.send_json(
+                    HTTPStatus.GATEWAY_TIMEOUT, {"error": "Spotify took too long"}
+                )
+        return self.send_json(HTTPStatus.OK, {"playing": uris})
+
+
+def share_caches(response_cache_size: int = 4096, semantic_threshold: float = 0.75):
+    """Share the GPT response caches and pooled connections between every user of the process."""
+    GPTPromptSystem.response_cache = ResponseCache(maxsize=response_cache_size)
+    if semantic_threshold:
+        DJGPTPromptSystem.semantic_cache = SemanticCache(
+            maxsize=response_cache_size, threshold=semantic_threshold
+        )
+    openai.requestssession = http_session()
+
+
+@app.command()
+def main(
+    openai_api_key: Annotated[str, Option(prompt=True, envvar="OPENAI_API_KEY")] = getenv(
+        "OPENAI_API_KEY"
+    ),
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    num_tracks: int = 5,
+    surplus: int = 2,
+    response_cache_size: int = 4096,
+    semantic_threshold: float = 0.75,
+    session_ttl: float = 3600,
+    turn_budget: float = 30.0,
+):
+    openai.api_key = openai_api_key
+    share_caches(response_cache_size, semantic_threshold)
+    server = DJGPTServer(
+        (host, port),
+        num_tracks=num_tracks,
+        surplus=surplus,
+        session_ttl=session_ttl,
+        turn_budget=turn_budget,
+    )
+    CONSOLE.log(f"[bold red]DJGPT serving on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        CONSOLE.log("The server is terminated manually!")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    app()
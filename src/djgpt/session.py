@@ -0,0 +1,145 @@
+"""DJ GPT CLI
+
+Module to keep track of the DJ session so refinements like "more like number 2" build on what came before
+"""
+
+import re
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional, Tuple
+
+from djgpt.spotify import Spotify, Track
+
+ORDINALS = {
+    "first": 1,
+    "second": 2,
+    "third": 3,
+    "fourth": 4,
+    "fifth": 5,
+    "sixth": 6,
+    "seventh": 7,
+    "eighth": 8,
+    "ninth": 9,
+    "tenth": 10,
+}
+
+# "number 2", "track #3", "no. 4", "#5", "the second one"
+TRACK_REFERENCE = re.compile(
+    r"\b(?:number|track|song|no\.?)\s*#?\s*(\d+)\b|#(\d+)\b|\bthe\s+("
+    + "|".join(ORDINALS)
+    + r")\s+(?:one|track|song)\b",
+    re.IGNORECASE,
+)
+
+
+def track_key(artist: str, trackname: str) -> Tuple[str, str]:
+    return artist.strip().lower(), trackname.strip().lower()
+
+
+@dataclass
+class Turn:
+    """Store a single request and the tracks presented for it, numbered as shown to the user."""
+
+    request: str
+    tracks: List[Track]
+
+
+class Session:
+    """The state of a DJ session.
+
+    Holds a bounded history of requests and the tracks we presented, plus everything we've already resolved in
+    Spotify so the same track recommended twice is only ever searched for once.
+    """
+
+    def __init__(self, max_turns: int = 3, max_resolved: int = 500, max_request_chars: int = 200):
+        self.turns: Deque[Turn] = deque(maxlen=max_turns)
+        self.resolved: "OrderedDict[Tuple[str, str], Optional[Spotify]]" = OrderedDict()
+        self.max_resolved = max_resolved
+        self.max_request_chars = max_request_chars
+
+    @property
+    def last_tracks(self) -> List[Track]:
+        return self.turns[-1].tracks if self.turns else []
+
+    def track(self, number: int) -> Optional[Track]:
+        """Get a track from the last turn by the number it was presented with."""
+        tracks = self.last_tracks
+        return tracks[number - 1] if 0 < number <= len(tracks) else None
+
+    def expand(self, request: str) -> str:
+        """Swap references like "number 2" for the actual track, so GPT doesn't need the whole history."""
+
+        def replace(match: re.Match) -> str:
+            number, hashed, ordinal = match.groups()
+            track = self.track(
+                int(number or hashed) if (number or hashed) else ORDINALS[ordinal.lower()]
+            )
+            if track is None:
+                return match.group(0)
+            return f'"{track.trackname}" by {track.artist}'
+
+        return TRACK_REFERENCE.sub(replace, request)
+
+    def context(self) -> Optional[str]:
+        """A compact summary of the session so far to give GPT as extra context."""
+        if not self.turns:
+            return None
+        lines = ["Earlier in this session (oldest first), the user asked for:"]
+        for turn in self.turns:
+            request = turn.request[: self.max_request_chars]
+            played = "; ".join(
+                f"{t.trackname} by {t.artist}" for t in turn.tracks if t.resolved and t.spotify
+            )
+            lines.append(f'- "{request}" and was offered: {played or "nothing playable"}')
+        lines.append("Treat the new request as a refinement of these where it makes sense.")
+        return "\n".join(lines)
+
+    def has_resolved(self, track: Track) -> bool:
+        return track_key(track.artist, track.trackname) in self.resolved
+
+    def reuse(self, tracks: List[Track]) -> List[Track]:
+        """Fill in the Spotify data for any tracks we've already resolved this session."""
+        for track in tracks:
+            key = track_key(track.artist, track.trackname)
+            if key in self.resolved:
+                self.resolved.move_to_end(key)
+                track.spotify = self.resolved[key]
+        return tracks
+
+    def record(self, request: str, tracks: List[Track]):
+        """Remember a request and the tracks we presented for it."""
+        self.turns.append(Turn(request=request, tracks=tracks))
+        for track in tracks:
+            if track.resolved:
+                self.resolved[track_key(track.artist, track.trackname)] = track.spotify
+        while len(self.resolved) > self.max_resolved:
+            self.resolved.popitem(last=False)
+
+    def to_dict(self) -> Dict:
+        """The session as plain JSON, so it can be snapshotted and restored."""
+        return {
+            "max_turns": self.turns.maxlen,
+            "max_resolved": self.max_resolved,
+            "max_request_chars": self.max_request_chars,
+            "turns": [
+                {"request": turn.request, "tracks": [t.to_dict() for t in turn.tracks]}
+                for turn in self.turns
+            ],
+            "resolved": [
+                [artist, trackname, {"url": s.url, "uri": s.uri} if s else None]
+                for (artist, trackname), s in self.resolved.items()
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, session: Dict) -> "Session":
+        self = cls(
+            max_turns=session["max_turns"],
+            max_resolved=session["max_resolved"],
+            max_request_chars=session["max_request_chars"],
+        )
+        for turn in session["turns"]:
+            self.turns.append(Turn(turn["request"], [Track.from_dict(t) for t in turn["tracks"]]))
+        for artist, trackname, spotify in session["resolved"]:
+            self.resolved[(artist, trackname)] = Spotify(stash={}, **spotify) if spotify else None
+        return self
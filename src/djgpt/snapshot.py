@@ -0,0 +1,82 @@
+"""DJ GPT CLI
+
+Module to snapshot the warm state of a DJ session to disk, so a restart (or crash) picks up where it left off without
+authorizing with Spotify or losing the session all over again
+"""
+
+import json
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, Optional
+
+import spotipy
+
+from djgpt import spotify
+from djgpt.session import Session
+from djgpt.utils import cache_path, debug
+
+
+@dataclass
+class Snapshot:
+    """Everything we need to be ready to DJ straight away."""
+
+    session: Dict
+    token_info: Optional[Dict] = None
+    device_id: Optional[str] = None
+    saved_at: float = field(default_factory=time.time)
+
+    @classmethod
+    def take(cls, session: Session) -> "Snapshot":
+        return cls(
+            session=session.to_dict(),
+            token_info=spotify.S_TOKEN_INFO,
+            device_id=spotify.S_DEVICE_ID,
+        )
+
+    def restore(self) -> Session:
+        """Put back the Spotify token and device, returning the restored session.
+
+        An expired token is still worth having back if it can be refreshed.
+        """
+        if self.token_info is not None and (
+            self.token_info.get("refresh_token")
+            or not spotipy.SpotifyOAuth.is_token_expired(self.token_info)
+        ):
+            spotify.S_TOKEN_INFO = self.token_info
+        spotify.S_DEVICE_ID = spotify.S_DEVICE_ID or self.device_id
+        return Session.from_dict(self.session)
+
+
+def snapshot_path() -> Path:
+    return cache_path("snapshot.json")
+
+
+def save_snapshot(session: Session, path: Optional[Path] = None):
+    """Write a snapshot atomically, so a crash part way through never leaves a broken one behind."""
+    path = path or snapshot_path()
+    tmp = path.with_suffix(".tmp")
+    with tmp.open("w") as f:
+        json.dump(asdict(Snapshot.take(session)), f)
+    # The token is as good as a password
+    os.chmod(tmp, 0o600)
+    os.replace(tmp, path)
+    debug("Saved snapshot to %s", path)
+
+
+def load_snapshot(path: Optional[Path] = None, max_age: float = 12 * 3600) -> Optional[Snapshot]:
+    """Load the last snapshot, unless it's too old to be worth resuming or can't be read."""
+    path = path or snapshot_path()
+    try:
+        with path.open() as f:
+            snapshot = Snapshot(**json.load(f))
+        # Make sure the session is usable now rather than finding out later
+        Session.from_dict(snapshot.session)
+    except (OSError, ValueError, TypeError, KeyError) as e:
+        debug("No snapshot to resume from: %s", e)
+        return None
+    if time.time() - snapshot.saved_at > max_age:
+        debug("Snapshot from %.0fs ago is too old to resume", time.time() - snapshot.saved_at)
+        return None
+    return snapshot
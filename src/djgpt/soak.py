@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""DJ GPT CLI
+
+Soak test a long DJ session against local stand-ins for GPT and Spotify, to catch anything that grows without bound or
+slows down the longer djgpt runs
+"""
+
+import gc
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+
+import typer
+from rich.table import Table
+from typer import Option
+from typing_extensions import Annotated
+
+from djgpt.catalog import get_catalog
+from djgpt.cli import DJGPTPromptSystem
+from djgpt.history import RECOMMENDED, SELECTED, get_history
+from djgpt.prompt import ResponseCache
+from djgpt.semantic import SemanticCache
+from djgpt.session import Session
+from djgpt.snapshot import save_snapshot
+from djgpt.spotify import Track, play_on_spotify, resolve_tracks, set_spotify
+from djgpt.standins import LocalGPT, LocalSpotify, synthetic_tracks
+from djgpt.utils import CONSOLE, RECENT
+
+app = typer.Typer()
+
+# Things that grow on purpose, the listening history and catalog live on disk and are pruned by age
+UNBOUNDED = ("history_events", "catalog_tracks")
+
+# Ways of asking for the same kind of thing, so the semantic cache sees some near misses
+PHRASINGS = ("music for {}", "{} music", "something for {}", "play me songs for {}")
+
+
+def rss_bytes() -> int:
+    """The resident set size of this process right now, or the peak where we can't tell."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KiB and macOS bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def count_instances(cls: type) -> int:
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, cls))
+
+
+@dataclass
+class Sample:
+    """Everything we measure at one point in the soak."""
+
+    turn: int
+    metrics: Dict[str, float]
+
+
+@dataclass
+class SoakReport:
+    turns: int
+    latencies: List[float] = field(default_factory=list)
+    samples: List[Sample] = field(default_factory=list)
+    failures: List[str] = field(default_factory=list)
+
+    def series(self, metric: str) -> List[float]:
+        return [s.metrics[metric] for s in self.samples]
+
+    def to_dict(self) -> Dict:
+        return {
+            "turns": self.turns,
+            "latencies": self.latencies,
+            "samples": [{"turn": s.turn, **s.metrics} for s in self.samples],
+            "failures": self.failures,
+        }
+
+
+def growth_failures(
+    report: SoakReport,
+    bounds: Optional[Dict[str, float]] = None,
+    max_growth: float = 0.1,
+    max_drift: float = 0.5,
+    warmup: float = 0.25,
+    ignore: Sequence[str] = UNBOUNDED,
+) -> List[str]:
+    """Whatever kept growing, or slowed down, after warming up.
+
+    Metrics with a known bound, like a cache's maxsize, just mustn't go over it. For the rest the second half after
+    warmup is compared with the first: they should have levelled off by then so may only grow by max_growth, and the
+    median turn latency only by max_drift.
+    """
+    bounds = bounds or {}
+    failures = []
+    for metric, bound in bounds.items():
+        highest = max((s.metrics[metric] for s in report.samples), default=0)
+        if highest > bound:
+            failures.append(f"{metric} went over its bound of {bound:.0f} to {highest:.0f}")
+
+    if len(report.samples) >= 4:
+        start = int(len(report.samples) * warmup)
+        middle = report.samples[start : start + max(1, (len(report.samples) - start) // 2)]
+        end = report.samples[-len(middle) :]
+        for metric in report.samples[0].metrics:
+            if metric in ignore or metric in bounds:
+                continue
+            before = statistics.median(s.metrics[metric] for s in middle)
+            after = statistics.median(s.metrics[metric] for s in end)
+            # A small absolute slack so counts that are tiny or zero don't fail on noise
+            if after > before * (1 + max_growth) + 10:
+                failures.append(f"{metric} kept growing from {before:.0f} to {after:.0f}")
+
+    if len(report.latencies) >= 8:
+        start = int(len(report.latencies) * warmup)
+        window = (len(report.latencies) - start) // 2
+        before = statistics.median(report.latencies[start : start + window])
+        after = statistics.median(report.latencies[-window:])
+        if after > before * (1 + max_drift) + 0.001:
+            failures.append(f"Turns slowed down from {1000 * before:.1f}ms to {1000 * after:.1f}ms")
+    return failures
+
+
+def soak(
+    turns: int = 5000,
+    sample_every: int = 100,
+    catalog_size: int = 2000,
+    distinct_requests: int = 300,
+    num_tracks: int = 5,
+    surplus: int = 2,
+    seed: int = 0,
+    on_sample: Optional[Callable[[Sample], None]] = None,
+) -> SoakReport:
+    """Take the same turns as cli.djgpt does, over and over against stand-ins, measuring as we go.
+
+    Each turn asks for tracks in the context of the session, records them and snapshots the session, then plays the
+    first one. Everything is configured as the CLI does by default, plus a response cache bounded as in the server.
+    """
+    tracks = synthetic_tracks(catalog_size)
+    rng = random.Random(seed)
+    djgpt = DJGPTPromptSystem(num_tracks=num_tracks + surplus)
+    djgpt.show_status = False
+    djgpt.chat_completion = LocalGPT(tracks, num_tracks=num_tracks + surplus).create
+    djgpt.response_cache = ResponseCache(maxsize=1024)
+    djgpt.semantic_cache = SemanticCache(maxsize=1024)
+    djgpt.history = get_history()
+    session = Session()
+
+    report = SoakReport(turns=turns)
+    previous_spotify = set_spotify(LocalSpotify(tracks))
+    quiet, CONSOLE.quiet = CONSOLE.quiet, True
+    try:
+        for turn in range(1, turns + 1):
+            request = rng.choice(PHRASINGS).format(f"situation {rng.randrange(distinct_requests)}")
+            start = time.perf_counter()
+            request_id = djgpt.history.record_request(request)
+            recommended = list(resolve_tracks(djgpt.ask(request, session=session), num_tracks))
+            session.record(request, recommended)
+            djgpt.history.record(RECOMMENDED, recommended, request_id)
+            save_snapshot(session)
+            if recommended:
+                djgpt.history.record(SELECTED, recommended[:1], request_id)
+                play_on_spotify(recommended[:1])
+            report.latencies.append(time.perf_counter() - start)
+
+            if turn % sample_every == 0:
+                gc.collect()
+                sample = Sample(
+                    turn=turn,
+                    metrics={
+                        "rss_mb": rss_bytes() / 2**20,
+                        "objects": len(gc.get_objects()),
+                        "tracks": count_instances(Track),
+                        "response_cache": len(djgpt.response_cache),
+                        "semantic_cache": len(djgpt.semantic_cache),
+                        "session_resolved": len(session.resolved),
+                        "debug_ring": len(RECENT.records),
+                        "history_events": len(djgpt.history),
+                        "catalog_tracks": len(get_catalog()),
+                    },
+                )
+                report.samples.append(sample)
+                if on_sample is not None:
+                    CONSOLE.quiet = quiet
+                    on_sample(sample)
+                    CONSOLE.quiet = True
+    finally:
+        CONSOLE.quiet = quiet
+        set_spotify(previous_spotify)
+
+    report.failures = growth_failures(
+        report,
+        bounds={
+            "response_cache": djgpt.response_cache.maxsize,
+            "semantic_cache": djgpt.semantic_cache.maxsize,
+            "session_resolved": session.max_resolved,
+        },
+    )
+    return report
+
+
+def summary_table(report: SoakReport) -> Table:
+    table = Table(title=f"DJGPT soak over {report.turns} turns")
+    table.add_column("Metric")
+    for column in ("First", "Min", "Max", "Last"):
+        table.add_column(column, justify="right")
+    for metric in report.samples[0].metrics:
+        values = report.series(metric)
+        table.add_row(
+            metric, *(f"{v:.1f}" for v in (values[0], min(values), max(values), values[-1]))
+        )
+    latencies = [1000 * latency for latency in report.latencies]
+    table.add_row(
+        "latency_ms",
+        *(f"{v:.2f}" for v in (latencies[0], min(latencies), max(latencies), latencies[-1])),
+    )
+    return table
+
+
+@app.command()
+def main(
+    turns: int = 5000,
+    sample_every: int = 100,
+    catalog_size: int = 2000,
+    distinct_requests: int = 300,
+    seed: int = 0,
+    output: Annotated[
+        Optional[Path], Option(help="Write every sample and turn latency as JSON for plotting")
+    ] = None,
+):
+    # Stand-in tracks must never end up in the real local catalog or history
+    os.environ["DJGPT_CACHE_DIR"] = tempfile.mkdtemp(prefix="djgpt-soak-")
+
+    def progress(sample: Sample):
+        CONSOLE.print(
+            f"turn {sample.turn:>6}: rss {sample.metrics['rss_mb']:.1f}MB, "
+            f"{sample.metrics['objects']:.0f} objects"
+        )
+
+    report = soak(
+        turns,
+        sample_every=sample_every,
+        catalog_size=catalog_size,
+        distinct_requests=distinct_requests,
+        seed=seed,
+        on_sample=progress,
+    )
+    if report.samples:
+        CONSOLE.print(summary_table(report))
+    if output:
+        output.write_text(json.dumps(report.to_dict(), indent=2))
+    for failure in report.failures:
+        CONSOLE.print(f"[bold red]FAIL: {failure}")
+    if report.failures:
+        raise typer.Exit(1)
+    CONSOLE.print("[bold green]Nothing grew without bound")
+
+
+if __name__ == "__main__":
+    app()
@@ -4,10 +4,18 @@ This module provides speech synthesis and recognition with fallbacks for differe
 """
 
 import platform
+import queue
+import threading
 import time
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextvars import copy_context
+from pathlib import Path
+from typing import Any, Callable, Optional, TypeVar
 
-from djgpt.utils import CONSOLE
+from djgpt.stt import STTChoice, choose_model
+from djgpt.utils import CONSOLE, cache_path, cancellable, debug, remaining
+
+T = TypeVar("T")
 
 # Import platform-specific text-to-speech modules
 SYSTEM = platform.system().lower()
@@ -44,9 +52,9 @@ if TTS_TYPE == "pyttsx3":
 
 
 def _wait_for_speech_to_finish():
-    """Wait for text-to-speech to finish"""
+    """Wait for text-to-speech to finish, or until the current deadline"""
     if TTS_TYPE == "macos" and TTS:
-        while TTS.isSpeaking():
+        while TTS.isSpeaking() and remaining() != 0:
             time.sleep(0.1)
     elif TTS_TYPE == "pyttsx3" and TTS:
         # pyttsx3's runAndWait() is blocking already, so nothing to do here
@@ -78,17 +86,205 @@ def say(text: str, wait: bool = False):
         TTS.runAndWait()
 
 
+class TypeAhead:
+    """Read keyboard input on a background thread, so the user can type a new request while we're still busy."""
+
+    def __init__(self, read: Callable[[], str] = input):
+        self.read = read
+        self.lines: "queue.Queue[Optional[str]]" = queue.Queue()
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def started(self) -> bool:
+        return self.thread is not None
+
+    def start(self) -> "TypeAhead":
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="djgpt-type-ahead", daemon=True)
+            self.thread.start()
+        return self
+
+    def run(self):
+        while True:
+            try:
+                line = self.read()
+            except Exception as e:
+                # EOF or the terminal went away, there's nothing more to read
+                debug("Stopped reading input: %r", e)
+                self.lines.put(None)
+                return
+            self.lines.put(line)
+
+    def get(self, timeout: Optional[float] = None) -> Optional[str]:
+        """Wait for the next line typed, None if input has finished."""
+        line = self.lines.get(timeout=timeout)
+        if line is None:
+            # Keep telling anyone else asking that input has finished
+            self.lines.put(None)
+        return line
+
+    def poll(self) -> Optional[str]:
+        """The next non-blank line if one has already been typed, without waiting."""
+        while True:
+            try:
+                line = self.lines.get_nowait()
+            except queue.Empty:
+                return None
+            if line is None:
+                self.lines.put(None)
+                return None
+            if line.strip():
+                return line
+
+
+# Shared by listen and interruptible once started, see cli.djgpt
+TYPE_AHEAD = TypeAhead()
+_WORK_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="djgpt-work")
+
+
+class Interrupted(Exception):
+    """Raised when the user gives up waiting, with whatever they asked for instead (None for Ctrl-C)."""
+
+    def __init__(self, request: Optional[str] = None):
+        self.request = request
+        super().__init__(request)
+
+
+def interruptible(func: Callable[..., T], *args, poll_interval: float = 0.05, **kwargs) -> T:
+    """Run some work in the background, giving up on it as soon as the user types something new or hits Ctrl-C.
+
+    Abandoned work is cancelled so it stops before making any more GPT or Spotify calls, but a call already in flight
+    can't be aborted and its answer is just ignored.
+    """
+    TYPE_AHEAD.start()
+    event = threading.Event()
+
+    def run() -> T:
+        with cancellable(event):
+            return func(*args, **kwargs)
+
+    future = _WORK_POOL.submit(copy_context().run, run)
+    try:
+        while not wait([future], timeout=poll_interval).done:
+            request = TYPE_AHEAD.poll()
+            if request is not None:
+                raise Interrupted(request)
+        return future.result()
+    except KeyboardInterrupt as e:
+        raise Interrupted() from e
+    finally:
+        if not future.done():
+            event.set()
+            future.cancel()
+
+
+# Whisper model to listen with, see use_voice, we only take keyboard input while there is none
+STT: Optional[STTChoice] = None
+_RECOGNIZER: Any = None
+
+
+# Something like what people ask for, spoken to calibrate speech recognition with
+CALIBRATION_REQUEST = (
+    "Play me some upbeat indie rock for a summer road trip, something like Arctic Monkeys or The Strokes, "
+    "and then maybe a few chilled out electronic tracks for when we get to the beach."
+)
+
+
+def spoken_clip() -> Optional[Path]:
+    """A recording of the speech synthesizer asking for some music, or None if there's no pyttsx3 to record it."""
+    path = cache_path("stt-clip.wav")
+    if not path.exists():
+        try:
+            import pyttsx3
+
+            engine = pyttsx3.init()
+            engine.setProperty("rate", 180)
+            engine.save_to_file(CALIBRATION_REQUEST, str(path))
+            engine.runAndWait()
+        except Exception as e:
+            debug("Failed to record a clip to calibrate speech recognition with: %r", e)
+            return None
+    return path if path.exists() and path.stat().st_size else None
+
+
+def use_voice(target_rtf: float = 0.5, clip: Optional[Path] = None, recalibrate: bool = False):
+    """Listen on the microphone with the most accurate Whisper model this machine can run fast enough.
+
+    The models are timed transcribing the clip given, otherwise a synthesized request for some music.
+    """
+    global STT
+    STT = choose_model(target_rtf, clip_path=clip or spoken_clip(), recalibrate=recalibrate)
+    try:
+        import torch
+
+        torch.set_num_threads(STT.threads)
+    except ImportError:
+        pass
+
+
+def try_speech_recognition() -> Optional[str]:
+    """Attempt to use speech recognition based on available libraries."""
+    global _RECOGNIZER
+    try:
+        from speech_recognition import Microphone, Recognizer
+    except ImportError:
+        return None
+
+    # The recognizer keeps the Whisper model loaded between requests
+    if _RECOGNIZER is None:
+        _RECOGNIZER = Recognizer()
+    try:
+        with CONSOLE.status("[bold green]Listening..."), Microphone() as source:
+            _RECOGNIZER.adjust_for_ambient_noise(source)
+            audio = _RECOGNIZER.listen(source, timeout=5, phrase_time_limit=5)
+    except Exception as e:
+        debug("Failed to listen: %r", e)
+        return None
+
+    # Try different recognition engines
+    try:
+        return _RECOGNIZER.recognize_whisper(
+            audio, language="english", model=STT.model, fp16=STT.fp16
+        )
+    except Exception as e:
+        debug("Whisper failed: %r", e)
+    try:
+        return _RECOGNIZER.recognize_google(audio)
+    except Exception as e:
+        debug("Google speech recognition failed: %r", e)
+    return None
+
+
 def listen() -> Optional[str]:
     """
     Get user input. Tries to use speech recognition if available,
     but falls back to keyboard input if speech recognition fails.
-    """
-    # First try to use speech recognition if it's available
 
-    # Always fall back to keyboard input for now
-    CONSOLE.print("[bold yellow]Microphone input disabled. Please type your request instead:[/]")
+    Once TYPE_AHEAD has been started, anything typed while we were busy is returned straight away.
+    """
+    # First try to use speech recognition if it's available, unless something was typed already
+    if STT is not None:
+        typed = TYPE_AHEAD.poll() if TYPE_AHEAD.started else None
+        if typed is not None:
+            return typed
+        spoken = try_speech_recognition()
+        if spoken and spoken.strip():
+            return spoken
+        CONSOLE.print(
+            "[bold yellow]Sorry, I didn't catch that. Please type your request instead:[/]"
+        )
+    else:
+        CONSOLE.print(
+            "[bold yellow]Microphone input disabled. Please type your request instead:[/]"
+        )
     try:
-        user_input = input("> ")
+        if TYPE_AHEAD.started:
+            CONSOLE.print("> ", end="")
+            user_input = TYPE_AHEAD.get()
+            if user_input is None:
+                return None
+        else:
+            user_input = input("> ")
         if user_input.strip() == "":
             return None
         return user_input
@@ -99,46 +295,6 @@ def listen() -> Optional[str]:
         return None
 
 
-# If you want to extend this in the future to use speech recognition:
-"""
-def try_speech_recognition() -> Optional[str]:
-    '''Attempt to use speech recognition based on available libraries.'''
-    try:
-        from speech_recognition import (
-            Recognizer, Microphone, UnknownValueError, RequestError, WaitTimeoutError
-        )
-        
-        recognizer = Recognizer()
-        mic = Microphone()
-        
-        with CONSOLE.status("[bold green]Listening...") as status:
-            with mic as source:
-                try:
-                    recognizer.adjust_for_ambient_noise(source)
-                    audio = recognizer.listen(source, timeout=5, phrase_time_limit=5)
-                    
-                    # Try different recognition engines
-                    try:
-                        text = recognizer.recognize_whisper(audio, language="english", model="base.en")
-                        return text
-                    except Exception:
-                        pass
-                    
-                    try:
-                        text = recognizer.recognize_google(audio)
-                        return text
-                    except Exception:
-                        pass
-                    
-                    return None
-                except Exception:
-                    return None
-    except ImportError:
-        return None
-    except Exception:
-        return None
-"""
-
 if __name__ == "__main__":
     # Simple test
     say("Testing cross-platform speech synthesis.")
@@ -3,18 +3,61 @@
 Module to deal with all the Spotify API interactions and functionality
 """
 
+import json
+import threading
 import time
-from dataclasses import dataclass
+import weakref
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from dataclasses import dataclass, field, fields
 from functools import cache
-from typing import Dict, List, NamedTuple, Optional
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
 import spotipy
 from spotipy import SpotifyException
+from spotipy.cache_handler import CacheFileHandler, CacheHandler
 
-from djgpt.utils import CONSOLE, debug, retry
+from djgpt.catalog import get_catalog, normalize, similarity, strip_extras
+from djgpt.history import PLAYED, get_history
+from djgpt.utils import (
+    CONSOLE,
+    Cancelled,
+    cache_path,
+    check_cancelled,
+    debug,
+    http_session,
+    remaining,
+    retry,
+)
 
-# Spotify globals
+# Spotify globals, S_DEVICE_ID being the device to play on for the CLI user, see select_device
 S_DEVICE_ID = S_CLIENT_ID = S_SECRET_ID = None
+# OAuth token (and its expiry) for the CLI user, restored from a snapshot or filled in when we authorize
+S_TOKEN_INFO: Optional[Dict] = None
+
+# Spotify API caller for whoever is being served right now, see use_spotify
+_CLIENT: ContextVar[Optional[spotipy.Spotify]] = ContextVar("djgpt_spotify", default=None)
+# Process wide replacement for the CLI user's API caller, see set_spotify
+_DEFAULT_CLIENT: Optional[spotipy.Spotify] = None
+
+# Threads for resolving candidate tracks concurrently, see resolve_tracks
+_RESOLVE_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="djgpt-resolve")
+# Threads for racing the query variants for a single track, see search_spotify
+_SEARCH_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="djgpt-search")
+
+# Search results to score per query, and how well one has to match to stop waiting on the others or be used at all
+SEARCH_LIMIT = 5
+CONFIDENT_MATCH = 0.9
+PLAUSIBLE_MATCH = 0.6
+
+# Seconds to trust the list of devices for, they rarely change between one turn and the next
+DEVICE_TTL = 30.0
+
+# Marker for a Track we haven't searched Spotify for yet, None means we searched and found nothing
+UNRESOLVED = object()
 
 
 class Spotify(NamedTuple):
@@ -41,32 +84,134 @@ class Track:
     reason: Optional[str] = None
     quality: Optional[float] = None
     error: Optional[str] = None
+    _spotify: Any = field(default=UNRESOLVED, init=False, repr=False, compare=False)
+
+    @property
+    def resolved(self) -> bool:
+        return self._spotify is not UNRESOLVED
 
     @property
     def spotify(self) -> Optional[Spotify]:
-        return search_spotify(self.artist, self.trackname)
+        """Search Spotify for the track, only the first time we are asked."""
+        if self._spotify is UNRESOLVED:
+            self._spotify = search_spotify(self.artist, self.trackname)
+        return self._spotify
+
+    @spotify.setter
+    def spotify(self, value: Optional[Spotify]):
+        self._spotify = value
+
+    def to_dict(self) -> Dict:
+        """Everything about the track as plain JSON, the Spotify result without the full stash."""
+        track = {f.name: getattr(self, f.name) for f in fields(self) if f.init}
+        if self.resolved:
+            track["spotify"] = (
+                {"url": self._spotify.url, "uri": self._spotify.uri} if self._spotify else None
+            )
+        return track
+
+    @classmethod
+    def from_dict(cls, track: Dict) -> "Track":
+        spotify = track.get("spotify", UNRESOLVED)
+        self = cls(**{k: v for k, v in track.items() if k != "spotify"})
+        if spotify is not UNRESOLVED:
+            self.spotify = Spotify(stash={}, **spotify) if spotify else None
+        return self
+
+
+def get_spotify() -> spotipy.Spotify:
+    """Get the spotify API caller.
+
+    This is the client set with use_spotify if there is one, then any set with set_spotify, otherwise the cached
+    client for the CLI user.
+    """
+    client = _CLIENT.get() or _DEFAULT_CLIENT
+    if client is not None:
+        return client
+    return _cli_spotify()
+
+
+def set_spotify(client: Optional[spotipy.Spotify]) -> Optional[spotipy.Spotify]:
+    """Replace the API caller for every thread, returning the previous replacement so it can be put back."""
+    global _DEFAULT_CLIENT
+    previous, _DEFAULT_CLIENT = _DEFAULT_CLIENT, client
+    return previous
+
+
+@contextmanager
+def use_spotify(client: spotipy.Spotify) -> Iterator[spotipy.Spotify]:
+    """Use a specific Spotify API caller for everything within the block, e.g. per user in the server."""
+    token = _CLIENT.set(client)
+    try:
+        yield client
+    finally:
+        _CLIENT.reset(token)
+
+
+class TokenInfoCacheHandler(CacheHandler):
+    """Keep the CLI user's token in S_TOKEN_INFO, so it gets snapshotted, as well as spotipy's usual cache file."""
+
+    def __init__(self):
+        self.file = CacheFileHandler()
+
+    def get_cached_token(self) -> Optional[Dict]:
+        return S_TOKEN_INFO or self.file.get_cached_token()
+
+    def save_token_to_cache(self, token_info: Dict):
+        global S_TOKEN_INFO
+        S_TOKEN_INFO = token_info
+        # Only logs a warning if it can't be written, we still have the token in memory
+        self.file.save_token_to_cache(token_info)
 
 
 @cache
-def get_spotify():
+def _cli_spotify() -> spotipy.Spotify:
     """Get the cached spotify API caller.
 
     On first ever use you will be asked to authorize the app use against your Spotify account (say yes in the browser)
-    you wont get asked ever again.
+    you wont get asked ever again. The token, restored from a snapshot or not, is refreshed whenever it expires.
     """
     # TODO: work out if we can avoid these globals in a nice way with Typer
-    global S_CLIENT_ID, S_SECRET_ID
-    oauth = spotipy.SpotifyOAuth(
-        client_id=S_CLIENT_ID,
-        client_secret=S_SECRET_ID,
+    oauth = spotify_oauth(
+        S_CLIENT_ID, S_SECRET_ID, show_dialog=True, cache_handler=TokenInfoCacheHandler()
+    )
+    # Authorize now, rather than part way through the first search
+    oauth.get_access_token(as_dict=False)
+    return spotify_client(auth_manager=oauth)
+
+
+def spotify_oauth(
+    client_id: Optional[str],
+    client_secret: Optional[str],
+    show_dialog: bool = False,
+    cache_handler: Optional[CacheHandler] = None,
+) -> spotipy.SpotifyOAuth:
+    return spotipy.SpotifyOAuth(
+        client_id=client_id,
+        client_secret=client_secret,
         redirect_uri="https://localhost:8888/callback",
         scope="user-read-playback-state user-modify-playback-state",
-        show_dialog=True,
+        show_dialog=show_dialog,
+        cache_handler=cache_handler,
     )
-    # Create/get cached token for a session with the API
-    token = oauth.get_access_token(as_dict=False)
 
-    return spotipy.Spotify(auth=token)
+
+def spotify_client(
+    access_token: Optional[str] = None,
+    auth_manager: Optional[spotipy.SpotifyOAuth] = None,
+    requests_timeout: float = 10.0,
+) -> spotipy.Spotify:
+    """Make a Spotify API caller sharing the pooled HTTP connections with everything else.
+
+    Either for an access token as is, or an auth manager that refreshes its token as needed. Every request times out
+    after requests_timeout seconds, or sooner if the current deadline is closer.
+    """
+    return spotipy.Spotify(
+        auth=access_token,
+        auth_manager=auth_manager,
+        requests_session=http_session(),
+        requests_timeout=requests_timeout,
+    )
 
 
 def wait_for_spotify():
@@ -91,30 +236,284 @@ def wait_for_spotify():
     return Track(trackname=track_name, artist=artist_name)
 
 
-def search_spotify(artist: str, trackname: str) -> Optional[Spotify]:
-    """Search Spotify using an artist and track name, get back an exteranl URL"""
+def search_queries(artist: str, trackname: str) -> List[str]:
+    """Ways of asking Spotify for a track, from the strictest to the loosest."""
+    queries = [f"artist:{artist} track:{trackname}", f"{artist} {trackname}"]
+    stripped_artist, stripped_track = strip_extras(artist), strip_extras(trackname)
+    if (stripped_artist, stripped_track) != (artist, trackname):
+        queries.append(f"artist:{stripped_artist} track:{stripped_track}")
+    return queries
+
+
+def match_score(artist: str, trackname: str, item: Dict) -> float:
+    """How close a Spotify track item is to the one asked for, both the artist and the track have to be close."""
+    norm_artist = normalize(artist)
+    by = max(
+        (similarity(norm_artist, normalize(a["name"])) for a in item.get("artists") or []),
+        default=0.0,
+    )
+    return min(by, similarity(normalize(trackname), normalize(item.get("name") or "")))
+
+
+def _search(client: spotipy.Spotify, query: str) -> Optional[Dict]:
+    try:
+        return client.search(query, limit=SEARCH_LIMIT, offset=0, type="track")
+    except Cancelled:
+        raise
+    except Exception as e:
+        debug("Spotify search for %s failed: %s", query, e)
+        return None
+
+
+def search_spotify(
+    artist: str, trackname: str, client: Optional[spotipy.Spotify] = None
+) -> Optional[Spotify]:
+    """Search Spotify using an artist and track name, get back an exteranl URL
+
+    A few variants of the query race each other, strict filters, loose free text and with any featured artists or
+    remaster suffix stripped, so GPT's formatting quirks don't lose us the track. Results are scored against what was
+    asked for and the first confident match wins, otherwise the best plausible one, otherwise the strict query's top
+    result as we'd always trusted that.
+
+    Pass a client to search with something other than the global Spotify API caller, such as a local stand-in.
+    Searches against the real Spotify go through the local catalog first, and any plausible match found is added to
+    it.
+    """
+    if client is None:
+        local = get_catalog().lookup(artist, trackname)
+        if local is not None:
+            url, uri, item = local
+            return Spotify(url, uri, {"tracks": {"items": [item]}})
+
+    check_cancelled()
+    searcher = client or get_spotify()
+    queries = search_queries(artist, trackname)
+    pending = {
+        _SEARCH_POOL.submit(copy_context().run, _search, searcher, query): query
+        for query in queries
+    }
+    best, best_score, fallback = None, PLAUSIBLE_MATCH, None
+    try:
+        while pending and best_score < CONFIDENT_MATCH:
+            done, _ = wait(pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                debug("Out of time searching for %s - %s", artist, trackname)
+                break
+            for future in done:
+                query = pending.pop(future)
+                results = future.result()
+                items = ((results or {}).get("tracks") or {}).get("items") or []
+                if items and query == queries[0]:
+                    fallback = (items[0], results)
+                for item in items:
+                    score = match_score(artist, trackname, item)
+                    if score >= best_score:
+                        best, best_score = (item, results), score
+    finally:
+        for future in pending:
+            future.cancel()
+
+    best = best or fallback
+    if best is None:
+        return None
+    item, results = best
+    score = match_score(artist, trackname, item)
+    debug("Found %s - %s scoring %.2f", artist, trackname, score)
+    # A poor strict match is still worth trying this once, but not reusing for whatever else is spelt like it
+    if client is None and score >= PLAUSIBLE_MATCH:
+        get_catalog().add(artist, trackname, item)
+    return Spotify(item["external_urls"]["spotify"], item["uri"], results)
+
+
+def resolve_tracks(tracks: Iterable[Track], wanted: int) -> Iterator[Track]:
+    """Lazily resolve candidate tracks best quality first, yielding the playable ones until we have enough.
+
+    Searches run concurrently, but only as many are in flight as could still be needed if they all succeed, so we
+    never make more Spotify calls than wanted plus however many candidates turned out to be hallucinated. Tracks are
+    yielded in quality order, and anything still pending when the caller stops iterating is cancelled. If the deadline
+    passes we stop with whatever was found in time.
+    """
+    candidates = deque(
+        sorted(tracks, key=lambda t: t.quality if t.quality is not None else -1, reverse=True)
+    )
+    in_flight: Deque[Tuple[Track, Optional[Future]]] = deque()
+    found = 0
     try:
-        search_results = get_spotify().search(
-            f"artist:{artist} track:{trackname}", limit=1, offset=0, type="track"
+        while found < wanted and (candidates or in_flight):
+            while candidates and found + len(in_flight) < wanted:
+                track = candidates.popleft()
+                # Already resolved tracks, e.g. reused from the session, don't need searching again
+                future = (
+                    None
+                    if track.resolved
+                    else _RESOLVE_POOL.submit(copy_context().run, lambda t=track: t.spotify)
+                )
+                in_flight.append((track, future))
+
+            track, future = in_flight.popleft()
+            if future is not None:
+                try:
+                    future.result(timeout=remaining())
+                except (Cancelled, FutureTimeoutError):
+                    debug("Out of time resolving tracks, stopping with %d", found)
+                    in_flight.appendleft((track, future))
+                    return
+            if track.spotify is not None:
+                found += 1
+                yield track
+    finally:
+        for _, future in in_flight:
+            if future is not None:
+                future.cancel()
+
+
+class Devices:
+    """The Spotify Connect devices of each API caller, cached for a short while.
+
+    Looking them up costs a round trip to Spotify on every play otherwise, and the answer is nearly always the same.
+    """
+
+    def __init__(self, ttl: float = DEVICE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # Keyed weakly so server users' clients are forgotten along with them
+        self.cached: "weakref.WeakKeyDictionary[Any, Tuple[float, List[Dict]]]" = (
+            weakref.WeakKeyDictionary()
         )
-        if not search_results:
-            return None
 
-        track = search_results["tracks"]["items"][0]
-        url = track["external_urls"]["spotify"]
-        uri = track["uri"]
+    def get(self, client: spotipy.Spotify) -> List[Dict]:
+        with self.lock:
+            at, devices = self.cached.get(client, (0.0, None))
+        if devices is not None and time.monotonic() - at < self.ttl:
+            return devices
+        devices = list((client.devices() or {}).get("devices") or [])
+        with self.lock:
+            self.cached[client] = (time.monotonic(), devices)
+        return devices
 
-        return Spotify(url, uri, search_results)
+    def activate(self, client: spotipy.Spotify, device_id: str):
+        """Note that playback moved to a device, without asking Spotify again."""
+        with self.lock:
+            at, devices = self.cached.get(client, (0.0, []))
+            devices = [{**d, "is_active": d["id"] == device_id} for d in devices]
+            self.cached[client] = (at, devices)
 
-    except Exception as e:
-        debug(e)
+    def forget(self, client: spotipy.Spotify):
+        with self.lock:
+            self.cached.pop(client, None)
+
+
+DEVICES = Devices()
+
+
+def device_path():
+    return cache_path("device.json")
+
+
+@cache
+def _persisted_device() -> Optional[Dict]:
+    try:
+        with device_path().open() as f:
+            return json.load(f)
+    except (OSError, ValueError):
         return None
 
 
-@retry(
-    exception_class=SpotifyException,
-    prompt="Try again with Spotify? (If the error is 'No active device found' just press play/pause in Spotify)",
-    none_is_fail=False,
-)
+def preferred_device() -> Optional[Dict]:
+    """The device the CLI user wants to play on, with its name too if we know it as ids can change."""
+    persisted = _persisted_device()
+    if S_DEVICE_ID is None:
+        return persisted
+    if persisted is not None and persisted.get("id") == S_DEVICE_ID:
+        return persisted
+    return {"id": S_DEVICE_ID}
+
+
+def select_device(name_or_id: str, client: Optional[spotipy.Spotify] = None) -> Optional[Dict]:
+    """Pick a device to play on by its id or name, remembering it for next time."""
+    global S_DEVICE_ID
+    devices = DEVICES.get(client or get_spotify())
+    wanted = name_or_id.lower()
+    device = next((d for d in devices if d["id"] == name_or_id), None) or next(
+        (d for d in devices if wanted in d["name"].lower()), None
+    )
+    if device is None:
+        CONSOLE.log(
+            f"[bold red]No Spotify device called {name_or_id}, try one of: "
+            + ", ".join(d["name"] for d in devices)
+        )
+        return None
+
+    S_DEVICE_ID = device["id"]
+    path = device_path()
+    with path.open("w") as f:
+        json.dump({"id": device["id"], "name": device["name"]}, f)
+    _persisted_device.cache_clear()
+    return device
+
+
+def choose_device(devices: List[Dict], preferred: Optional[Dict] = None) -> Optional[Dict]:
+    """The preferred device if it is around, otherwise whichever is active, otherwise the first we can control."""
+    usable = [d for d in devices if not d.get("is_restricted")]
+    if preferred is not None:
+        for key in ("id", "name"):
+            match = next((d for d in usable if d.get(key) == preferred.get(key)), None)
+            if match is not None and preferred.get(key) is not None:
+                return match
+    return next((d for d in usable if d.get("is_active")), None) or next(iter(usable), None)
+
+
+def ready_device(
+    client: Optional[spotipy.Spotify] = None,
+    preferred: Optional[Callable[[], Optional[Dict]]] = preferred_device,
+) -> Optional[str]:
+    """The id of the device to play on, transferring playback to it first if it isn't already active.
+
+    The CLI user's preferred device is only for the CLI user, pass preferred=None for anyone else, e.g. users of the
+    server, to go by their own active device. None when there are no devices at all, for Spotify to pick one itself if
+    it can.
+    """
+    client = client or get_spotify()
+    device = choose_device(DEVICES.get(client), preferred() if preferred is not None else None)
+    if device is None:
+        return None
+    if not device.get("is_active"):
+        debug("Transferring playback to %s", device["name"])
+        client.transfer_playback(device["id"], force_play=False)
+        DEVICES.activate(client, device["id"])
+    return device["id"]
+
+
+@retry(exception_class=SpotifyException, num_attempts=2, none_is_fail=False)
 def play_on_spotify(tracks: List[Track]):
-    get_spotify().start_playback(uris=[t.spotify.uri for t in tracks if t.spotify])
+    """Play the tracks on the device we want, moving playback there beforehand rather than failing after.
+
+    If Spotify still can't play, what we knew about the devices is probably stale, so we look again and have one more
+    go rather than waiting on the user.
+    """
+    tracks = [t for t in tracks if t.spotify]
+    client = get_spotify()
+    try:
+        client.start_playback(device_id=ready_device(client), uris=[t.spotify.uri for t in tracks])
+    except SpotifyException as e:
+        DEVICES.forget(client)
+        CONSOLE.log(f"[bold red]Spotify failed to play: {e.msg}")
+        raise
+    get_history().record(PLAYED, tracks)
+
+
+def start_on_spotify(track: Track):
+    """Start playing a track right away, on the device we want.
+
+    It isn't recorded as played, as the PlayQueue only records what it sees playing.
+    """
+    client = get_spotify()
+    client.start_playback(device_id=ready_device(client), uris=[track.spotify.uri])
+
+
+def queue_on_spotify(track: Track):
+    """Add a track to the end of Spotify's own play queue, without interrupting what is playing.
+
+    It isn't recorded as played, as it may well be skipped or never reached.
+    """
+    get_spotify().add_to_queue(track.spotify.uri)
@@ -0,0 +1,174 @@
+"""DJ GPT CLI
+
+Local stand-ins for the external services so we can evaluate, benchmark and test without the network
+"""
+
+import hashlib
+import json
+import re
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from djgpt.prompt import PromptTestCase
+
+# Spotify search filters we understand, e.g. 'artist:Daft Punk track:One More Time'
+SEARCH_FILTER = re.compile(r"(artist|track):(.*?)(?=\s+(?:artist|track):|$)")
+
+
+class LocalSpotify:
+    """A tiny in-memory stand-in for the spotipy.Spotify client.
+
+    Only knows about the tracks it is given, and answers searches in the same shape as the real API.
+    """
+
+    def __init__(self, tracks: Iterable[Tuple[str, str]] = (), latency: float = 0.0):
+        self.latency = latency
+        self.catalog: Dict[Tuple[str, str], Dict] = {}
+        self.device_list: List[Dict] = [
+            {"id": "local", "name": "Local Speaker", "is_active": True, "is_restricted": False}
+        ]
+        self.device_id: Optional[str] = None
+        for artist, trackname in tracks:
+            self.add(artist, trackname)
+
+    @classmethod
+    def from_test_cases(cls, cases: Iterable[PromptTestCase], **kwargs) -> "LocalSpotify":
+        """Build a catalog out of the tracks GPT expected to be produced for some test cases."""
+        return cls(
+            ((t["artist"], t["trackname"]) for case in cases for t in _tracks_in(case.output)),
+            **kwargs,
+        )
+
+    def add(self, artist: str, trackname: str) -> Dict:
+        """Add a track to the catalog, returning the Spotify shaped item for it."""
+        key = (artist.lower(), trackname.lower())
+        if key not in self.catalog:
+            track_id = hashlib.sha1(f"{key[0]}\0{key[1]}".encode()).hexdigest()[:22]
+            self.catalog[key] = {
+                "id": track_id,
+                "name": trackname,
+                "artists": [{"name": artist}],
+                "external_urls": {"spotify": f"https://open.spotify.com/track/{track_id}"},
+                "uri": f"spotify:track:{track_id}",
+            }
+        return self.catalog[key]
+
+    def search(self, q: str, limit: int = 10, offset: int = 0, type: str = "track") -> Dict:
+        if self.latency:
+            time.sleep(self.latency)
+        filters = {field: value.strip().lower() for field, value in SEARCH_FILTER.findall(q)}
+        words = SEARCH_FILTER.sub("", q).lower().split()
+        items = [
+            item
+            for (artist, trackname), item in self.catalog.items()
+            if filters.get("artist", artist) in artist
+            and filters.get("track", trackname) in trackname
+            and all(word in f"{artist} {trackname}" for word in words)
+        ]
+        return {"tracks": {"items": items[offset : offset + limit], "total": len(items)}}
+
+    def start_playback(
+        self, device_id: Optional[str] = None, uris: Optional[List[str]] = None, **kwargs
+    ):
+        if self.latency:
+            time.sleep(self.latency)
+        self.device_id = device_id
+        self.playing = list(uris or [])
+
+    def devices(self) -> Dict:
+        return {"devices": [dict(d) for d in self.device_list]}
+
+    def transfer_playback(self, device_id: str, force_play: bool = True):
+        for device in self.device_list:
+            device["is_active"] = device["id"] == device_id
+
+    def current_playback(self) -> Optional[Dict]:
+        return None
+
+
+class LocalGPT:
+    """A stand-in for openai.ChatCompletion.create that recommends tracks from a catalog.
+
+    The same user request always gets the same tracks, and the usage is a rough chars/4 token estimate.
+    """
+
+    def __init__(
+        self, tracks: Sequence[Tuple[str, str]], num_tracks: int = 5, latency: float = 0.0
+    ):
+        self.tracks = list(tracks)
+        self.num_tracks = num_tracks
+        self.latency = latency
+
+    def recommend(self, request: str) -> List[Dict]:
+        seed = int(hashlib.sha1(request.encode()).hexdigest()[:8], 16)
+        return [
+            {
+                "artist": artist,
+                "trackname": trackname,
+                "genre": "stand-in",
+                "reason": f"Picked for {request[:40]}",
+                "quality": 0.5,
+            }
+            for artist, trackname in (
+                self.tracks[(seed + i) % len(self.tracks)] for i in range(self.num_tracks)
+            )
+        ]
+
+    def arguments(self, parameters: Dict, request: str) -> Dict:
+        """Answer in the first array of the function parameters, as GPT would when made to call it.
+
+        Parameters that are objects themselves are a pack of keyed requests, each answered on its own.
+        """
+        properties = parameters["properties"]
+        if properties and all(schema.get("type") == "object" for schema in properties.values()):
+            requests = json.loads(request)
+            return {key: self.arguments(properties[key], requests[key]) for key in properties}
+        key = next(name for name, schema in properties.items() if schema.get("type") == "array")
+        return {key: self.recommend(request)}
+
+    def create(self, model: str, messages: List[Dict], **kwargs) -> Dict:
+        if self.latency:
+            time.sleep(self.latency)
+        request = messages[-1]["content"]
+        message = {"role": "assistant", "content": json.dumps(self.recommend(request))}
+        if kwargs.get("functions"):
+            function = kwargs["functions"][0]
+            message = {
+                "role": "assistant",
+                "content": None,
+                "function_call": {
+                    "name": function["name"],
+                    "arguments": json.dumps(self.arguments(function["parameters"], request)),
+                },
+            }
+        content = message["content"] or message["function_call"]["arguments"]
+        prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+        return {
+            "model": model,
+            "choices": [{"message": message}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(content) // 4,
+                "total_tokens": prompt_tokens + len(content) // 4,
+            },
+        }
+
+
+def synthetic_tracks(size: int) -> List[Tuple[str, str]]:
+    """Make up a catalog of artist/track names for load and soak testing."""
+    return [(f"Artist {n // 10}", f"Track {n}") for n in range(size)]
+
+
+def _tracks_in(output: Union[List, Dict, None]) -> List[Dict]:
+    """Pull anything that looks like a track out of whatever JSON GPT thought the output should be."""
+    if isinstance(output, dict):
+        output = output["tracks"] if isinstance(output.get("tracks"), list) else [output]
+    if not isinstance(output, list):
+        return []
+    return [
+        t
+        for t in output
+        if isinstance(t, dict)
+        and isinstance(t.get("artist"), str)
+        and isinstance(t.get("trackname"), str)
+    ]
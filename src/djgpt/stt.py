@@ -0,0 +1,180 @@
+"""DJ GPT CLI
+
+Module to pick the Whisper speech to text model for this machine, the most accurate one that is still fast enough
+"""
+
+import json
+import os
+import platform
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from djgpt.utils import CONSOLE, cache_path, debug
+
+# Whisper models most accurate first, the English only ones being better at English for their size
+MODELS = ("medium.en", "small.en", "base.en", "tiny.en")
+SAMPLE_RATE = 16000
+
+# Transcribe some audio with a model, a number of threads and whether to use half precision
+Transcribe = Callable[[str, np.ndarray, int, bool], str]
+
+
+@dataclass
+class STTChoice:
+    """The Whisper model and settings to use, and the real-time factor it was measured at."""
+
+    model: str
+    threads: int
+    fp16: bool
+    rtf: float
+
+
+def synthetic_clip(seconds: float = 5.0) -> np.ndarray:
+    """A speech-like clip of harmonics with syllable-rate amplitude modulation and a little noise.
+
+    It won't transcribe to anything sensible, and as Whisper's decoding time depends on the tokens it emits, which on
+    anything but speech may be next to none or run away, timings on it are only a rough guide. Only used when there's
+    no real speech to calibrate on.
+    """
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    pitch = 140 + 30 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / SAMPLE_RATE
+    voice = sum(np.sin(k * phase) / k for k in range(1, 6))
+    syllables = 0.5 * (1 + np.sin(2 * np.pi * 4 * t))
+    noise = np.random.default_rng(0).normal(0, 0.02, t.shape)
+    return (0.3 * voice * syllables + noise).astype(np.float32)
+
+
+def thread_settings() -> Tuple[int, ...]:
+    """All the cores, and half of them as hyperthreads rarely help."""
+    cores = os.cpu_count() or 1
+    return tuple(sorted({cores, max(1, cores // 2)}, reverse=True))
+
+
+def _gpu() -> bool:
+    try:
+        import torch
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
+
+
+_MODELS: Dict[str, object] = {}
+
+
+def whisper_transcribe(model: str, audio: np.ndarray, threads: int, fp16: bool) -> str:
+    import torch
+    import whisper
+
+    torch.set_num_threads(threads)
+    if model not in _MODELS:
+        _MODELS[model] = whisper.load_model(model, device="cuda" if fp16 else "cpu")
+    return _MODELS[model].transcribe(audio, language="en", fp16=fp16)["text"]
+
+
+def calibrate(
+    target_rtf: float = 0.5,
+    clip: Optional[np.ndarray] = None,
+    models: Sequence[str] = MODELS,
+    transcribe: Transcribe = whisper_transcribe,
+) -> STTChoice:
+    """Time transcribing a clip with each model and setting, fastest first, stopping at the first too slow.
+
+    The real-time factor is seconds taken per second of audio. Bigger models are only ever slower, so once one is too
+    slow there's no point waiting on the rest, which on a small machine could take minutes. The most accurate model
+    within target_rtf is used, or if none is, the fastest.
+    """
+    clip = synthetic_clip() if clip is None else clip
+    duration = len(clip) / SAMPLE_RATE
+    fp16 = _gpu()
+    chosen: Optional[STTChoice] = None
+    for model in reversed(models):
+        best: Optional[STTChoice] = None
+        for threads in thread_settings():
+            # Warm up first so loading the model and first-call overheads aren't counted
+            transcribe(model, clip[:SAMPLE_RATE], threads, fp16)
+            start = time.perf_counter()
+            transcribe(model, clip, threads, fp16)
+            rtf = (time.perf_counter() - start) / duration
+            debug("Whisper %s with %d threads ran at %.2fx real time", model, threads, rtf)
+            if best is None or rtf < best.rtf:
+                best = STTChoice(model=model, threads=threads, fp16=fp16, rtf=rtf)
+        if best.rtf > target_rtf:
+            if chosen is None:
+                chosen = best
+                CONSOLE.log(
+                    f"[bold yellow]No speech model is fast enough here, using {best.model} at "
+                    f"{best.rtf:.2f}x real time"
+                )
+            break
+        chosen = best
+    return chosen
+
+
+def machine_key(target_rtf: float, models: Sequence[str]) -> str:
+    """What the choice depends on, so a different machine, upgrade or target calibrates again."""
+    return json.dumps(
+        [
+            platform.machine(),
+            platform.processor(),
+            os.cpu_count(),
+            platform.python_version(),
+            target_rtf,
+            list(models),
+        ]
+    )
+
+
+def stt_path() -> Path:
+    return cache_path("stt.json")
+
+
+def choose_model(
+    target_rtf: float = 0.5,
+    clip_path: Optional[Path] = None,
+    models: Sequence[str] = MODELS,
+    recalibrate: bool = False,
+    transcribe: Transcribe = whisper_transcribe,
+) -> STTChoice:
+    """The speech to text model for this machine, calibrated once and then cached in the DJGPT cache directory.
+
+    Calibrates against clip_path if given and ffmpeg can load it, otherwise a synthetic clip that makes for a less
+    reliable choice.
+    """
+    path = stt_path()
+    key = machine_key(target_rtf, models)
+    try:
+        cached = json.loads(path.read_text())
+    except (OSError, ValueError):
+        cached = {}
+    if not recalibrate and key in cached:
+        return STTChoice(**cached[key])
+
+    clip = None
+    if clip_path is not None:
+        try:
+            import whisper
+
+            clip = whisper.load_audio(str(clip_path))
+        except Exception as e:
+            # Loading shells out to ffmpeg, which may well not be installed
+            CONSOLE.log(
+                f"[bold red]Failed to load {clip_path} to calibrate speech recognition on: {e}"
+            )
+    if clip is None:
+        CONSOLE.log(
+            "[bold yellow]Calibrating speech recognition without any real speech, so the model chosen may be too slow "
+            "or needlessly inaccurate. Pass --stt-clip a recording of yourself asking for some music to be sure."
+        )
+    with CONSOLE.status("[bold green]Finding the best speech model for this machine..."):
+        choice = calibrate(target_rtf, clip=clip, models=models, transcribe=transcribe)
+    # The speech recognizer loads its own copy of the chosen model, so don't hang on to any of them
+    _MODELS.clear()
+    CONSOLE.log(f"[bold green]Using Whisper {choice.model} at {choice.rtf:.2f}x real time")
+    cached[key] = asdict(choice)
+    path.write_text(json.dumps(cached, indent=2))
+    return choice
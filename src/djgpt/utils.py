@@ -1,23 +1,320 @@
+import atexit
+import json
+import logging
+import queue
+import threading
 import time
-from functools import wraps
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import cache, wraps
+from logging.handlers import QueueHandler, QueueListener
 from os import getenv
-from typing import Callable, Optional, Type
+from pathlib import Path
+from typing import Callable, Deque, Iterator, List, Optional, Tuple, Type, Union
 
+import requests
 from dotenv import find_dotenv, load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
 
 load_dotenv(find_dotenv(usecwd=True))
 
 from rich.console import Console  # noqa: E402
+from rich.logging import RichHandler  # noqa: E402
 from rich.prompt import Confirm  # noqa: E402
 
 CONSOLE = Console()
 LOGLEVEL = getenv("LOGLEVEL", "INFO")
+# Write log lines as JSON objects to stderr instead of through Rich
+LOGJSON = getenv("LOGJSON", "").lower() in ("1", "true", "yes")
+# How many recent debug events to keep around for dumping on error, 0 makes debug() completely free when not logged
+DEBUG_RING = int(getenv("DJGPT_DEBUG_RING", "0"))
 
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+LOGGER = logging.getLogger("djgpt")
 
-def debug(whatever: object):
-    """Hacky debug level print."""
-    if LOGLEVEL == "DEBUG" or LOGLEVEL == "TRACE":
-        CONSOLE.log(whatever)
+
+def cache_path(name: str) -> Path:
+    """Path to a file in the DJGPT cache directory (DJGPT_CACHE_DIR or ~/.cache/djgpt), creating the directory."""
+    cache_dir = Path(getenv("DJGPT_CACHE_DIR") or Path.home() / ".cache" / "djgpt")
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir / name
+
+
+class DeadlineSession(requests.Session):
+    """A requests session that cuts every request's timeout down to whatever is left of the current deadline."""
+
+    def request(self, method, url, *args, **kwargs):
+        check_cancelled()
+        kwargs["timeout"] = call_timeout(kwargs.get("timeout"))
+        try:
+            return super().request(method, url, *args, **kwargs)
+        except requests.Timeout:
+            # Running out of the overall budget isn't the same as one slow call
+            check_cancelled()
+            raise
+
+
+class DeadlineRetry(Retry):
+    """Retries that never wait past the current deadline.
+
+    A rate limit asking us to come back after the deadline is given up on straight away, handing back its response,
+    and backoff sleeps are cut down to what's left.
+    """
+
+    def increment(
+        self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None
+    ):
+        retries = super().increment(method, url, response, error, _pool, _stacktrace)
+        left = remaining()
+        if left is not None and response is not None:
+            retry_after = (
+                retries.get_retry_after(response) if self.respect_retry_after_header else None
+            )
+            wait = retries.get_backoff_time() if retry_after is None else retry_after
+            if wait >= left:
+                debug(
+                    "Not retrying %s %s, it would take %.1fs with %.1fs left",
+                    method,
+                    url,
+                    wait,
+                    left,
+                )
+                raise MaxRetryError(
+                    _pool, url, ResponseError(f"retry after {wait:.1f}s is past the deadline")
+                )
+        return retries
+
+    def sleep(self, response=None):
+        left = remaining()
+        if left is None:
+            return super().sleep(response)
+        retry_after = (
+            self.get_retry_after(response) if response and self.respect_retry_after_header else None
+        )
+        wait = self.get_backoff_time() if retry_after is None else retry_after
+        time.sleep(min(wait, left))
+
+
+@cache
+def http_session(pool_size: int = 32) -> requests.Session:
+    """A requests session with a connection pool, shared by every API caller so connections get reused.
+
+    Rate limits and server errors are retried as spotipy's own session would, honouring any Retry-After that comes
+    before the current deadline.
+    """
+    session = DeadlineSession()
+    retries = DeadlineRetry(
+        total=3,
+        connect=None,
+        read=False,
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+        respect_retry_after_header=True,
+        # Hand the last response back so the API client can raise its own error for it
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class RingBufferHandler(logging.Handler):
+    """Keep the last few log records around unformatted, to dump when something goes wrong."""
+
+    def __init__(self, capacity: int):
+        super().__init__(logging.NOTSET)
+        self.records: Deque[logging.LogRecord] = deque(maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord):
+        self.records.append(record)
+
+
+class LazyQueueHandler(QueueHandler):
+    """Queue records as they are, so formatting happens on the listener thread rather than the caller's."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, including any structured fields passed to debug()."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+RECENT = RingBufferHandler(DEBUG_RING)
+_LISTENER: Optional[QueueListener] = None
+
+
+def configure_logging(
+    level: str = LOGLEVEL, json_output: bool = LOGJSON, ring_size: int = DEBUG_RING
+):
+    """Set up the djgpt logger.
+
+    Output is handed off to a background thread through a queue, either to the Rich console or as JSON lines to
+    stderr. Optionally a ring buffer of recent debug events is kept (see dump_recent).
+    """
+    global _LISTENER, RECENT
+    if _LISTENER is not None:
+        _LISTENER.stop()
+    for handler in list(LOGGER.handlers):
+        LOGGER.removeHandler(handler)
+
+    level = logging.getLevelName(level.upper())
+    if not isinstance(level, int):
+        level = logging.INFO
+    if json_output:
+        output = logging.StreamHandler()
+        output.setFormatter(JSONFormatter())
+    else:
+        output = RichHandler(console=CONSOLE, show_path=False)
+    output.setLevel(level)
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    queued = LazyQueueHandler(records)
+    queued.setLevel(level)
+    LOGGER.addHandler(queued)
+    _LISTENER = QueueListener(records, output, respect_handler_level=True)
+    _LISTENER.start()
+
+    RECENT = RingBufferHandler(ring_size)
+    if ring_size:
+        LOGGER.addHandler(RECENT)
+        level = min(level, logging.DEBUG)
+    LOGGER.setLevel(level)
+
+
+def flush_logging(restart: bool = True):
+    """Wait for everything queued so far to be written out."""
+    if _LISTENER is not None and _LISTENER._thread is not None:
+        _LISTENER.stop()
+        if restart:
+            _LISTENER.start()
+
+
+def debug(msg: object, *args, **fields):
+    """Debug level logging that costs next to nothing unless someone is listening.
+
+    Use %-style args rather than f-strings so formatting only happens for records that are actually written, any
+    keyword arguments are kept as structured fields for JSON output.
+    """
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug(msg, *args, extra={"fields": fields}, stacklevel=2)
+
+
+def trace(msg: object, *args, **fields):
+    """Even chattier than debug, for dumping whole API responses."""
+    if LOGGER.isEnabledFor(TRACE):
+        LOGGER.log(TRACE, msg, *args, extra={"fields": fields}, stacklevel=2)
+
+
+def recent_debug() -> List[str]:
+    """The recent debug events from the ring buffer, formatted."""
+    return [
+        f"{time.strftime('%H:%M:%S', time.localtime(r.created))} {r.levelname} {r.getMessage()}"
+        for r in list(RECENT.records)
+    ]
+
+
+def dump_recent():
+    """Print the recent debug events, for when something has gone wrong."""
+    lines = recent_debug()
+    if lines:
+        CONSOLE.print(f"[bold yellow]Last {len(lines)} debug events:[/]")
+        for line in lines:
+            CONSOLE.print(line, markup=False, highlight=False)
+
+
+configure_logging()
+atexit.register(flush_logging, restart=False)
+
+
+# Set once whoever is waiting on the current piece of work has given up on it, see cancellable
+_CANCEL: ContextVar[Optional[threading.Event]] = ContextVar("djgpt_cancel", default=None)
+# time.monotonic() by which the current piece of work has to be done, see deadline
+_DEADLINE: ContextVar[Optional[float]] = ContextVar("djgpt_deadline", default=None)
+
+
+class Cancelled(Exception):
+    """Raised from work that has been cancelled, so it stops at the next opportunity."""
+
+
+class DeadlineExceeded(Cancelled):
+    """Raised from work that has run out of time."""
+
+
+@contextmanager
+def cancellable(event: Optional[threading.Event] = None) -> Iterator[threading.Event]:
+    """Make the work within the block cancellable by setting the event, from any thread."""
+    event = event or threading.Event()
+    token = _CANCEL.set(event)
+    try:
+        yield event
+    finally:
+        _CANCEL.reset(token)
+
+
+@contextmanager
+def deadline(seconds: Optional[float]) -> Iterator[Optional[float]]:
+    """Give the work within the block a time budget, never extending one set further out.
+
+    The deadline follows the work into other threads run with copy_context, and every call made through
+    http_session gets its timeout cut down to what's left.
+    """
+    if seconds is None:
+        yield _DEADLINE.get()
+        return
+    at = time.monotonic() + seconds
+    outer = _DEADLINE.get()
+    token = _DEADLINE.set(at if outer is None else min(at, outer))
+    try:
+        yield _DEADLINE.get()
+    finally:
+        _DEADLINE.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current deadline, None if there isn't one."""
+    at = _DEADLINE.get()
+    return None if at is None else max(0.0, at - time.monotonic())
+
+
+def call_timeout(timeout: Union[None, float, Tuple[float, float]]) -> Union[None, float, Tuple]:
+    """The timeout for a single call, its own (connect, read) timeout cut down to what's left of the deadline."""
+    left = remaining()
+    if left is None:
+        return timeout
+    # Never zero, which requests takes as an error rather than no time at all
+    left = max(left, 0.01)
+    if isinstance(timeout, tuple):
+        return tuple(left if t is None else min(t, left) for t in timeout)
+    return left if timeout is None else min(timeout, left)
+
+
+def check_cancelled():
+    """Raise Cancelled if the current work has been cancelled or run out of time, call before anything slow."""
+    event = _CANCEL.get()
+    if event is not None and event.is_set():
+        raise Cancelled()
+    at = _DEADLINE.get()
+    if at is not None and time.monotonic() >= at:
+        raise DeadlineExceeded()
 
 
 def retry(
@@ -57,14 +354,16 @@ def retry(
         def wrapper_retry(*args, **kwargs):
             attempt = 1
             while attempt <= num_attempts:
-                debug(f"Attempt {attempt} for {func.__name__}")
+                # Never retry past the deadline, or something nobody is waiting for any more
+                check_cancelled()
+                debug("Attempt %d for %s", attempt, func.__name__)
                 try:
                     result = func(*args, **kwargs)
                     if none_is_fail and result is None:
                         raise ValueError("Function returned None.")
                     return result
                 except exception_class as e:
-                    debug(f"Exception occurred: {e}, retrying...")
+                    debug("Exception occurred: %s, retrying...", e)
                     if prompt:
                         if not Confirm.ask(prompt, default=False):
                             debug("User answered no, breaking out of retry")
@@ -74,6 +373,9 @@ def retry(
                         wait_time = sleeptime
                         if cooloff:
                             wait_time = sleeptime * attempt
+                        left = remaining()
+                        if left is not None:
+                            wait_time = min(wait_time, left)
                         if wait_time > 0:
                             time.sleep(wait_time)
             return None
@@ -2,8 +2,29 @@
 pytest configuration file
 """
 
+from pathlib import Path
+
 import pytest
 
+CASSETTES = Path(__file__).parent / "cassettes"
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path):
+    """Fixture to keep anything DJGPT caches on disk out of the real cache directory"""
+    from djgpt.catalog import _persisted_catalog
+    from djgpt.history import _persisted_history
+    from djgpt.spotify import _persisted_device
+
+    monkeypatch.setenv("DJGPT_CACHE_DIR", str(tmp_path / "cache"))
+    _persisted_catalog.cache_clear()
+    _persisted_history.cache_clear()
+    _persisted_device.cache_clear()
+    yield tmp_path / "cache"
+    _persisted_catalog.cache_clear()
+    _persisted_history.cache_clear()
+    _persisted_device.cache_clear()
+
 
 @pytest.fixture(autouse=True)
 def mock_environ(monkeypatch):
@@ -13,3 +34,20 @@ def mock_environ(monkeypatch):
     monkeypatch.setenv("SPOTIPY_CLIENT_ID", "fake_client_id")
     monkeypatch.setenv("SPOTIPY_CLIENT_SECRET", "fake_client_secret")
     monkeypatch.setenv("OPENAI_API_KEY", "fake_api_key")
+
+
+@pytest.fixture
+def replay_cassette():
+    """Fixture to replay recorded OpenAI/Spotify traffic, by cassette name or path, without any latency"""
+    from djgpt.cassette import REPLAY, Cassette
+
+    cassettes = []
+
+    def replay(name, latency_scale: float = 0.0) -> Cassette:
+        path = Path(name) if Path(name).exists() else CASSETTES / f"{name}.json.gz"
+        cassettes.append(Cassette(path, mode=REPLAY, latency_scale=latency_scale).install())
+        return cassettes[-1]
+
+    yield replay
+    for cassette in reversed(cassettes):
+        cassette.uninstall()
@@ -0,0 +1,92 @@
+"""
+Tests for the backends module
+"""
+
+import json
+import sys
+import types
+
+import pytest
+
+from djgpt.backends import OPENAI, Backend, LlamaCppBackend
+from djgpt.cli import DJGPTPromptSystem
+from djgpt.prompt import GPTPromptSystem, IntGPTPromptSystem
+
+
+class FakeLlama:
+    """Stands in for llama_cpp.Llama, answering with a track when given a schema and otherwise 2"""
+
+    instances = []
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.calls = []
+        FakeLlama.instances.append(self)
+
+    def create_chat_completion(self, messages, **kwargs):
+        self.calls.append((messages, kwargs))
+        schema = (kwargs.get("response_format") or {}).get("schema")
+        content = json.dumps({"tracks": [{"artist": "Air", "trackname": "La Femme d'Argent"}]})
+        return {
+            "choices": [{"message": {"role": "assistant", "content": content if schema else "2"}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+        }
+
+
+@pytest.fixture
+def llama_cpp(monkeypatch):
+    FakeLlama.instances.clear()
+    monkeypatch.setitem(sys.modules, "llama_cpp", types.SimpleNamespace(Llama=FakeLlama))
+    yield FakeLlama.instances
+
+
+class Seven(Backend):
+    name = "seven"
+
+    def create(self, model, messages, max_tokens, temperature, **kwargs):
+        return {"choices": [{"message": {"content": "7"}}]}
+
+
+class TestBackends:
+    """Test choosing where prompt systems run their models"""
+
+    def test_openai_by_default(self):
+        assert GPTPromptSystem.backend is OPENAI
+
+    def test_backend_per_prompt_system(self):
+        intgpt = IntGPTPromptSystem()
+        intgpt.show_status = False
+        intgpt.backend = Seven()
+        assert intgpt.ask("seven") == 7
+        assert IntGPTPromptSystem.backend is OPENAI
+        # The same prompt answered by different backends isn't the same answer
+        assert intgpt.cache_key("seven") != IntGPTPromptSystem().cache_key("seven")
+
+    def test_local_model_loaded_once_on_the_cpu(self, llama_cpp):
+        intgpt = IntGPTPromptSystem()
+        intgpt.show_status = False
+        intgpt.backend = LlamaCppBackend("tiny.gguf", n_threads=2)
+        assert not llama_cpp
+
+        assert intgpt.ask("the second one") == 2
+        assert intgpt.ask("number two") == 2
+        assert len(llama_cpp) == 1
+        assert llama_cpp[0].kwargs["n_gpu_layers"] == 0
+        assert llama_cpp[0].kwargs["n_threads"] == 2
+
+    def test_local_function_calling(self, llama_cpp):
+        djgpt = DJGPTPromptSystem(num_tracks=1)
+        djgpt.show_status = False
+        djgpt.backend = LlamaCppBackend("tiny.gguf")
+
+        tracks = djgpt.ask("french electronica")
+        assert [(t.artist, t.trackname) for t in tracks] == [("Air", "La Femme d'Argent")]
+        messages, kwargs = llama_cpp[0].calls[0]
+        # Constrained to the function's schema, rather than trusting the model to stick to it
+        assert kwargs["response_format"]["schema"] == DJGPTPromptSystem.schema
+        assert "recommend_tracks" in messages[-1]["content"]
+
+    def test_missing_llama_cpp(self, monkeypatch):
+        monkeypatch.setitem(sys.modules, "llama_cpp", None)
+        with pytest.raises(ImportError, match="pip install llama-cpp-python"):
+            LlamaCppBackend("tiny.gguf").create("local", [], max_tokens=1, temperature=0)
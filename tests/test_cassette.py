@@ -0,0 +1,93 @@
+"""
+Tests for the cassette module
+"""
+
+from unittest.mock import patch
+
+import openai
+import pytest
+from spotipy import SpotifyException
+
+from djgpt.backends import Backend
+from djgpt.cassette import RECORD, Cassette, CassetteMiss, CassetteSpotify
+from djgpt.cli import DJGPTPromptSystem
+from djgpt.prompt import IntGPTPromptSystem
+from djgpt.spotify import get_spotify
+from djgpt.standins import LocalGPT, LocalSpotify
+
+TRACKS = [
+    ("Daft Punk", "One More Time"),
+    ("Bonobo", "Kerala"),
+    ("Massive Attack", "Teardrop"),
+    ("Air", "La Femme d'Argent"),
+    ("Nightmares on Wax", "You Wish"),
+]
+
+
+@pytest.fixture
+def recorded(tmp_path, monkeypatch):
+    """Record a short session against local stand-ins, returning the cassette path and what was recommended"""
+    monkeypatch.setattr(openai.ChatCompletion, "create", LocalGPT(TRACKS, num_tracks=3).create)
+    path = tmp_path / "session.json.gz"
+    with Cassette(path, mode=RECORD):
+        get_spotify().client_factory = lambda: LocalSpotify(TRACKS)
+        djgpt = DJGPTPromptSystem(num_tracks=3)
+        djgpt.show_status = False
+        recommended = [(t.trackname, t.spotify.uri) for t in djgpt.ask("chill")]
+    return path, recommended
+
+
+class Seven(Backend):
+    name = "seven"
+
+    def create(self, model, messages, max_tokens, temperature, **kwargs):
+        return {"choices": [{"message": {"content": "7"}}]}
+
+
+class TestCassette:
+    """Test recording and replaying API traffic"""
+
+    def test_replay_matches_recording(self, recorded, replay_cassette):
+        path, recommended = recorded
+        cassette = replay_cassette(path)
+        # The GPT call and a search for each track, plus any looser searches that got going before a match
+        assert len(cassette) >= 4
+
+        djgpt = DJGPTPromptSystem(num_tracks=3)
+        djgpt.show_status = False
+        assert [(t.trackname, t.spotify.uri) for t in djgpt.ask("chill")] == recommended
+
+    def test_replay_miss(self, recorded, replay_cassette):
+        replay_cassette(recorded[0])
+        with pytest.raises(CassetteMiss):
+            get_spotify().current_playback()
+
+    def test_errors_are_replayed(self, tmp_path, replay_cassette):
+        path = tmp_path / "errors.json.gz"
+
+        def no_device(**kwargs):
+            raise SpotifyException(404, -1, "No active device found")
+
+        with Cassette(path, mode=RECORD) as cassette:
+            with pytest.raises(SpotifyException):
+                cassette.call("spotify", "start_playback", no_device, uris=["spotify:track:1"])
+
+        replay_cassette(path)
+        assert isinstance(get_spotify(), CassetteSpotify)
+        with pytest.raises(SpotifyException, match="No active device"):
+            get_spotify().start_playback(uris=["spotify:track:1"])
+
+    def test_local_backends_are_recorded(self, tmp_path, replay_cassette):
+        path = tmp_path / "local.json.gz"
+        intgpt = IntGPTPromptSystem()
+        intgpt.show_status = False
+        intgpt.backend = Seven()
+        with patch("openai.ChatCompletion.create") as create:
+            with Cassette(path, mode=RECORD):
+                assert intgpt.ask("seven") == 7
+            create.assert_not_called()
+
+        # Replaying doesn't need the backend at all
+        replay_cassette(path)
+        with patch.object(Seven, "create", side_effect=AssertionError):
+            assert intgpt.ask("seven") == 7
@@ -0,0 +1,79 @@
+"""
+Tests for the catalog module
+"""
+
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from djgpt.catalog import Catalog, normalize
+from djgpt.spotify import search_spotify
+
+ITEM = {
+    "name": "Get Lucky (feat. Pharrell Williams)",
+    "artists": [{"name": "Daft Punk"}],
+    "external_urls": {"spotify": "https://open.spotify.com/track/123"},
+    "uri": "spotify:track:123",
+}
+
+
+@pytest.fixture
+def catalog():
+    catalog = Catalog()
+    catalog.add("Daft Punk ft. Pharrell", "Get Lucky", ITEM)
+    return catalog
+
+
+class TestNormalize:
+    """Test name normalisation"""
+
+    @pytest.mark.parametrize(
+        "name,expected",
+        [
+            ("Beyoncé", "beyonce"),
+            ("Get Lucky (feat. Pharrell Williams)", "get lucky"),
+            ("Here Comes The Sun - Remastered 2009", "here comes the sun"),
+            ("Simon & Garfunkel", "simon and garfunkel"),
+            ("Stay (With Me)", "stay with me"),
+            ("  Don't   Stop Me Now! ", "don t stop me now"),
+        ],
+    )
+    def test_normalize(self, name, expected):
+        assert normalize(name) == expected
+
+
+class TestCatalog:
+    """Test local catalog lookups"""
+
+    def test_exact_lookup(self, catalog):
+        url, uri, item = catalog.lookup("DAFT PUNK", "get lucky")
+        assert uri == "spotify:track:123"
+        assert item == ITEM
+        assert len(catalog) == 1
+
+    def test_fuzzy_lookup(self, catalog):
+        assert catalog.lookup("Daft Punkk", "Get Luckey")[1] == "spotify:track:123"
+
+    def test_fuzzy_needs_artist_and_track(self, catalog):
+        assert catalog.lookup("Daft Punk", "Around the World") is None
+        assert catalog.lookup("Pharrell Williams", "Get Lucky") is None
+
+    def test_fuzzy_numbers_must_match(self, catalog):
+        catalog.add("Beethoven", "Symphony No. 5", {**ITEM, "name": "", "uri": "spotify:track:5"})
+        catalog.add(
+            "Pink Floyd",
+            "Another Brick in the Wall, Pt. 2",
+            {**ITEM, "name": "", "uri": "spotify:track:2"},
+        )
+        assert catalog.lookup("Beethoven", "Symphonie No. 5")[1] == "spotify:track:5"
+        assert catalog.lookup("Beethoven", "Symphony No. 9") is None
+        assert catalog.lookup("Pink Floyd", "Another Brick in the Wall, Pt. 1") is None
+
+    def test_search_spotify_uses_catalog(self):
+        client = MagicMock()
+        client.search.return_value = {"tracks": {"items": [ITEM]}}
+        with patch("djgpt.spotify.get_spotify", return_value=client):
+            assert search_spotify("Daft Punk", "Get Lucky").uri == "spotify:track:123"
+            searches = client.search.call_count
+            assert search_spotify("daft punk", "Get Lucky - Radio Edit").uri == "spotify:track:123"
+        assert client.search.call_count == searches
@@ -0,0 +1,71 @@
+"""
+Tests for the cli module
+"""
+
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from djgpt import cli
+from djgpt.playqueue import PlayQueue
+from djgpt.spotify import Spotify, Track
+
+
+def track(n: int) -> Track:
+    t = Track(artist="Artist", trackname=f"Track {n}", genre="Genre", reason="Reason")
+    t.spotify = Spotify(url=f"https://track/{n}", uri=f"spotify:track:{n}", stash={})
+    return t
+
+
+@pytest.fixture
+def session():
+    """Fixture to run a CLI session with the requests given, without GPT, Spotify or the keyboard
+
+    Returns a mock the Spotify and keyboard calls made are attached to, in the order they were made, and the play
+    queues started.
+    """
+    queues = []
+
+    def start(queue):
+        queues.append(queue)
+        return queue
+
+    def run(*requests, **options):
+        calls = MagicMock()
+        with (
+            patch.object(cli, "listen", side_effect=[*requests, "stop"]),
+            patch.object(cli, "say"),
+            patch.object(cli, "recommend", return_value=[track(1), track(2)]),
+            patch.object(cli.IntGPTPromptSystem, "ask", return_value=2),
+            patch.object(cli, "play_on_spotify", calls.play_on_spotify),
+            patch.object(cli, "get_spotify", calls.get_spotify),
+            patch.object(cli, "wait_for_spotify", calls.wait_for_spotify),
+            patch.object(cli.TYPE_AHEAD, "start", calls.type_ahead),
+            patch.object(cli.time, "sleep"),
+            patch.object(PlayQueue, "start", start),
+        ):
+            with pytest.raises(SystemExit):
+                cli.djgpt("id", "secret", "key", resume=False, **options)
+        return calls, queues
+
+    return run
+
+
+class TestDJGPT:
+    """Test the interactive DJ session"""
+
+    def test_plays_selection(self, session):
+        calls, queues = session("something dreamy", "the second one")
+        calls.play_on_spotify.assert_called_once()
+        assert calls.play_on_spotify.call_args.args[0][0].trackname == "Track 2"
+        assert not queues
+
+    def test_continuous_selection_is_queued(self, session):
+        calls, queues = session("something dreamy", "the second one", continuous=True)
+        calls.play_on_spotify.assert_not_called()
+        assert [t.trackname for t in queues[0].pending] == ["Track 2"]
+
+    def test_authorizes_spotify_before_typing_ahead(self, session):
+        calls, _ = session(continuous=True)
+        # Authorizing for the first time reads the redirect URL from stdin
+        assert [c[0] for c in calls.mock_calls][:2] == ["get_spotify", "type_ahead"]
@@ -0,0 +1,151 @@
+"""
+Tests for the evaluate module
+"""
+
+import json
+from functools import partial
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from djgpt.cassette import RECORD, Cassette
+from djgpt.cli import DJGPTPromptSystem
+from djgpt.evaluate import evaluate, load_test_cases, summarise
+from djgpt.prompt import GPTHallucinationError, PromptTestCase
+from djgpt.prompt import TestCaseType as CaseType
+from djgpt.spotify import get_spotify, search_spotify
+from djgpt.standins import LocalGPT, LocalSpotify
+
+# Evaluated against the stand-ins to record tests/cassettes/evaluation.json.gz, see record_evaluation
+EVALUATION_CASES = [
+    PromptTestCase(prompt="Some French house", output=[], case=CaseType.HAPPY),
+    PromptTestCase(prompt="Chilled trip hop for a rainy day", output=[], case=CaseType.SAD),
+]
+EVALUATION_TRACKS = [
+    ("Daft Punk", "One More Time"),
+    ("Bonobo", "Kerala"),
+    ("Massive Attack", "Teardrop"),
+    ("Air", "La Femme d'Argent"),
+    ("Nightmares on Wax", "You Wish"),
+]
+
+
+def record_evaluation(path: Path):
+    """Record evaluating the DJ prompt on EVALUATION_CASES against the stand-ins, run again if the prompt changes"""
+    with (
+        patch("openai.ChatCompletion.create", LocalGPT(EVALUATION_TRACKS, num_tracks=3).create),
+        Cassette(path, mode=RECORD),
+    ):
+        get_spotify().client_factory = lambda: LocalSpotify(EVALUATION_TRACKS)
+        evaluate(DJGPTPromptSystem(num_tracks=3), EVALUATION_CASES, workers=1)
+
+
+@pytest.fixture
+def cases():
+    """A couple of test cases, one of which should resolve"""
+    return [
+        PromptTestCase(
+            prompt="Some French house",
+            output=[{"artist": "Daft Punk", "trackname": "One More Time"}],
+            case=CaseType.HAPPY,
+        ),
+        PromptTestCase(
+            prompt="Songs by the Beatles from 2030", output=[], case=CaseType.HALLUCINATING
+        ),
+    ]
+
+
+@pytest.fixture
+def mock_gpt():
+    """Fixture to mock GPT always recommending the same track"""
+    with patch("openai.ChatCompletion.create") as mock_create:
+        mock_create.return_value = {
+            "choices": [
+                {
+                    "message": {
+                        "content": None,
+                        "function_call": {
+                            "name": "recommend_tracks",
+                            "arguments": json.dumps(
+                                {"tracks": [{"artist": "Daft Punk", "trackname": "One More Time"}]}
+                            ),
+                        },
+                    }
+                }
+            ],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+        }
+        yield mock_create
+
+
+class TestLocalSpotify:
+    """Test the local Spotify stand-in"""
+
+    def test_search_with_filters(self):
+        client = LocalSpotify([("Daft Punk", "One More Time")])
+        results = client.search("artist:daft punk track:One More Time", limit=1)
+        assert results["tracks"]["items"][0]["name"] == "One More Time"
+        assert client.search("artist:Daft Punk track:Around the World")["tracks"]["items"] == []
+
+    def test_search_free_text(self):
+        client = LocalSpotify([("Daft Punk", "One More Time")])
+        assert len(client.search("punk time")["tracks"]["items"]) == 1
+
+
+class TestEvaluate:
+    """Test running and summarising an evaluation"""
+
+    def test_load_test_cases_from_cache(self, tmp_path, cases):
+        path = tmp_path / "cases.json"
+        path.write_text(json.dumps([c._asdict() for c in cases]))
+        loaded = load_test_cases(path, DJGPTPromptSystem(num_tracks=1))
+        assert loaded == cases
+        assert loaded[1].case is CaseType.HALLUCINATING
+
+    def test_failed_generation_not_cached(self, tmp_path):
+        path = tmp_path / "cases.json"
+        djgpt = DJGPTPromptSystem(num_tracks=1)
+        # The prompt system generating the cases gives up with an error rather than returning nothing
+        with patch(
+            "djgpt.prompt.TestGPTPomptSystem.ask", side_effect=GPTHallucinationError(prompt=djgpt)
+        ):
+            assert load_test_cases(path, djgpt) == []
+        assert not path.exists()
+
+    def test_evaluate_offline(self, cases, mock_gpt):
+        resolver = partial(search_spotify, client=LocalSpotify.from_test_cases(cases))
+        results = evaluate(DJGPTPromptSystem(num_tracks=1), cases, resolver=resolver, workers=2)
+
+        assert [r.resolved for r in results] == [1, 1]
+        summary = summarise(results, prompt_price=0.03, completion_price=0.06)
+        assert summary["all"]["hit_rate"] == 1.0
+        assert summary["all"]["prompt_tokens"] == 200
+        assert summary["happy"]["cost"] == pytest.approx((100 * 0.03 + 20 * 0.06) / 1000)
+        assert "sad" not in summary
+
+    def test_evaluate_packed(self, cases):
+        gpt = LocalGPT([("Daft Punk", "One More Time")], num_tracks=1)
+        resolver = partial(search_spotify, client=LocalSpotify.from_test_cases(cases))
+        djgpt = DJGPTPromptSystem(num_tracks=1)
+        with patch("openai.ChatCompletion.create", side_effect=gpt.create) as create:
+            results = evaluate(djgpt, cases * 2, resolver=resolver, workers=2, pack=2)
+
+        assert create.call_count == 2
+        assert [r.case for r in results] == cases * 2
+        assert [r.resolved for r in results] == [1, 1, 1, 1]
+        # Both cases in a pack share its tokens
+        assert results[0].prompt_tokens == results[1].prompt_tokens > 0
+
+    def test_evaluate_replayed(self, replay_cassette):
+        replay_cassette("evaluation")
+        with patch("openai.ChatCompletion.create", side_effect=AssertionError("Not replayed")):
+            results = evaluate(DJGPTPromptSystem(num_tracks=3), EVALUATION_CASES, workers=2)
+
+        assert [r.error for r in results] == [None, None]
+        assert [r.resolved for r in results] == [3, 3]
+        assert summarise(results, 0.03, 0.06)["all"]["prompt_tokens"] > 0
+
+
+if __name__ == "__main__":
+    record_evaluation(Path(__file__).parent / "cassettes" / "evaluation.json.gz")
@@ -0,0 +1,89 @@
+"""
+Tests for the history module
+"""
+
+import time
+
+from djgpt.cli import DJGPTPromptSystem
+from djgpt.history import PLAYED, RECOMMENDED, SELECTED, History, get_history, use_history
+from djgpt.session import Session
+from djgpt.spotify import Spotify, Track, play_on_spotify, use_spotify
+from djgpt.standins import LocalGPT, LocalSpotify
+
+
+def track(artist: str, trackname: str) -> Track:
+    t = Track(artist=artist, trackname=trackname)
+    t.spotify = Spotify(url="https://track/1", uri="spotify:track:1", stash={})
+    return t
+
+
+class TestHistory:
+    """Test the listening history"""
+
+    def test_filters_recent_repeats(self):
+        history = History()
+        request_id = history.record_request("chill")
+        history.record(PLAYED, [track("Air", "Playground Love")], request_id)
+        history.record(RECOMMENDED, [track("Bonobo", "Kerala")], request_id)
+        history.record(SELECTED, [track("Bonobo", "Kerala")], request_id)
+
+        fresh = history.filter(
+            [
+                Track(artist="AIR", trackname="Playground Love (feat. Gordon Tracks)"),
+                Track(artist="Bonobo", trackname="Kerala"),
+            ]
+        )
+        # Being recommended or selected doesn't count, it was never played
+        assert [t.trackname for t in fresh] == ["Kerala"]
+
+    def test_window_and_prune(self, monkeypatch):
+        history = History(window=60)
+        history.record(PLAYED, [track("Air", "Playground Love")])
+        assert history.is_repeat(Track(artist="Air", trackname="Playground Love"))
+
+        later = time.time() + 120
+        monkeypatch.setattr(time, "time", lambda: later)
+        assert not history.is_repeat(Track(artist="Air", trackname="Playground Love"))
+        history.prune(keep=60)
+        assert len(history) == 0
+
+    def test_exclusions(self):
+        history = History()
+        assert history.exclusions() is None
+        history.record(PLAYED, [track("Air", "Playground Love"), track("Bonobo", "Kerala")])
+        history.record(PLAYED, [track("Air", "Playground Love")])
+        assert history.exclusions(limit=1).endswith(": playground love by air")
+
+    def test_play_on_spotify_records_plays(self):
+        client = LocalSpotify()
+        with use_spotify(client):
+            play_on_spotify([track("Air", "Playground Love")])
+        assert client.playing == ["spotify:track:1"]
+        assert get_history().is_repeat(Track(artist="Air", trackname="Playground Love"))
+
+    def test_djgpt_skips_repeats(self):
+        tracks = [("Air", "Playground Love"), ("Bonobo", "Kerala")]
+        djgpt = DJGPTPromptSystem(num_tracks=2)
+        djgpt.show_status = False
+        djgpt.chat_completion = LocalGPT(tracks, num_tracks=2).create
+        djgpt.history = History()
+        djgpt.exclude_recent = 5
+        with use_history(djgpt.history):
+            djgpt.history.record(PLAYED, [track("Air", "Playground Love")])
+            assert [t.trackname for t in djgpt.ask("chill")] == ["Kerala"]
+
+    def test_session_tracks_are_not_repeats(self):
+        tracks = [("Air", "Playground Love"), ("Bonobo", "Kerala")]
+        djgpt = DJGPTPromptSystem(num_tracks=2)
+        djgpt.show_status = False
+        djgpt.chat_completion = LocalGPT(tracks, num_tracks=2).create
+        djgpt.history = History()
+        session = Session()
+        first = [track(t.artist, t.trackname) for t in djgpt.ask("chill", session=session)]
+        session.record("chill", first)
+        djgpt.history.record(PLAYED, first)
+
+        # Asking about what this session already offered gets it again, already resolved
+        again = djgpt.ask("more like number 1", session=session)
+        assert {t.trackname for t in again} == {"Playground Love", "Kerala"}
+        assert all(t.resolved for t in again)
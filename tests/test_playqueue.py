@@ -0,0 +1,158 @@
+"""
+Tests for the playqueue module
+"""
+
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+from spotipy import SpotifyException
+
+from djgpt.history import get_history
+from djgpt.playqueue import PlayQueue
+from djgpt.spotify import Spotify, Track
+
+
+def track(n: int) -> Track:
+    t = Track(artist="Artist", trackname=f"Track {n}")
+    t.spotify = Spotify(url=f"https://track/{n}", uri=f"spotify:track:{n}", stash={})
+    return t
+
+
+def playing(n: int, progress_ms: int = 0) -> dict:
+    return {
+        "is_playing": True,
+        "progress_ms": progress_ms,
+        "item": {"uri": f"spotify:track:{n}", "duration_ms": 200_000},
+    }
+
+
+@pytest.fixture
+def mock_spotify_api():
+    """Fixture to mock Spotify API calls"""
+    with patch("djgpt.spotify.get_spotify") as mock_get_spotify:
+        with patch("djgpt.playqueue.get_spotify", mock_get_spotify):
+            mock_spotify = MagicMock()
+            mock_get_spotify.return_value = mock_spotify
+            yield mock_spotify
+
+
+class TestPlayQueue:
+    """Test continuous play queue"""
+
+    def test_starts_playback_when_idle(self, mock_spotify_api):
+        mock_spotify_api.current_playback.return_value = None
+        queue = PlayQueue(ahead=2)
+        queue.extend([track(1), track(2), track(3)])
+
+        queue.top_up()
+        mock_spotify_api.start_playback.assert_called_once_with(
+            device_id=None, uris=["spotify:track:1"]
+        )
+        # Not playing yet as far as Spotify says, but we mustn't start anything else
+        queue.top_up()
+        mock_spotify_api.start_playback.assert_called_once()
+
+    def test_queues_ahead_and_tops_up(self, mock_spotify_api):
+        queue = PlayQueue(ahead=2, poll_interval=30)
+        queue.extend([track(n) for n in range(1, 6)])
+        mock_spotify_api.current_playback.return_value = None
+        queue.top_up()
+
+        mock_spotify_api.current_playback.return_value = playing(1, progress_ms=190_000)
+        assert queue.top_up() == pytest.approx(8)
+        assert [c.args[0] for c in mock_spotify_api.add_to_queue.call_args_list] == [
+            "spotify:track:2",
+            "spotify:track:3",
+        ]
+
+        mock_spotify_api.current_playback.return_value = playing(2)
+        assert queue.top_up() == 30
+        assert mock_spotify_api.add_to_queue.call_args.args[0] == "spotify:track:4"
+        assert len(queue) == 3
+        mock_spotify_api.start_playback.assert_called_once()
+
+    def test_ignores_tracks_not_on_spotify(self, mock_spotify_api):
+        missing = Track(artist="Nobody", trackname="Nothing")
+        missing.spotify = None
+        queue = PlayQueue()
+        queue.extend([missing])
+        assert len(queue) == 0
+
+    def test_only_tracks_seen_playing_count_as_played(self, mock_spotify_api):
+        mock_spotify_api.current_playback.return_value = None
+        queue = PlayQueue(ahead=2)
+        queue.extend([track(1), track(2), track(3)])
+        queue.top_up()
+        assert not get_history().is_repeat(track(1))
+
+        mock_spotify_api.current_playback.return_value = playing(1)
+        queue.top_up()
+        assert get_history().is_repeat(track(1))
+        # Queued up behind it, but they could yet be skipped or cleared
+        assert not get_history().is_repeat(track(2))
+
+        mock_spotify_api.current_playback.return_value = playing(3)
+        queue.top_up()
+        assert get_history().is_repeat(track(3))
+        assert not get_history().is_repeat(track(2))
+
+    def test_adding_never_waits_on_spotify(self, mock_spotify_api):
+        mock_spotify_api.current_playback.return_value = None
+        queue = PlayQueue()
+        # Would deadlock if Spotify were called holding the lock
+        mock_spotify_api.start_playback.side_effect = lambda **kwargs: queue.extend([track(2)])
+        queue.extend([track(1)])
+        queue.top_up()
+        assert len(queue) == 2
+
+    def test_gives_up_on_tracks_that_never_play(self, mock_spotify_api):
+        mock_spotify_api.current_playback.return_value = None
+        queue = PlayQueue(stale_after=0)
+        queue.extend([track(1), track(2)])
+        queue.top_up()
+        # Spotify never played the first, so rather than stall we move on
+        time.sleep(0.01)
+        queue.top_up()
+        assert mock_spotify_api.start_playback.call_args.kwargs["uris"] == ["spotify:track:2"]
+
+    def test_relinked_tracks_are_seen_playing(self, mock_spotify_api):
+        queue = PlayQueue(ahead=1)
+        queue.extend([track(1), track(2)])
+        mock_spotify_api.current_playback.return_value = playing(0)
+        queue.top_up()
+        relinked = playing(99)
+        relinked["item"]["linked_from"] = {"uri": "spotify:track:1"}
+        mock_spotify_api.current_playback.return_value = relinked
+        queue.top_up()
+        assert mock_spotify_api.add_to_queue.call_args.args[0] == "spotify:track:2"
+
+    def test_failed_tracks_go_back_on_the_queue(self, mock_spotify_api):
+        mock_spotify_api.current_playback.return_value = playing(1)
+        mock_spotify_api.add_to_queue.side_effect = SpotifyException(502, -1, "Bad gateway")
+        queue = PlayQueue(ahead=2)
+        queue.extend([track(2), track(3)])
+        with pytest.raises(SpotifyException):
+            queue.top_up()
+        assert [t.trackname for t in queue.pending] == ["Track 2", "Track 3"]
+        assert not queue.pushed
+
+    def test_keeps_polling_after_network_errors(self, mock_spotify_api):
+        mock_spotify_api.current_playback.side_effect = [
+            requests.ConnectionError("Connection reset"),
+            requests.ReadTimeout("Read timed out"),
+            ValueError("Something unexpected"),
+            None,
+        ]
+        queue = PlayQueue(poll_interval=0.01)
+        queue.extend([track(1)])
+        queue.start()
+        try:
+            for _ in range(100):
+                if mock_spotify_api.start_playback.called:
+                    break
+                time.sleep(0.01)
+        finally:
+            queue.stop()
+        mock_spotify_api.start_playback.assert_called_once()
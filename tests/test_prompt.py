@@ -0,0 +1,239 @@
+"""
+Tests for the prompt module
+"""
+
+import json
+import time
+
+import pytest
+
+from djgpt.cli import DJGPTPromptSystem
+from djgpt.prompt import (
+    CONTEXT_WINDOWS,
+    TIER_WINS,
+    GPTHallucinationError,
+    GPTPromptSystem,
+    IntGPTPromptSystem,
+    JSONGPTPromptSystem,
+    ResponseCache,
+    estimate_tokens,
+    schema_errors,
+)
+from djgpt.standins import LocalGPT, synthetic_tracks
+from djgpt.utils import DeadlineExceeded, deadline
+
+
+def slow_models(delays, answers=None):
+    """A chat completion stand-in where each model takes its own time to answer"""
+    calls = []
+
+    def create(model, messages, request_timeout=None, **kwargs):
+        assert request_timeout is not None
+        calls.append(model)
+        time.sleep(delays[model])
+        content = (answers or {}).get(model, f'"{model}"')
+        return {"choices": [{"message": {"content": content}}]}
+
+    create.calls = calls
+    return create
+
+
+@pytest.fixture(autouse=True)
+def reset_tier_wins():
+    TIER_WINS.clear()
+    yield
+    TIER_WINS.clear()
+
+
+def hedged(prompt_system: GPTPromptSystem, create, hedge_after: float) -> GPTPromptSystem:
+    prompt_system.show_status = False
+    prompt_system.chat_completion = create
+    prompt_system.fallback_model = "fast"
+    prompt_system.hedge_after = hedge_after
+    return prompt_system
+
+
+class TestHedging:
+    """Test hedged requests across model tiers"""
+
+    def test_fallback_wins_when_main_model_is_slow(self):
+        create = slow_models({"gpt-4": 0.5, "fast": 0.0})
+        assert hedged(JSONGPTPromptSystem(), create, 0.05).ask("hi") == "fast"
+        assert create.calls == ["gpt-4", "fast"]
+        assert TIER_WINS == {"fast": 1}
+
+    def test_no_hedge_when_main_model_is_quick(self):
+        create = slow_models({"gpt-4": 0.0, "fast": 0.0})
+        assert hedged(JSONGPTPromptSystem(), create, 0.5).ask("hi") == "gpt-4"
+        assert create.calls == ["gpt-4"]
+        assert TIER_WINS == {"gpt-4": 1}
+
+    def test_invalid_fallback_answer_is_ignored(self):
+        create = slow_models({"gpt-4": 0.2, "fast": 0.0}, answers={"fast": "not json"})
+        assert hedged(JSONGPTPromptSystem(), create, 0.05).ask("hi") == "gpt-4"
+        assert TIER_WINS == {"gpt-4": 1}
+
+    def test_invalid_main_answer_hedges_straight_away(self):
+        create = slow_models({"gpt-4": 0.0, "fast": 0.0}, answers={"gpt-4": "not json"})
+        start = time.perf_counter()
+        assert hedged(JSONGPTPromptSystem(), create, 5.0).ask("hi") == "fast"
+        assert time.perf_counter() - start < 1.0
+        assert create.calls == ["gpt-4", "fast"]
+
+    def test_hedged_request_gives_up_at_the_deadline(self):
+        create = slow_models({"gpt-4": 0.5, "fast": 0.5})
+        with deadline(0.1), pytest.raises(DeadlineExceeded):
+            hedged(JSONGPTPromptSystem(), create, 0.05).ask("hi")
+
+    def test_int_prompt_system_uses_small_model(self):
+        create = slow_models({"gpt-3.5-turbo": 0.0}, answers={"gpt-3.5-turbo": "3"})
+        intgpt = IntGPTPromptSystem()
+        intgpt.show_status = False
+        intgpt.chat_completion = create
+        assert intgpt.ask("the third one") == 3
+        assert create.calls == ["gpt-3.5-turbo"]
+
+
+def function_call(arguments, calls=None):
+    """A chat completion stand-in that always calls the requested function with the same arguments"""
+
+    def create(model, messages, **kwargs):
+        if calls is not None:
+            calls.append(kwargs)
+        message = {
+            "content": None,
+            "function_call": {"name": kwargs["function_call"]["name"], "arguments": arguments},
+        }
+        return {"choices": [{"message": message}]}
+
+    return create
+
+
+class TestStructuredOutput:
+    """Test getting tracks via a function schema"""
+
+    def test_schema_errors(self):
+        schema = DJGPTPromptSystem.schema
+        assert (
+            schema_errors({"tracks": [{"artist": "Air", "trackname": "Playground Love"}]}, schema)
+            == []
+        )
+        assert schema_errors({"tracks": [{"artist": "Air", "quality": 2}]}, schema) == [
+            "$.tracks[0].trackname is missing",
+            "$.tracks[0].quality should be at most 1",
+        ]
+        assert schema_errors({"tracks": "Air"}, schema) == ["$.tracks should be array, got str"]
+
+    def test_tracks_from_function_call(self):
+        calls = []
+        djgpt = DJGPTPromptSystem(num_tracks=1)
+        djgpt.show_status = False
+        djgpt.chat_completion = function_call(
+            json.dumps(
+                {"tracks": [{"artist": "Air", "trackname": "Playground Love", "quality": 0.9}]}
+            ),
+            calls,
+        )
+        [track] = djgpt.ask("something dreamy")
+        assert (track.artist, track.trackname, track.quality) == ("Air", "Playground Love", 0.9)
+        assert calls[0]["functions"][0]["parameters"] is DJGPTPromptSystem.schema
+        assert "JSON" not in djgpt.prompt
+
+    def test_invalid_tracks_are_dropped(self):
+        calls = []
+        djgpt = DJGPTPromptSystem(num_tracks=2)
+        djgpt.show_status = False
+        djgpt.chat_completion = function_call(
+            json.dumps(
+                {
+                    "tracks": [
+                        {"artist": "Air", "trackname": "Playground Love", "quality": 1.1},
+                        {"artist": "Air", "trackname": "Cherry Blossom Girl"},
+                    ]
+                }
+            ),
+            calls,
+        )
+        assert [t.trackname for t in djgpt.ask("something dreamy")] == ["Cherry Blossom Girl"]
+        assert len(calls) == 1
+
+    def test_no_valid_tracks_is_asked_again(self):
+        calls = []
+        djgpt = DJGPTPromptSystem(num_tracks=1)
+        djgpt.show_status = False
+        djgpt.chat_completion = function_call('{"tracks": [{"artist": "Air"}]}', calls)
+        assert djgpt.ask("something dreamy") == []
+        assert len(calls) == DJGPTPromptSystem.attempts
+
+        with pytest.raises(GPTHallucinationError, match="trackname is missing"):
+            super(DJGPTPromptSystem, djgpt).ask("something dreamy")
+
+
+class TestPacking:
+    """Test packing several requests into a single completion"""
+
+    REQUESTS = ["french house", "sad jazz", "happy hardcore", "sea shanties", "dub techno"]
+
+    def test_packed_answers_match_single_ones(self):
+        gpt = LocalGPT(synthetic_tracks(50), num_tracks=2)
+        calls = []
+
+        def create(**kwargs):
+            calls.append(kwargs)
+            return gpt.create(**kwargs)
+
+        djgpt = DJGPTPromptSystem(num_tracks=2)
+        djgpt.show_status = False
+        djgpt.pack_size = 3
+        djgpt.chat_completion = create
+        packed = djgpt.ask_many(self.REQUESTS)
+        assert len(calls) == 2
+        assert calls[0]["max_tokens"] == 3 * djgpt.max_tokens
+        assert [djgpt.ask(request) for request in self.REQUESTS] == packed
+
+    def test_packs_too_big_for_the_model_are_split(self):
+        gpt = LocalGPT(synthetic_tracks(50), num_tracks=2)
+        calls = []
+
+        def create(**kwargs):
+            calls.append(kwargs)
+            return gpt.create(**kwargs)
+
+        djgpt = DJGPTPromptSystem(num_tracks=2)
+        djgpt.show_status = False
+        djgpt.pack_size = 8
+        djgpt.chat_completion = create
+        packed = djgpt.ask_many(self.REQUESTS * 2)
+        assert all(len(tracks) == 2 for tracks in packed)
+        # Eight answers of max_tokens each won't fit in gpt-4's context
+        assert len(calls) > 1
+        for call in calls:
+            prompt = estimate_tokens([call["messages"], call["functions"][0]])
+            assert prompt + call["max_tokens"] <= CONTEXT_WINDOWS["gpt-4"]
+
+    def test_only_failed_requests_are_asked_again(self):
+        calls = []
+        good = {"tracks": [{"artist": "Air", "trackname": "Playground Love"}]}
+
+        def create(model, messages, functions, **kwargs):
+            calls.append(messages[-1]["content"])
+            answer = good
+            if functions[0]["name"] == "recommend_tracks_each":
+                # The second request is garbage and the third is missing altogether
+                answer = {"r0": good, "r1": {"tracks": "Air"}}
+            return function_call(json.dumps(answer))(model, messages, **kwargs)
+
+        djgpt = DJGPTPromptSystem(num_tracks=1)
+        djgpt.show_status = False
+        djgpt.chat_completion = create
+        djgpt.response_cache = ResponseCache()
+        assert [len(tracks) for tracks in djgpt.ask_many(["dreamy", "french", "moody"])] == [
+            1,
+            1,
+            1,
+        ]
+        assert calls[1:] == ["french", "moody"]
+
+        # Good answers from a pack are cached for each request on its own
+        assert len(djgpt.ask("dreamy")) == 1
+        assert len(calls) == 3
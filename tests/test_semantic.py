@@ -0,0 +1,117 @@
+"""
+Tests for the semantic module
+"""
+
+import pytest
+
+from djgpt.cli import DJGPTPromptSystem
+from djgpt.history import PLAYED, History
+from djgpt.semantic import SemanticCache
+from djgpt.session import Session
+from djgpt.standins import LocalGPT
+
+
+class TestSemanticCache:
+    """Test looking up requests by meaning"""
+
+    def test_similar_requests_hit(self):
+        cache = SemanticCache(threshold=0.5)
+        cache.put("chill music for studying", ["studying"])
+        cache.put("upbeat songs for a summer road trip", ["road trip"])
+
+        assert cache.lookup("Chill music for study") == ["studying"]
+        assert cache.lookup("heavy metal to lift weights to") is None
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert cache.hit_rate == 0.5
+
+    def test_blends_close_matches(self):
+        cache = SemanticCache(threshold=0.5)
+        cache.put("chill music for studying", ["a", "b"])
+        cache.put("chill music for studying late", ["c", "a"])
+        assert cache.lookup("chill music for studying late at night") == ["c", "a", "b"]
+        assert cache.lookup("chill music for studying late at night", limit=2) == ["c", "a"]
+
+    def test_evicts_least_recently_used(self):
+        cache = SemanticCache(maxsize=2, threshold=0.9)
+        cache.put("jazz for a rainy day", ["jazz"])
+        cache.put("punk for the gym", ["punk"])
+        assert cache.lookup("jazz for a rainy day") == ["jazz"]
+        cache.put("opera for cooking", ["opera"])
+
+        assert len(cache) == 2 and cache.evictions == 1
+        assert cache.lookup("punk for the gym") is None
+        assert cache.lookup("jazz for a rainy day") == ["jazz"]
+
+    def test_grows_to_maxsize(self):
+        cache = SemanticCache(maxsize=100, threshold=0.99)
+        for n in range(100):
+            cache.put(f"request number {n}", [n])
+        assert len(cache) == 100 and cache.counts.shape[0] == 100
+        assert cache.lookup("request number 99") == [99]
+
+    @pytest.mark.parametrize(
+        "cached, asked",
+        [
+            ("80s", "90s"),
+            ("1970s", "1980s"),
+            ("number 2", "number 3"),
+            ("best songs of the 80s", "best songs of the 90s"),
+        ],
+    )
+    def test_numbers_must_match(self, cached, asked):
+        cache = SemanticCache()
+        cache.put(cached, [cached])
+        assert cache.lookup(asked) is None
+        assert cache.lookup(cached) == [cached]
+
+    def test_readme_example_hits(self):
+        cache = SemanticCache()
+        cache.put("songs for a summer road trip", ["road trip"])
+        assert cache.lookup("summer road trip songs") == ["road trip"]
+
+
+@pytest.fixture
+def calls():
+    return []
+
+
+@pytest.fixture
+def djgpt(calls):
+    """A DJGPT asking a stand-in GPT, counting the calls, with a semantic cache"""
+    gpt = LocalGPT(
+        [("Air", "Playground Love"), ("Bonobo", "Kerala"), ("Moby", "Porcelain")], num_tracks=2
+    )
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        return gpt.create(**kwargs)
+
+    djgpt = DJGPTPromptSystem(num_tracks=2)
+    djgpt.show_status = False
+    djgpt.chat_completion = create
+    djgpt.semantic_cache = SemanticCache(threshold=0.6)
+    return djgpt
+
+
+class TestDJGPTSemanticCache:
+    """Test DJGPT reusing tracks from similar requests"""
+
+    def test_skips_gpt_for_similar_requests(self, djgpt, calls):
+        first = djgpt.ask("chill music for studying")
+        second = djgpt.ask("chill music for study")
+        assert len(calls) == 1
+        assert [t.trackname for t in first] == [t.trackname for t in second]
+
+    def test_asks_gpt_when_cached_tracks_were_heard(self, djgpt, calls):
+        djgpt.history = History()
+        djgpt.history.record(PLAYED, djgpt.ask("chill music for studying"))
+        again = djgpt.ask("chill music for study")
+        assert len(calls) == 2
+        assert not any(djgpt.history.is_repeat(t) for t in again)
+
+    def test_not_used_in_context(self, djgpt, calls):
+        djgpt.ask("chill music for studying")
+        session = Session()
+        session.record("something dreamy", djgpt.ask("something dreamy"))
+        djgpt.ask("chill music for studying", session=session)
+        assert len(calls) == 3
@@ -0,0 +1,105 @@
+"""
+Tests for the server and load test modules
+"""
+
+import json
+import threading
+from http.client import HTTPConnection
+
+import openai
+import pytest
+
+from djgpt.cli import DJGPTPromptSystem
+from djgpt.loadtest import call, load_test
+from djgpt.prompt import GPTPromptSystem
+from djgpt.server import DJGPTServer, default_client_factory
+from djgpt.standins import LocalGPT, LocalSpotify, synthetic_tracks
+
+
+@pytest.fixture(autouse=True)
+def unshared_caches(monkeypatch):
+    """Fixture to undo sharing caches across the whole process"""
+    monkeypatch.setattr(GPTPromptSystem, "response_cache", None)
+    monkeypatch.setattr(DJGPTPromptSystem, "semantic_cache", None)
+    monkeypatch.setattr(openai, "requestssession", None)
+
+
+@pytest.fixture
+def server():
+    tracks = synthetic_tracks(50)
+    clients = []
+
+    def client_factory(credentials):
+        clients.append(LocalSpotify(tracks))
+        return clients[-1]
+
+    server = DJGPTServer(
+        ("127.0.0.1", 0),
+        num_tracks=3,
+        client_factory=client_factory,
+        chat_completion=LocalGPT(tracks, num_tracks=3).create,
+    )
+    server.clients = clients
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestServer:
+    """Test the multi-user server"""
+
+    def test_sessions_are_independent(self, server):
+        conn = HTTPConnection("127.0.0.1", server.server_port)
+        first = call(conn, "POST", "/sessions", {"access_token": "a"})["session"]
+        second = call(conn, "POST", "/sessions", {"access_token": "b"})["session"]
+
+        tracks = call(conn, "POST", f"/sessions/{first}/ask", {"request": "chill"})["tracks"]
+        assert [t["number"] for t in tracks] == [1, 2, 3]
+        assert call(conn, "POST", f"/sessions/{first}/play", {"tracks": [2]})["playing"] == [
+            tracks[1]["uri"]
+        ]
+        assert server.clients[0].playing == [tracks[1]["uri"]]
+        assert not hasattr(server.clients[1], "playing")
+
+        with pytest.raises(RuntimeError, match="400"):
+            call(conn, "POST", f"/sessions/{second}/play", {"tracks": "all"})
+
+        call(conn, "DELETE", f"/sessions/{first}")
+        with pytest.raises(RuntimeError, match="404"):
+            call(conn, "POST", f"/sessions/{first}/ask", {"request": "chill"})
+
+    @pytest.mark.parametrize(
+        "action, body",
+        [
+            ("play", {"tracks": ["two"]}),
+            ("play", {"tracks": [4]}),
+            ("play", {"tracks": 2}),
+            ("play", ["tracks", 2]),
+            ("ask", {"request": 5}),
+            ("ask", "chill"),
+        ],
+    )
+    def test_malformed_bodies_are_bad_requests(self, server, action, body):
+        conn = HTTPConnection("127.0.0.1", server.server_port)
+        session = call(conn, "POST", "/sessions", {"access_token": "a"})["session"]
+        call(conn, "POST", f"/sessions/{session}/ask", {"request": "chill"})
+
+        conn.request("POST", f"/sessions/{session}/{action}", body=json.dumps(body))
+        response = conn.getresponse()
+        assert response.status == 400
+        assert "error" in json.loads(response.read())
+        # The connection is still good for the next request
+        assert call(conn, "POST", f"/sessions/{session}/play", {"tracks": [1]})["playing"]
+
+    def test_sessions_need_an_access_token(self):
+        with pytest.raises(ValueError, match="access_token"):
+            default_client_factory({"client_id": "id", "client_secret": "secret"})
+        assert default_client_factory({"access_token": "a"})._auth == "a"
+
+    def test_load_test(self):
+        stats = load_test(users=3, turns=4, catalog_size=100, distinct_requests=1, warm=1)
+        assert stats["turns"] == 12
+        # Every user's first request is served from the warmed up semantic cache, the rest have context
+        assert stats["semantic_cache_hit_rate"] == 3 / 4
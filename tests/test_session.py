@@ -0,0 +1,117 @@
+"""
+Tests for the session module
+"""
+
+import time
+from unittest.mock import patch
+
+from djgpt import spotify
+from djgpt.session import Session
+from djgpt.snapshot import load_snapshot, save_snapshot, snapshot_path
+from djgpt.spotify import Spotify, Track
+
+
+def resolved_track(artist: str, trackname: str) -> Track:
+    track = Track(artist=artist, trackname=trackname)
+    track.spotify = Spotify(url=f"https://{trackname}", uri=f"spotify:track:{trackname}", stash={})
+    return track
+
+
+class TestSession:
+    """Test session state"""
+
+    def test_expand_track_references(self):
+        session = Session()
+        session.record(
+            "chill", [resolved_track("Air", "La Femme"), resolved_track("Moby", "Porcelain")]
+        )
+        assert session.expand("more like number 2") == 'more like "Porcelain" by Moby'
+        assert session.expand("something like the first one") == 'something like "La Femme" by Air'
+        assert session.expand("more like #7") == "more like #7"
+
+    def test_context_is_bounded(self):
+        session = Session(max_turns=2)
+        assert session.context() is None
+        for request in ("one", "two", "three"):
+            session.record(request, [resolved_track("Air", request)])
+        context = session.context()
+        assert '"one"' not in context
+        assert '"two"' in context and "three by Air" in context
+
+    @patch("djgpt.spotify.search_spotify")
+    def test_reuse_skips_search(self, mock_search):
+        session = Session()
+        session.record("chill", [resolved_track("Air", "La Femme")])
+
+        track = session.reuse([Track(artist="air ", trackname="La Femme")])[0]
+        assert track.spotify.uri == "spotify:track:La Femme"
+        mock_search.assert_not_called()
+
+    def test_resolved_is_bounded(self):
+        session = Session(max_resolved=2)
+        session.record("chill", [resolved_track("Air", str(n)) for n in range(5)])
+        assert list(session.resolved) == [("air", "3"), ("air", "4")]
+
+
+class TestSnapshot:
+    """Test snapshotting and resuming a session"""
+
+    def test_round_trip(self, cache_dir, monkeypatch):
+        session = Session()
+        missing = Track(artist="Nobody", trackname="Nothing")
+        missing.spotify = None
+        session.record("chill", [resolved_track("Air", "La Femme"), missing])
+        token = {"access_token": "token", "expires_at": time.time() + 3600}
+        monkeypatch.setattr(spotify, "S_TOKEN_INFO", token)
+        monkeypatch.setattr(spotify, "S_DEVICE_ID", "kitchen")
+        save_snapshot(session)
+
+        monkeypatch.setattr(spotify, "S_TOKEN_INFO", None)
+        monkeypatch.setattr(spotify, "S_DEVICE_ID", None)
+        restored = load_snapshot().restore()
+        assert spotify.S_TOKEN_INFO == token
+        assert spotify.S_DEVICE_ID == "kitchen"
+        assert restored.context() == session.context()
+        assert restored.track(1).spotify.uri == "spotify:track:La Femme"
+        assert restored.track(2).resolved and restored.track(2).spotify is None
+        assert restored.reuse([Track(artist="air", trackname="la femme")])[0].resolved
+
+    def test_expired_token_is_not_restored(self, cache_dir, monkeypatch):
+        monkeypatch.setattr(spotify, "S_TOKEN_INFO", {"access_token": "old", "expires_at": 0})
+        save_snapshot(Session())
+        monkeypatch.setattr(spotify, "S_TOKEN_INFO", None)
+        load_snapshot().restore()
+        assert spotify.S_TOKEN_INFO is None
+
+    def test_restored_token_refreshes_itself(self, cache_dir, monkeypatch):
+        expired = {
+            "access_token": "old",
+            "refresh_token": "refresh",
+            "scope": "user-read-playback-state user-modify-playback-state",
+            "expires_at": 0,
+        }
+        monkeypatch.setattr(spotify, "S_TOKEN_INFO", expired)
+        save_snapshot(Session())
+        monkeypatch.setattr(spotify, "S_TOKEN_INFO", None)
+        load_snapshot().restore()
+        assert spotify.S_TOKEN_INFO == expired
+
+        def refresh(oauth, refresh_token):
+            token = {**expired, "access_token": "new", "expires_at": time.time() + 3600}
+            oauth.cache_handler.save_token_to_cache(token)
+            return token
+
+        monkeypatch.chdir(cache_dir)
+        spotify._cli_spotify.cache_clear()
+        with patch("spotipy.SpotifyOAuth.refresh_access_token", refresh):
+            client = spotify._cli_spotify()
+        spotify._cli_spotify.cache_clear()
+        assert spotify.S_TOKEN_INFO["access_token"] == "new"
+        # The client keeps refreshing it, rather than being stuck with a token that expires
+        assert client.auth_manager.cache_handler.get_cached_token() is spotify.S_TOKEN_INFO
+
+    def test_stale_or_broken_snapshots_are_ignored(self, cache_dir):
+        save_snapshot(Session())
+        assert load_snapshot(max_age=-1) is None
+        snapshot_path().write_text('{"session": {}}')
+        assert load_snapshot() is None
@@ -0,0 +1,64 @@
+"""
+Tests for the soak module
+"""
+
+import pytest
+
+from djgpt.cli import DJGPTPromptSystem
+from djgpt.prompt import GPTPromptSystem
+from djgpt.soak import Sample, SoakReport, growth_failures, soak
+
+
+@pytest.fixture(autouse=True)
+def unshared_caches(monkeypatch):
+    """Fixture to keep the soak's caches to itself"""
+    monkeypatch.setattr(GPTPromptSystem, "response_cache", None)
+    monkeypatch.setattr(DJGPTPromptSystem, "semantic_cache", None)
+
+
+def report(series, latencies=()):
+    return SoakReport(
+        turns=len(series),
+        latencies=list(latencies),
+        samples=[Sample(turn=n, metrics=metrics) for n, metrics in enumerate(series)],
+    )
+
+
+class TestGrowthFailures:
+    """Test spotting unbounded growth and latency drift"""
+
+    def test_levelled_off(self):
+        series = [{"objects": 1000 + min(n, 3) * 100, "cache": 10 * n} for n in range(20)]
+        assert growth_failures(report(series, [0.01] * 100), bounds={"cache": 200}) == []
+
+    def test_leak(self):
+        series = [{"objects": 1000 + 100 * n} for n in range(20)]
+        assert growth_failures(report(series)) == ["objects kept growing from 1800 to 2600"]
+
+    def test_over_bound(self):
+        series = [{"cache": 10 * n} for n in range(20)]
+        assert growth_failures(report(series), bounds={"cache": 100}) == [
+            "cache went over its bound of 100 to 190"
+        ]
+
+    def test_history_may_grow(self):
+        series = [{"history_events": 100 * n} for n in range(20)]
+        assert growth_failures(report(series)) == []
+
+    def test_latency_drift(self):
+        latencies = [0.01 + 0.001 * n for n in range(100)]
+        [failure] = growth_failures(report([], latencies))
+        assert failure.startswith("Turns slowed down")
+
+
+class TestSoak:
+    """Test a short soak against the stand-ins"""
+
+    def test_short_soak(self):
+        result = soak(turns=300, sample_every=30, catalog_size=200, distinct_requests=20)
+        assert len(result.latencies) == 300
+        assert [s.turn for s in result.samples] == list(range(30, 301, 30))
+        assert result.failures == []
+        # Every turn played something, and the session only remembers so much
+        assert result.series("history_events")[-1] > 300
+        assert max(result.series("session_resolved")) <= 500
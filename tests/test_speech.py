@@ -2,11 +2,18 @@
 Tests for the speech module
 """
 
+import sys
+import time
+import types
+from threading import Event
 from unittest.mock import patch
 
 import pytest
 
-from djgpt.speech import listen, say
+from djgpt import speech
+from djgpt.speech import Interrupted, TypeAhead, interruptible, listen, say
+from djgpt.stt import STTChoice
+from djgpt.utils import Cancelled, check_cancelled
 
 
 @pytest.fixture
@@ -67,3 +74,88 @@ class TestSpeech:
         result = listen()
         assert result is None
         mock_console.log.assert_called_once()
+
+
+class TestTypeAhead:
+    """Test reading input while busy"""
+
+    def type_ahead(self, *lines):
+        lines = iter(lines)
+
+        def read():
+            try:
+                return next(lines)
+            except StopIteration:
+                raise EOFError from None
+
+        return TypeAhead(read=read).start()
+
+    def test_lines_then_end_of_input(self):
+        type_ahead = self.type_ahead("chill", "", "2")
+        type_ahead.thread.join(timeout=1)
+        assert type_ahead.get() == "chill"
+        # Blank lines aren't a new request
+        assert type_ahead.poll() == "2"
+        assert type_ahead.poll() is None
+        assert type_ahead.get(timeout=1) is None
+        assert type_ahead.get(timeout=1) is None
+
+    def test_new_request_interrupts_work(self, monkeypatch):
+        monkeypatch.setattr(speech, "TYPE_AHEAD", TypeAhead(read=Event().wait).start())
+        stopped = Event()
+
+        def slow_ask():
+            while True:
+                try:
+                    check_cancelled()
+                except Cancelled:
+                    stopped.set()
+                    raise
+                time.sleep(0.01)
+
+        speech.TYPE_AHEAD.lines.put("something faster")
+        with pytest.raises(Interrupted) as interrupted:
+            interruptible(slow_ask)
+        assert interrupted.value.request == "something faster"
+        assert stopped.wait(timeout=1)
+
+    def test_finished_work_is_returned(self, monkeypatch):
+        monkeypatch.setattr(speech, "TYPE_AHEAD", TypeAhead(read=Event().wait).start())
+        assert interruptible(lambda x: x * 2, 21) == 42
+
+
+class FakeEngine:
+    """Stands in for a pyttsx3 engine, saving whatever it was asked to say as the file's contents"""
+
+    def __init__(self):
+        self.saving = []
+
+    def setProperty(self, name, value):
+        pass
+
+    def save_to_file(self, text, path):
+        self.saving.append((text, path))
+
+    def runAndWait(self):
+        for text, path in self.saving:
+            with open(path, "w") as f:
+                f.write(text)
+
+
+class TestUseVoice:
+    """Test calibrating speech recognition on spoken requests"""
+
+    def test_calibrates_on_a_spoken_request(self, cache_dir, monkeypatch):
+        monkeypatch.setitem(sys.modules, "pyttsx3", types.SimpleNamespace(init=FakeEngine))
+        monkeypatch.setattr(speech, "STT", None)
+        choice = STTChoice(model="base.en", threads=1, fp16=False, rtf=0.1)
+        with patch("djgpt.speech.choose_model", return_value=choice) as choose_model:
+            speech.use_voice(0.5)
+        clip = choose_model.call_args.kwargs["clip_path"]
+        assert clip == cache_dir / "stt-clip.wav"
+        assert clip.read_text() == speech.CALIBRATION_REQUEST
+        assert speech.STT == choice
+
+    def test_no_spoken_request_without_pyttsx3(self, cache_dir, monkeypatch):
+        monkeypatch.setitem(sys.modules, "pyttsx3", None)
+        assert speech.spoken_clip() is None
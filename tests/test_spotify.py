@@ -2,11 +2,33 @@
 Tests for the spotify module
 """
 
+import time
 from unittest.mock import MagicMock, patch
 
 import pytest
+from spotipy import SpotifyException
 
-from djgpt.spotify import Spotify, Track, search_spotify
+from djgpt import spotify
+from djgpt.catalog import get_catalog
+from djgpt.spotify import (
+    DEVICES,
+    SEARCH_LIMIT,
+    Devices,
+    Spotify,
+    Track,
+    _persisted_device,
+    choose_device,
+    play_on_spotify,
+    preferred_device,
+    ready_device,
+    resolve_tracks,
+    search_queries,
+    search_spotify,
+    select_device,
+    use_spotify,
+)
+from djgpt.standins import LocalSpotify
+from djgpt.utils import deadline
 
 
 @pytest.fixture
@@ -80,6 +102,8 @@ class TestSpotifySearch:
             "tracks": {
                 "items": [
                     {
+                        "name": "Test Track",
+                        "artists": [{"name": "Test Artist"}],
                         "external_urls": {"spotify": "https://open.spotify.com/track/123"},
                         "uri": "spotify:track:123",
                     }
@@ -91,8 +115,8 @@ class TestSpotifySearch:
         result = search_spotify("Test Artist", "Test Track")
 
         # Assert the Spotify API was called with correct query
-        mock_spotify_api.search.assert_called_once_with(
-            "artist:Test Artist track:Test Track", limit=1, offset=0, type="track"
+        mock_spotify_api.search.assert_any_call(
+            "artist:Test Artist track:Test Track", limit=SEARCH_LIMIT, offset=0, type="track"
         )
 
         # Assert the result is as expected
@@ -121,3 +145,257 @@ class TestSpotifySearch:
 
         # Assert the result is None
         assert result is None
+
+
+class CountingSpotify(LocalSpotify):
+    """Local Spotify stand-in counting the tracks searched for, by their strict query"""
+
+    searches = 0
+
+    def search(self, q, **kwargs):
+        self.searches += q.startswith("artist:")
+        return super().search(q, **kwargs)
+
+
+class TestResolveTracks:
+    """Test resolving just enough candidate tracks"""
+
+    def candidates(self):
+        return [
+            Track(artist="Air", trackname="Playground Love", quality=0.5),
+            Track(artist="Made Up", trackname="Hallucination", quality=0.9),
+            Track(artist="Bonobo", trackname="Kerala", quality=0.8),
+            Track(artist="Massive Attack", trackname="Teardrop", quality=0.7),
+            Track(artist="Nightmares on Wax", trackname="You Wish", quality=0.1),
+        ]
+
+    def test_stops_once_enough_are_playable(self):
+        client = CountingSpotify(
+            [
+                ("Air", "Playground Love"),
+                ("Bonobo", "Kerala"),
+                ("Massive Attack", "Teardrop"),
+                ("Nightmares on Wax", "You Wish"),
+            ]
+        )
+        candidates = self.candidates()
+        with use_spotify(client):
+            playable = list(resolve_tracks(candidates, 2))
+
+        assert [t.trackname for t in playable] == ["Kerala", "Teardrop"]
+        # Two wanted plus the one hallucination, the rest were never searched for
+        assert client.searches == 3
+        assert not candidates[0].resolved and not candidates[4].resolved
+
+    def test_yields_what_it_can(self):
+        with use_spotify(CountingSpotify([("Bonobo", "Kerala")])):
+            playable = list(resolve_tracks(self.candidates(), 3))
+        assert [t.trackname for t in playable] == ["Kerala"]
+
+    def test_stops_with_what_was_found_in_time(self):
+        client = CountingSpotify([("Made Up", "Hallucination"), ("Bonobo", "Kerala")], latency=0.2)
+        start = time.perf_counter()
+        with use_spotify(client), deadline(0.3):
+            playable = list(resolve_tracks(self.candidates(), 3))
+        # Teardrop wasn't found in the first round of searches, and there was no time for another
+        assert [t.trackname for t in playable] == ["Hallucination", "Kerala"]
+        assert time.perf_counter() - start < 0.4
+
+    def test_already_resolved_tracks_are_not_searched(self):
+        client = CountingSpotify()
+        track = Track(artist="Bonobo", trackname="Kerala")
+        track.spotify = Spotify(url="https://track/1", uri="spotify:track:1", stash={})
+        with use_spotify(client):
+            assert list(resolve_tracks([track], 1)) == [track]
+        assert client.searches == 0
+
+
+class FlakySpotify(LocalSpotify):
+    """A stand-in with a speaker that isn't playing yet, and a count of device lookups"""
+
+    def __init__(self, *args, failures: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.device_list.append(
+            {"id": "kitchen", "name": "Kitchen", "is_active": False, "is_restricted": False}
+        )
+        self.failures = failures
+        self.lookups = 0
+        self.transfers = []
+
+    def devices(self):
+        self.lookups += 1
+        return super().devices()
+
+    def transfer_playback(self, device_id, force_play=True):
+        self.transfers.append(device_id)
+        super().transfer_playback(device_id, force_play)
+
+    def start_playback(self, device_id=None, uris=None, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise SpotifyException(404, -1, "No active device found")
+        super().start_playback(device_id=device_id, uris=uris, **kwargs)
+
+
+def playable(n: int) -> Track:
+    track = Track(artist="Artist", trackname=f"Track {n}")
+    track.spotify = Spotify(url=f"https://track/{n}", uri=f"spotify:track:{n}", stash={})
+    return track
+
+
+class TestDevices:
+    """Test choosing, caching and transferring playback to Spotify devices"""
+
+    def test_devices_are_cached(self):
+        client = FlakySpotify()
+        devices = Devices(ttl=60)
+        assert devices.get(client) == devices.get(client)
+        assert client.lookups == 1
+        devices.forget(client)
+        devices.get(client)
+        assert client.lookups == 2
+
+    def test_choose_device(self):
+        devices = FlakySpotify().devices()["devices"]
+        assert choose_device(devices)["id"] == "local"
+        assert choose_device(devices, {"id": "kitchen"})["id"] == "kitchen"
+        # Device ids can change, so the name is good enough
+        assert choose_device(devices, {"id": "gone", "name": "Kitchen"})["id"] == "kitchen"
+        assert choose_device(devices, {"id": "gone"})["id"] == "local"
+        assert choose_device([]) is None
+
+    def test_transfers_to_the_selected_device_before_playing(self, monkeypatch):
+        monkeypatch.setattr(spotify, "S_DEVICE_ID", None)
+        client = FlakySpotify()
+        with use_spotify(client):
+            assert select_device("kitchen")["id"] == "kitchen"
+            play_on_spotify([playable(1)])
+            play_on_spotify([playable(2)])
+
+        assert client.transfers == ["kitchen"]
+        assert client.device_id == "kitchen"
+        assert client.playing == ["spotify:track:2"]
+
+    def test_selected_device_is_remembered(self, monkeypatch):
+        monkeypatch.setattr(spotify, "S_DEVICE_ID", None)
+        with use_spotify(FlakySpotify()):
+            select_device("Kitchen")
+            assert select_device("Bathroom") is None
+
+        monkeypatch.setattr(spotify, "S_DEVICE_ID", None)
+        _persisted_device.cache_clear()
+        assert preferred_device() == {"id": "kitchen", "name": "Kitchen"}
+
+    def test_preference_is_only_for_the_cli_user(self, monkeypatch):
+        monkeypatch.setattr(spotify, "S_DEVICE_ID", "kitchen")
+        client = FlakySpotify()
+        assert ready_device(client, preferred=None) == "local"
+        assert client.transfers == []
+        assert ready_device(client) == "kitchen"
+
+    def test_retries_with_fresh_devices_without_asking(self):
+        client = FlakySpotify(failures=1)
+        with use_spotify(client), patch("djgpt.utils.Confirm.ask") as ask:
+            DEVICES.get(client)
+            play_on_spotify([playable(1)])
+
+        ask.assert_not_called()
+        assert client.lookups == 2
+        assert client.playing == ["spotify:track:1"]
+
+
+class TestSearchCascade:
+    """Test racing query variants to find the track GPT meant"""
+
+    def test_search_queries(self):
+        assert search_queries("Daft Punk", "One More Time") == [
+            "artist:Daft Punk track:One More Time",
+            "Daft Punk One More Time",
+        ]
+        assert search_queries("Daft Punk feat. Pharrell", "Get Lucky - 2013 Remaster")[-1] == (
+            "artist:Daft Punk track:Get Lucky"
+        )
+
+    def test_stripped_query_finds_remasters(self):
+        client = LocalSpotify([("The Beatles", "Here Comes the Sun")])
+        found = search_spotify("The Beatles", "Here Comes The Sun - Remastered 2009", client=client)
+        assert found.uri == client.add("The Beatles", "Here Comes the Sun")["uri"]
+
+    def test_loose_query_finds_what_filters_miss(self):
+        class StrictFilters(LocalSpotify):
+            def search(self, q, **kwargs):
+                if q.startswith("artist:"):
+                    return {"tracks": {"items": []}}
+                return super().search(q, **kwargs)
+
+        client = StrictFilters([("Simon and Garfunkel", "The Boxer")])
+        found = search_spotify("Simon and Garfunkel", "The Boxer", client=client)
+        assert found.uri == client.add("Simon and Garfunkel", "The Boxer")["uri"]
+
+    def test_poor_matches_are_dropped(self):
+        client = MagicMock()
+        client.search.side_effect = lambda q, **kwargs: {
+            "tracks": {
+                "items": []
+                if q.startswith("artist:")
+                else [
+                    {
+                        "name": "Kerala",
+                        "artists": [{"name": "Bonobo"}],
+                        "external_urls": {"spotify": "https://track/1"},
+                        "uri": "spotify:track:1",
+                    }
+                ]
+            }
+        }
+        assert search_spotify("Made Up", "Hallucination", client=client) is None
+
+    def test_best_match_wins(self):
+        client = MagicMock()
+        client.search.return_value = {
+            "tracks": {
+                "items": [
+                    {
+                        "name": f"{name}",
+                        "artists": [{"name": "Bonobo"}],
+                        "external_urls": {"spotify": f"https://track/{n}"},
+                        "uri": f"spotify:track:{n}",
+                    }
+                    for n, name in enumerate(["Kerala - Edit", "Kong", "Kerala"])
+                ]
+            }
+        }
+        assert search_spotify("Bonobo", "Kerala", client=client).uri == "spotify:track:2"
+
+    def test_poor_strict_match_is_not_catalogued(self):
+        client = MagicMock()
+        client.search.side_effect = lambda q, **kwargs: {
+            "tracks": {
+                "items": [
+                    {
+                        "name": "Kong",
+                        "artists": [{"name": "Bonobo"}],
+                        "external_urls": {"spotify": "https://track/1"},
+                        "uri": "spotify:track:1",
+                    }
+                ]
+                if q.startswith("artist:")
+                else []
+            }
+        }
+        with patch("djgpt.spotify.get_spotify", return_value=client):
+            assert search_spotify("Bonobo", "Kerala").uri == "spotify:track:1"
+        assert get_catalog().lookup("Bonobo", "Kerala") is None
+        assert len(get_catalog()) == 0
+
+    def test_confident_match_does_not_wait(self):
+        class SlowLoose(LocalSpotify):
+            def search(self, q, **kwargs):
+                if not q.startswith("artist:"):
+                    time.sleep(1)
+                return super().search(q, **kwargs)
+
+        client = SlowLoose([("Bonobo", "Kerala")])
+        start = time.perf_counter()
+        assert search_spotify("Bonobo", "Kerala", client=client) is not None
+        assert time.perf_counter() - start < 0.5
@@ -0,0 +1,81 @@
+"""
+Tests for the stt module
+"""
+
+import time
+
+import pytest
+
+from djgpt import stt
+from djgpt.stt import SAMPLE_RATE, calibrate, choose_model, synthetic_clip
+
+
+def timed_models(rtfs):
+    """A transcribe stand-in where each model runs at its own real-time factor, regardless of threads"""
+    calls = []
+
+    def transcribe(model, audio, threads, fp16):
+        calls.append((model, threads))
+        time.sleep(rtfs[model] * len(audio) / SAMPLE_RATE)
+        return "play something"
+
+    transcribe.calls = calls
+    return transcribe
+
+
+@pytest.fixture(autouse=True)
+def two_thread_settings(monkeypatch):
+    monkeypatch.setattr(stt, "thread_settings", lambda: (4, 2))
+
+
+class TestCalibrate:
+    """Test picking the speech to text model by real-time factor"""
+
+    CLIP = synthetic_clip(0.05)
+
+    def test_synthetic_clip(self):
+        clip = synthetic_clip(2.0)
+        assert len(clip) == 2 * SAMPLE_RATE
+        assert 0.05 < abs(clip).max() < 1.0
+
+    def test_most_accurate_fast_enough_model(self):
+        transcribe = timed_models({"small.en": 2.0, "base.en": 0.3, "tiny.en": 0.1})
+        choice = calibrate(0.5, clip=self.CLIP, transcribe=transcribe)
+        assert choice.model == "base.en"
+        assert choice.rtf == pytest.approx(0.3, abs=0.15)
+        # Each setting is warmed up then timed, smallest first, and we stop at the first model that is too slow
+        assert [model for model, _ in transcribe.calls[::4]] == ["tiny.en", "base.en", "small.en"]
+        assert len(transcribe.calls) == 12
+
+    def test_fastest_when_nothing_is_fast_enough(self):
+        transcribe = timed_models({"small.en": 3.0, "tiny.en": 1.5})
+        choice = calibrate(
+            0.5, clip=self.CLIP, models=["small.en", "tiny.en"], transcribe=transcribe
+        )
+        assert choice.model == "tiny.en"
+        assert {model for model, _ in transcribe.calls} == {"tiny.en"}
+
+    def test_choice_is_cached_per_machine(self, cache_dir, monkeypatch):
+        monkeypatch.setattr(stt, "synthetic_clip", lambda: self.CLIP)
+        transcribe = timed_models({"base.en": 0.1})
+        choice = choose_model(0.5, models=["base.en"], transcribe=transcribe)
+        calls = len(transcribe.calls)
+
+        assert choose_model(0.5, models=["base.en"], transcribe=transcribe) == choice
+        assert len(transcribe.calls) == calls
+        assert (cache_dir / "stt.json").exists()
+
+        # A different target is a different choice
+        choose_model(0.05, models=["base.en"], transcribe=transcribe)
+        assert len(transcribe.calls) > calls
+
+    def test_falls_back_to_synthetic_clip(self, tmp_path, monkeypatch):
+        clips = []
+        monkeypatch.setattr(stt, "synthetic_clip", lambda: clips.append(self.CLIP) or self.CLIP)
+        transcribe = timed_models({"base.en": 0.1})
+        # Whether or not Whisper is installed, there's no loading a clip that isn't there
+        choice = choose_model(
+            0.5, clip_path=tmp_path / "missing.wav", models=["base.en"], transcribe=transcribe
+        )
+        assert choice.model == "base.en"
+        assert len(clips) == 1
@@ -2,34 +2,112 @@
 Tests for the utils module
 """
 
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch
 
-from djgpt.utils import debug, retry
+import pytest
+
+from djgpt import utils
+from djgpt.utils import (
+    DeadlineExceeded,
+    JSONFormatter,
+    call_timeout,
+    configure_logging,
+    deadline,
+    debug,
+    http_session,
+    recent_debug,
+    remaining,
+    retry,
+)
+
+
+class Expensive:
+    """Something that counts how often it gets formatted"""
+
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return "expensive"
+
+
+@pytest.fixture
+def rate_limited():
+    """Fixture for the URL of a local server that always rate limits, asking to come back after a minute"""
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            self.send_response(429)
+            self.send_header("Retry-After", "60")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/", requests
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def logging_level():
+    """Fixture to configure logging at a level, going back to the default afterwards"""
+    yield configure_logging
+    configure_logging()
 
 
 class TestDebug:
     """Test debug function"""
 
-    @patch("djgpt.utils.CONSOLE")
-    @patch("djgpt.utils.LOGLEVEL", "DEBUG")
-    def test_debug_logging_enabled(self, mock_console):
+    def test_debug_logging_enabled(self, logging_level, caplog):
         """Test debug function when logging is enabled"""
-        debug("Test message")
-        mock_console.log.assert_called_once_with("Test message")
+        logging_level("DEBUG")
+        debug("Test %s", "message")
+        assert caplog.messages == ["Test message"]
 
-    @patch("djgpt.utils.CONSOLE")
-    @patch("djgpt.utils.LOGLEVEL", "TRACE")
-    def test_debug_trace_enabled(self, mock_console):
+    def test_debug_trace_enabled(self, logging_level, caplog):
         """Test debug function when trace is enabled"""
+        logging_level("TRACE")
         debug("Test message")
-        mock_console.log.assert_called_once_with("Test message")
+        utils.trace("Trace message")
+        assert caplog.messages == ["Test message", "Trace message"]
 
-    @patch("djgpt.utils.CONSOLE")
-    @patch("djgpt.utils.LOGLEVEL", "INFO")
-    def test_debug_logging_disabled(self, mock_console):
-        """Test debug function when logging is disabled"""
-        debug("Test message")
-        mock_console.log.assert_not_called()
+    def test_debug_logging_disabled(self, logging_level, caplog):
+        """Test debug function when logging is disabled, nothing should even be formatted"""
+        logging_level("INFO")
+        expensive = Expensive()
+        debug("Test message %s", expensive)
+        assert caplog.messages == []
+        assert expensive.formatted == 0
+
+    def test_ring_buffer_keeps_recent_debug(self, logging_level):
+        """Test recent debug events are kept even when not logged"""
+        logging_level("INFO", ring_size=2)
+        for n in range(3):
+            debug("Event %d", n)
+        assert [line.split(" ", 1)[1] for line in recent_debug()] == [
+            "DEBUG Event 1",
+            "DEBUG Event 2",
+        ]
+
+    def test_json_formatter_includes_fields(self):
+        """Test structured fields make it into the JSON output"""
+        record = logging.LogRecord("djgpt", logging.DEBUG, __file__, 1, "Took %.1fs", (1.23,), None)
+        record.fields = {"model": "gpt-4"}
+        entry = json.loads(JSONFormatter().format(record))
+        assert entry["message"] == "Took 1.2s"
+        assert entry["model"] == "gpt-4"
 
 
 class TestRetry:
@@ -138,3 +216,51 @@ class TestRetry:
         result = test_func()
         assert result == "success"
         assert attempts[0] == 2
+
+
+class TestDeadline:
+    """Test deadlines and per-call timeouts"""
+
+    def test_no_deadline(self):
+        assert remaining() is None
+        assert call_timeout(10) == 10
+        assert call_timeout(None) is None
+
+    def test_inner_deadline_never_extends_outer(self):
+        with deadline(1):
+            with deadline(60):
+                assert remaining() <= 1
+            with deadline(0.5):
+                assert remaining() <= 0.5
+                assert call_timeout(10) <= 0.5
+                assert call_timeout((5, 0.1)) == (pytest.approx(0.5, abs=0.1), 0.1)
+        assert remaining() is None
+
+    def test_retry_gives_up_at_the_deadline(self):
+        calls = []
+
+        @retry(num_attempts=100, exception_class=TimeoutError)
+        def hangs():
+            calls.append(1)
+            time.sleep(0.05)
+            raise TimeoutError()
+
+        with deadline(0.12), pytest.raises(DeadlineExceeded):
+            hangs()
+        assert len(calls) < 5
+
+    def test_shared_session_retries_rate_limits(self):
+        retries = http_session().get_adapter("https://api.spotify.com").max_retries
+        assert retries.is_retry("PUT", 429, has_retry_after=True)
+        assert retries.is_retry("GET", 503)
+        assert not retries.is_retry("GET", 404)
+        assert retries.respect_retry_after_header
+
+    def test_shared_session_gives_up_on_rate_limits_past_the_deadline(self, rate_limited):
+        url, requests = rate_limited
+        start = time.monotonic()
+        with deadline(5):
+            response = http_session().get(url)
+        assert response.status_code == 429
+        assert time.monotonic() - start < 1
+        assert len(requests) == 1